@@ -60,4 +60,9 @@ admin.site.register(models.TimeSeriesDataType)
 admin.site.register(models.TimeSeriesData)
 admin.site.register(models.SleepStageTimeSeriesData)
 admin.site.register(models.SleepTypeData)
-admin.site.register(models.SleepStageSummary)
\ No newline at end of file
+admin.site.register(models.SleepStageSummary)
+admin.site.register(models.BackfillCheckpoint)
+admin.site.register(models.SleepHypnogram)
+admin.site.register(models.SyncWatermark)
+admin.site.register(models.SyncJob)
+admin.site.register(models.SyncLease)
@@ -29,8 +29,6 @@ FITAPP_SUBSCRIPTIONS = None
 
 # The initial delay (in seconds) when doing the historical data import
 FITAPP_HISTORICAL_INIT_DELAY = 10
-# The delay (in seconds) between items when doing requests
-FITAPP_BETWEEN_DELAY = 5
 
 # By default, don't try to get intraday time series data. See
 # https://dev.fitbit.com/docs/activity/#get-activity-intraday-time-series for
@@ -60,9 +58,85 @@ FITAPP_LOGIN_REQUIRED = True
 # to the database.
 FITAPP_SAVE_INTRADAY_ZERO_VALUES = False
 
+# The maximum number of data points returned by a single request to the
+# intraday data view.
+FITAPP_INTRADAY_MAX_POINTS = 1440
+
+# The maximum number of data points in a page of data read from the database.
+FITAPP_MAX_PAGE_SIZE = 1000
+
+# The number of users whose sleep logs are retrieved at the same time by
+# utils.get_all_sleep_log.
+FITAPP_SLEEP_SWEEP_CONCURRENCY = 8
+
+# The number of windows of up to 100 days of a user's sleep logs that are
+# retrieved at the same time by utils.get_sleep_log_by_date_range.
+FITAPP_SLEEP_BACKFILL_CONCURRENCY = 2
+
+# Whether sleep stages are also saved as one SleepStageTimeSeriesData row per
+# stage. They are always saved compactly as one SleepHypnogram per night.
+FITAPP_SAVE_SLEEP_STAGE_ROWS = True
+
 # The default amount of data we pull for each user registered with this app
 FITAPP_DEFAULT_PERIOD = 'max'
 
+# The number of days of a user's history of each resource retrieved at a time
+# when their data is backfilled after they integrate their Fitbit account.
+FITAPP_BACKFILL_WINDOW_DAYS = 365
+
+# The number of most recent days of each resource retrieved first when a
+# user's data is backfilled, before the rest of their history. It's also the
+# most days FITAPP_READ_THROUGH retrieves while a request waits.
+FITAPP_BACKFILL_RECENT_DAYS = 7
+
+# The Celery queue and priority of each lane of fitapp tasks: 'realtime' for
+# syncs of webhook updates and the most recent days of new users, 'backfill'
+# for the rest of new users' history, 'intraday' for intraday data and
+# 'maintenance' for subscriptions and sleep log sweeps. A queue of None is
+# Celery's default queue. How priorities are ordered depends on the broker,
+# with RabbitMQ higher numbers are more important. Lanes or keys missing from
+# this setting keep these defaults.
+FITAPP_TASK_LANES = {
+    'realtime': {'queue': None, 'priority': 9},
+    'intraday': {'queue': None, 'priority': 6},
+    'maintenance': {'queue': None, 'priority': 3},
+    'backfill': {'queue': None, 'priority': 0},
+}
+
+# The number of seconds a task running a user's sync jobs may go without
+# renewing its lease on them, before it's presumed dead and another task may
+# take over. The lease is renewed every third of this while a job runs.
+# Schedule the restart_sync_jobs task or management command to run about this
+# often, to restart the jobs of users whose task died.
+FITAPP_SYNC_LEASE_SECONDS = 60 * 5
+
+# The number of days before the newest synced date of a user's data that are
+# retrieved again by each sync, to update data their device synced late.
+FITAPP_SYNC_OVERLAP_DAYS = 2
+
+# Without FITAPP_SUBSCRIBE, the number of seconds the get_data view caches
+# each response from Fitbit, 0 to not cache them.
+FITAPP_LIVE_CACHE_TIMEOUT = 30
+# The most seconds the get_data view waits for the response of an identical
+# request to Fitbit that's in progress, before it makes its own request.
+FITAPP_LIVE_CACHE_WAIT = 10
+
+# With FITAPP_SUBSCRIBE, whether the get_data view retrieves the days of the
+# requested range that haven't been synced yet from Fitbit, and saves them,
+# before it responds with the stored data.
+FITAPP_READ_THROUGH = False
+# The number of seconds before the get_data view retrieves the same unsynced
+# days again, when FITAPP_READ_THROUGH is enabled.
+FITAPP_READ_THROUGH_MAX_AGE = 60 * 5
+
+# The number of seconds whether a user is integrated with Fitbit is cached.
+# It's cleared when their UserFitbit is saved or deleted.
+FITAPP_INTEGRATION_CACHE_TIMEOUT = 60 * 60
+
+# The number of seconds a user's Fitbit profile is cached after it's
+# retrieved, when they log in or integrate their Fitbit account.
+FITAPP_PROFILE_CACHE_TIMEOUT = 60 * 60 * 24
+
 # The collection we want to recieve subscription updates for
 # (e.g. 'activities'). None defaults to all collections.
 FITAPP_SUBSCRIPTION_COLLECTION = None
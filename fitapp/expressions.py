@@ -0,0 +1,93 @@
+"""
+Database expressions used to aggregate time series data in the database.
+
+These are written as plain ``Func`` expressions with vendor specific SQL so
+that they work with every version of Django we support.
+"""
+from django.db.models import DateField, FloatField, Func, IntegerField
+
+
+class NumericValue(Func):
+    """
+    Cast the string ``value`` of time series data to a number, so that it can
+    be aggregated.
+    """
+    template = 'CAST(%(expressions)s AS DOUBLE PRECISION)'
+
+    def __init__(self, expression, **extra):
+        super(NumericValue, self).__init__(
+            expression, output_field=FloatField(), **extra)
+
+    def as_sqlite(self, compiler, connection):
+        return self.as_sql(compiler, connection,
+                           template='CAST(%(expressions)s AS REAL)')
+
+    def as_mysql(self, compiler, connection):
+        return self.as_sql(compiler, connection,
+                           template='CAST(%(expressions)s AS DECIMAL(20, 6))')
+
+
+class EpochBucket(Func):
+    """
+    Truncate a datetime to the start of a fixed size bucket of ``seconds``,
+    expressed as the number of seconds since the epoch.
+    """
+    template = (
+        'CAST(FLOOR(EXTRACT(EPOCH FROM %(expressions)s) / %(seconds)d) '
+        '* %(seconds)d AS BIGINT)'
+    )
+
+    def __init__(self, expression, seconds, **extra):
+        super(EpochBucket, self).__init__(
+            expression, seconds=int(seconds), output_field=IntegerField(),
+            **extra)
+
+    def as_sqlite(self, compiler, connection):
+        return self.as_sql(compiler, connection, template=(
+            'CAST(ROUND((julianday(%(expressions)s) - 2440587.5) * 86400) '
+            'AS INTEGER) / %(seconds)d * %(seconds)d'
+        ))
+
+    def as_mysql(self, compiler, connection):
+        # UNIX_TIMESTAMP would read the datetime in the session time zone
+        return self.as_sql(compiler, connection, template=(
+            "FLOOR(TIMESTAMPDIFF(SECOND, '1970-01-01 00:00:00', "
+            "%(expressions)s) / %(seconds)d) * %(seconds)d"
+        ))
+
+
+class DateBucket(Func):
+    """
+    Truncate a datetime to the date that starts its day, week (starting on
+    Monday), month or year.
+    """
+    BUCKETS = ('day', 'week', 'month', 'year')
+    template = "CAST(DATE_TRUNC('%(bucket)s', %(expressions)s) AS DATE)"
+    sqlite_templates = {
+        'day': 'date(%(expressions)s)',
+        'week': "date(%(expressions)s, '-6 days', 'weekday 1')",
+        'month': "date(%(expressions)s, 'start of month')",
+        'year': "date(%(expressions)s, 'start of year')",
+    }
+    mysql_templates = {
+        'day': 'DATE(%(expressions)s)',
+        'week': ('DATE(DATE_SUB(%(expressions)s, '
+                 'INTERVAL WEEKDAY(%(expressions)s) DAY))'),
+        'month': ('DATE(DATE_SUB(%(expressions)s, '
+                  'INTERVAL DAYOFMONTH(%(expressions)s) - 1 DAY))'),
+        'year': 'MAKEDATE(YEAR(%(expressions)s), 1)',
+    }
+
+    def __init__(self, expression, bucket, **extra):
+        if bucket not in self.BUCKETS:
+            raise ValueError('Invalid bucket: {}'.format(bucket))
+        super(DateBucket, self).__init__(
+            expression, bucket=bucket, output_field=DateField(), **extra)
+
+    def as_sqlite(self, compiler, connection):
+        return self.as_sql(compiler, connection,
+                           template=self.sqlite_templates[self.extra['bucket']])
+
+    def as_mysql(self, compiler, connection):
+        return self.as_sql(compiler, connection,
+                           template=self.mysql_templates[self.extra['bucket']])
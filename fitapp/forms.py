@@ -1,10 +1,17 @@
+from datetime import timedelta
+
 from django import forms
 
 from . import utils
 from . import models
+from .expressions import DateBucket
 
 
 INPUT_FORMATS = ['%Y-%m-%d']
+DATETIME_INPUT_FORMATS = ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M',
+                          '%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M'] + INPUT_FORMATS
+FUNCTION_CHOICES = [(f, f) for f in sorted(
+    models.TimeSeriesDataQuerySet.AGGREGATE_FUNCTIONS)]
 
 
 class PeriodForm(forms.Form):
@@ -38,6 +45,91 @@ class RangeForm(forms.Form):
             }
 
 
+class IntradayForm(forms.Form):
+    """Data necessary to request intraday data from a specific time range."""
+    base_date = forms.DateTimeField(input_formats=DATETIME_INPUT_FORMATS)
+    end_date = forms.DateTimeField(input_formats=DATETIME_INPUT_FORMATS)
+    resolution = forms.ChoiceField(choices=[])
+    function = forms.ChoiceField(choices=FUNCTION_CHOICES, required=False)
+
+    def __init__(self, *args, **kwargs):
+        super(IntradayForm, self).__init__(*args, **kwargs)
+        RESOLUTION_CHOICES = [(r, r) for r in utils.get_valid_resolutions()]
+        self.fields['resolution'].choices = RESOLUTION_CHOICES
+
+    def clean_end_date(self):
+        end_date = self.cleaned_data['end_date']
+        if ':' not in self.data['end_date']:
+            # An end date without a time includes the whole day
+            end_date += timedelta(days=1)
+        return end_date
+
+    def clean(self):
+        cleaned_data = super(IntradayForm, self).clean()
+        base_date = cleaned_data.get('base_date')
+        end_date = cleaned_data.get('end_date')
+        if base_date and end_date and base_date >= end_date:
+            raise forms.ValidationError('end_date must be after base_date')
+        return cleaned_data
+
+    def get_fitbit_data(self):
+        if self.is_valid():
+            resolution = self.cleaned_data['resolution']
+            return {
+                'base_date': self.cleaned_data['base_date'],
+                'end_date': self.cleaned_data['end_date'],
+                'resolution': utils.get_valid_resolutions()[resolution],
+                'function': self.cleaned_data['function'] or 'sum',
+            }
+
+
+class AggregateForm(forms.Form):
+    """Data necessary to aggregate time series data by day, week, etc."""
+    bucket = forms.ChoiceField(choices=[(b, b) for b in DateBucket.BUCKETS])
+    function = forms.ChoiceField(choices=FUNCTION_CHOICES, required=False)
+
+    def get_fitbit_data(self):
+        if self.is_valid():
+            return {
+                'bucket': self.cleaned_data['bucket'],
+                'function': self.cleaned_data['function'] or 'sum',
+            }
+
+
+class SleepForm(forms.Form):
+    """Optional data included with sleep summaries."""
+    stages = forms.BooleanField(required=False)
+
+    def get_fitbit_data(self):
+        if self.is_valid():
+            return {'stages': self.cleaned_data['stages']}
+
+
+class PageForm(forms.Form):
+    """
+    Optional keyset pagination of data read from the database. The cursor is
+    taken from the previous page of data.
+    """
+    cursor = forms.CharField(required=False)
+    limit = forms.IntegerField(min_value=1, required=False)
+
+    def clean_cursor(self):
+        cursor = self.cleaned_data['cursor']
+        if not cursor:
+            return None
+        try:
+            return utils.decode_cursor(cursor)
+        except ValueError:
+            raise forms.ValidationError('Invalid cursor')
+
+    def get_fitbit_data(self):
+        if self.is_valid():
+            return {
+                'cursor': self.cleaned_data['cursor'],
+                'limit': self.cleaned_data['limit'],
+            }
+
+
 class UserFitbitForm(forms.Form):
     """
     This form is used for associating a user to a UserFitbit via the Django
@@ -0,0 +1,328 @@
+"""
+This django management command streams stored Fitbit data to files, for
+example for analytics. Unlike ``dumpdata``, the data is read from the
+database a chunk at a time and written out as it is read, so memory use stays
+flat however much data there is.
+
+The ``--data`` option chooses what to export: ``timeseries`` (the default)
+for ``TimeSeriesData``, ``sleep_stages`` for ``SleepStageTimeSeriesData`` or
+``sleep_summaries`` for the per level ``SleepTypeData`` of each
+``SleepStageSummary``.
+
+Data is written as CSV (the default), newline-delimited JSON (``--format
+json``), or Parquet or Arrow (``--format parquet`` or ``--format arrow``),
+which require the optional ``pyarrow`` package. Files are written to the
+``--output`` directory, one file for all of the data or, with the
+``--partition user`` or ``--partition month`` option, one file per user or
+calendar month.
+
+The exported data can be filtered by user primary key (``--user``), time
+series resource (``--resource activities/steps``), date range
+(``--base-date`` and ``--end-date``, both inclusive) and whether it is
+intraday time series data (``--intraday only`` or ``--intraday exclude``).
+Both ``--user`` and ``--resource`` may be given more than once.
+"""
+
+import csv
+import io
+import json
+import os
+import time
+from datetime import datetime, timedelta
+
+import six
+from dateutil.relativedelta import relativedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from fitapp.expressions import DateBucket
+from fitapp.models import (TimeSeriesData, TimeSeriesDataType,
+                           SleepStageTimeSeriesData, SleepTypeData)
+
+
+# The model, fields, column names and column types of each set of data
+DATA_SETS = {
+    'timeseries': {
+        'model': TimeSeriesData,
+        'fields': ('user', 'resource_type', 'date', 'value', 'intraday'),
+        'columns': ('user', 'resource', 'date', 'value', 'intraday'),
+        'types': ('int64', 'string', 'timestamp', 'string', 'bool_'),
+        'user': 'user',
+        'date': 'date',
+    },
+    'sleep_stages': {
+        'model': SleepStageTimeSeriesData,
+        'fields': ('user', 'date', 'level', 'seconds'),
+        'columns': ('user', 'date', 'level', 'seconds'),
+        'types': ('int64', 'timestamp', 'string', 'int64'),
+        'user': 'user',
+        'date': 'date',
+    },
+    'sleep_summaries': {
+        'model': SleepTypeData,
+        'fields': ('sleep_summary__user', 'sleep_summary__date', 'level',
+                   'count', 'minute'),
+        'columns': ('user', 'date', 'level', 'count', 'minutes'),
+        'types': ('int64', 'timestamp', 'string', 'int64', 'int64'),
+        'user': 'sleep_summary__user',
+        'date': 'sleep_summary__date',
+    },
+}
+
+
+class CSVWriter(object):
+    extension = 'csv'
+
+    def __init__(self, path, data_set):
+        if six.PY2:
+            self.file = open(path, 'wb')
+        else:
+            self.file = io.open(path, 'w', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(data_set['columns'])
+
+    def write(self, rows):
+        self.writer.writerows(
+            [[v.isoformat() if isinstance(v, datetime) else v for v in row]
+             for row in rows])
+
+    def close(self):
+        self.file.close()
+
+
+class JSONWriter(object):
+    extension = 'jsonl'
+
+    def __init__(self, path, data_set):
+        self.file = io.open(path, 'w', encoding='utf8')
+        self.columns = data_set['columns']
+
+    def write(self, rows):
+        for row in rows:
+            row = [v.isoformat() if isinstance(v, datetime) else v
+                   for v in row]
+            self.file.write(six.text_type(
+                json.dumps(dict(zip(self.columns, row)))) + u'\n')
+
+    def close(self):
+        self.file.close()
+
+
+class ArrowWriter(object):
+    extension = 'arrow'
+
+    def __init__(self, path, data_set):
+        try:
+            import pyarrow
+        except ImportError:
+            raise CommandError(
+                'The {} format requires pyarrow to be installed'.format(
+                    self.extension))
+        self.pa = pyarrow
+        fields = []
+        for column, _type in zip(data_set['columns'], data_set['types']):
+            if _type == 'timestamp':
+                tz = 'UTC' if settings.USE_TZ else None
+                fields.append(pyarrow.field(
+                    column, pyarrow.timestamp('us', tz=tz)))
+            else:
+                fields.append(pyarrow.field(column, getattr(pyarrow, _type)()))
+        self.schema = pyarrow.schema(fields)
+        self.writer = self.open(path)
+
+    def open(self, path):
+        return self.pa.ipc.new_file(path, self.schema)
+
+    def write(self, rows):
+        arrays = [self.pa.array(list(column), type=field.type)
+                  for column, field in zip(zip(*rows), self.schema)]
+        self.writer.write_table(
+            self.pa.Table.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+class ParquetWriter(ArrowWriter):
+    extension = 'parquet'
+
+    def open(self, path):
+        import pyarrow.parquet
+        return pyarrow.parquet.ParquetWriter(path, self.schema)
+
+
+WRITERS = {
+    'csv': CSVWriter,
+    'json': JSONWriter,
+    'arrow': ArrowWriter,
+    'parquet': ParquetWriter,
+}
+
+
+def iter_chunks(queryset, fields, chunk_size):
+    """
+    Yield the rows of the queryset a chunk at a time, in primary key order.
+
+    Each chunk continues from the last primary key of the previous one, so
+    every chunk is an index range read no matter how far into the table it
+    is, and only one chunk is held in memory.
+    """
+    last_pk = None
+    queryset = queryset.order_by('pk')
+    while True:
+        chunk = queryset
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        rows = list(chunk.values_list('pk', *fields)[:chunk_size])
+        if not rows:
+            return
+        last_pk = rows[-1][0]
+        yield [row[1:] for row in rows]
+
+
+class Command(BaseCommand):
+    help = """
+        Streams stored Fitbit time series or sleep data to CSV, JSON, Parquet
+        or Arrow files
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--data', choices=sorted(DATA_SETS), default='timeseries',
+            help='The data to export')
+        parser.add_argument(
+            '--format', choices=sorted(WRITERS), default='csv',
+            help='The format of the exported files')
+        parser.add_argument(
+            '--output', default='.',
+            help='The directory to write the exported files to')
+        parser.add_argument(
+            '--partition', choices=['none', 'user', 'month'], default='none',
+            help='Write one file per user or per month')
+        parser.add_argument(
+            '--user', action='append', type=int, dest='users',
+            help='Only export data of the user with this primary key')
+        parser.add_argument(
+            '--resource', action='append', dest='resources',
+            help='Only export this time series resource, eg activities/steps')
+        parser.add_argument(
+            '--base-date', dest='base_date',
+            help='Only export data on or after this date (yyyy-mm-dd)')
+        parser.add_argument(
+            '--end-date', dest='end_date',
+            help='Only export data on or before this date (yyyy-mm-dd)')
+        parser.add_argument(
+            '--intraday', choices=['include', 'only', 'exclude'],
+            default='include', help='Whether to export intraday data')
+        parser.add_argument(
+            '--chunk-size', type=int, dest='chunk_size', default=2000,
+            help='The number of rows to read from the database at a time')
+
+    def handle(self, *args, **options):
+        data_set = DATA_SETS[options['data']]
+        writer_class = WRITERS[options['format']]
+        queryset = self.get_queryset(data_set, options)
+
+        if not os.path.isdir(options['output']):
+            os.makedirs(options['output'])
+
+        paths = dict((_type.pk, _type.path())
+                     for _type in TimeSeriesDataType.objects.all())
+
+        start = time.time()
+        total = 0
+        for name, partition in self.get_partitions(
+                queryset, data_set, options['partition']):
+            filename = options['data']
+            if name:
+                filename = '{}-{}'.format(filename, name)
+            path = os.path.join(options['output'], '{}.{}'.format(
+                filename, writer_class.extension))
+            writer = writer_class(path, data_set)
+            count = 0
+            try:
+                for rows in iter_chunks(partition, data_set['fields'],
+                                        options['chunk_size']):
+                    if options['data'] == 'timeseries':
+                        rows = [(row[0], paths[row[1]]) + row[2:]
+                                for row in rows]
+                    writer.write(rows)
+                    count += len(rows)
+            finally:
+                writer.close()
+            total += count
+            self.stdout.write('Wrote {} rows to {}'.format(count, path))
+
+        elapsed = max(time.time() - start, 0.001)
+        msg = 'Exported {} rows in {:.2f} seconds ({:.0f} rows/second)'.format(
+            total, elapsed, total / elapsed)
+        # Django 1.8 doesn't have the SUCCESS style, fallback to WARNING
+        success_style = getattr(self.style, 'SUCCESS', self.style.WARNING)
+        self.stdout.write(success_style(msg))
+
+    def get_queryset(self, data_set, options):
+        queryset = data_set['model'].objects.all()
+        date_field = data_set['date']
+        if options['users']:
+            queryset = queryset.filter(
+                **{data_set['user'] + '__in': options['users']})
+        try:
+            if options['base_date']:
+                base_date = datetime.strptime(options['base_date'], '%Y-%m-%d')
+                queryset = queryset.filter(
+                    **{date_field + '__gte': self.make_aware(base_date)})
+            if options['end_date']:
+                end_date = datetime.strptime(options['end_date'], '%Y-%m-%d')
+                queryset = queryset.filter(**{date_field + '__lt': (
+                    self.make_aware(end_date + timedelta(days=1)))})
+        except ValueError:
+            raise CommandError('Dates must be of the format yyyy-mm-dd')
+
+        if data_set['model'] is not TimeSeriesData:
+            if options['resources'] or options['intraday'] != 'include':
+                raise CommandError('--resource and --intraday can only be '
+                                   'used with time series data')
+            return queryset
+        if options['resources']:
+            resource_types = []
+            for path in options['resources']:
+                category, _, resource = path.partition('/')
+                try:
+                    resource_types.append(TimeSeriesDataType.objects.get(
+                        category=getattr(TimeSeriesDataType, category),
+                        resource=resource))
+                except (AttributeError, TimeSeriesDataType.DoesNotExist):
+                    raise CommandError('Invalid resource: {}'.format(path))
+            queryset = queryset.filter(resource_type__in=resource_types)
+        if options['intraday'] != 'include':
+            queryset = queryset.filter(
+                intraday=options['intraday'] == 'only')
+        return queryset
+
+    def get_partitions(self, queryset, data_set, partition):
+        """Yield the name and queryset of each file to write"""
+        if partition == 'user':
+            users = queryset.order_by(data_set['user']).values_list(
+                data_set['user'], flat=True).distinct()
+            for user in users:
+                yield 'user-{}'.format(user), queryset.filter(
+                    **{data_set['user']: user})
+        elif partition == 'month':
+            date_field = data_set['date']
+            months = queryset.annotate(
+                month=DateBucket(date_field, 'month')
+            ).order_by('month').values_list('month', flat=True).distinct()
+            for month in months:
+                start = self.make_aware(datetime(month.year, month.month, 1))
+                yield month.strftime('%Y-%m'), queryset.filter(**{
+                    date_field + '__gte': start,
+                    date_field + '__lt': start + relativedelta(months=1),
+                })
+        else:
+            yield None, queryset
+
+    def make_aware(self, date):
+        if settings.USE_TZ:
+            return timezone.make_aware(date, timezone.utc)
+        return date
@@ -0,0 +1,185 @@
+"""
+This django management command imports the data of a Fitbit account export
+archive, the zip file Fitbit users can download from their account settings,
+for a user that has already integrated their Fitbit account. A user's whole
+history can then be stored without making any API calls.
+
+The command takes the Fitbit user id of the user and the path to the archive::
+
+    python manage.py import_fitbit_export 2ABCDE fitbit_export.zip
+
+The daily files of the export hold a JSON list of data points. Minute by
+minute step and calorie data is stored as intraday data (when
+``FITAPP_GET_INTRADAY`` is ``True``) and totalled into daily data, the
+sedentary, lightly, moderately and very active minutes are stored as daily
+data and the sleep logs are stored as sleep stage time series data and sleep
+summaries. Other files are ignored.
+
+The timestamps of the minute by minute data are in UTC, so the
+``--utc-offset`` option should be given the user's offset from UTC in hours
+for the daily totals to match their days.
+
+Members of the archive are read and parsed one at a time by a pool of
+``--processes`` worker processes (the number of CPUs by default), while the
+parsed data is written to the database in bulk.
+"""
+
+import json
+import multiprocessing
+import re
+import time
+import zipfile
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.six.moves import map
+from django.utils.timezone import utc
+
+from fitapp import utils
+from fitapp.models import UserFitbit, TimeSeriesDataType
+
+
+# The time series files of the export, mapped to the category and resource of
+# the data they hold and whether it's minute by minute data
+TIME_SERIES_FILES = {
+    'steps': ('activities', 'steps', True),
+    'calories': ('activities', 'calories', True),
+    'sedentary_minutes': ('activities', 'minutesSedentary', False),
+    'lightly_active_minutes': ('activities', 'minutesLightlyActive', False),
+    'moderately_active_minutes': ('activities', 'minutesFairlyActive', False),
+    'very_active_minutes': ('activities', 'minutesVeryActive', False),
+}
+SLEEP_FILE = 'sleep'
+MEMBER_RE = re.compile(r'(?:^|/)(?P<name>[a-z_]+)-\d{4}-\d{2}-\d{2}\.json$')
+DATE_FORMAT = '%m/%d/%y %H:%M:%S'
+
+# The archive, opened once in each worker process
+_archive = None
+
+
+def open_archive(path):
+    global _archive
+    _archive = zipfile.ZipFile(path)
+
+
+def parse_member(member):
+    """
+    Read and parse a member of the archive, returning its file name and data.
+    The data of time series files is parsed into a list of ``(datetime,
+    value)`` tuples, the sleep logs of sleep files are returned as is.
+    """
+    name = MEMBER_RE.search(member).group('name')
+    data = json.loads(_archive.read(member).decode('utf8'))
+    if name == SLEEP_FILE:
+        return name, data
+    return name, [(datetime.strptime(datum['dateTime'], DATE_FORMAT),
+                   datum['value']) for datum in data]
+
+
+def format_total(total):
+    if total == int(total):
+        return str(int(total))
+    return '{:.2f}'.format(total)
+
+
+class Command(BaseCommand):
+    help = 'Imports the data of a Fitbit account export archive'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'fitbit_user', help='The Fitbit user id of the exported account')
+        parser.add_argument('archive', help='The path to the export zip file')
+        parser.add_argument(
+            '--utc-offset', type=float, dest='utc_offset', default=0,
+            help="The user's offset from UTC in hours")
+        parser.add_argument(
+            '--processes', type=int, default=None,
+            help='The number of processes to parse the archive with')
+
+    def handle(self, *args, **options):
+        try:
+            self.fbuser = UserFitbit.objects.get(
+                fitbit_user=options['fitbit_user'])
+        except UserFitbit.DoesNotExist:
+            raise CommandError('No Fitbit user with the id {}'.format(
+                options['fitbit_user']))
+        try:
+            with zipfile.ZipFile(options['archive']) as archive:
+                members = [
+                    member for member in archive.namelist()
+                    if self.is_imported(MEMBER_RE.search(member))]
+        except (IOError, zipfile.BadZipfile) as e:
+            raise CommandError('Invalid archive: {}'.format(e))
+
+        self.types = {}
+        for name, (category, resource, _) in TIME_SERIES_FILES.items():
+            self.types[name] = TimeSeriesDataType.objects.get(
+                category=getattr(TimeSeriesDataType, category),
+                resource=resource)
+        self.offset = timedelta(hours=options['utc_offset'])
+        self.totals = defaultdict(lambda: defaultdict(float))
+        self.counts = {'files': 0, 'values': 0, 'sleep_logs': 0}
+
+        start = time.time()
+        processes = options['processes'] or multiprocessing.cpu_count()
+        if processes > 1:
+            pool = multiprocessing.Pool(
+                processes, initializer=open_archive,
+                initargs=(options['archive'],))
+            try:
+                self.import_members(pool.imap(parse_member, members))
+            finally:
+                pool.terminate()
+        else:
+            open_archive(options['archive'])
+            self.import_members(map(parse_member, members))
+        # Minute by minute data can span more than one file per day, so the
+        # daily totals are written once every file has been read
+        for name, totals in self.totals.items():
+            self.save(name, [
+                (datetime(date.year, date.month, date.day), format_total(total))
+                for date, total in totals.items()])
+
+        msg = ('Imported {files} files with {values} time series values and '
+               '{sleep_logs} sleep logs').format(**self.counts)
+        msg += ' in {:.2f} seconds'.format(time.time() - start)
+        # Django 1.8 doesn't have the SUCCESS style, fallback to WARNING
+        success_style = getattr(self.style, 'SUCCESS', self.style.WARNING)
+        self.stdout.write(success_style(msg))
+
+    def is_imported(self, match):
+        return match and (match.group('name') in TIME_SERIES_FILES or
+                          match.group('name') == SLEEP_FILE)
+
+    def import_members(self, parsed):
+        save_intraday = utils.get_setting('FITAPP_GET_INTRADAY')
+        save_zeros = utils.get_setting('FITAPP_SAVE_INTRADAY_ZERO_VALUES')
+        for name, data in parsed:
+            self.counts['files'] += 1
+            if name == SLEEP_FILE:
+                self.save_sleep_logs(data)
+                continue
+            if not TIME_SERIES_FILES[name][2]:
+                self.save(name, data)
+                continue
+            for date, value in data:
+                local_date = (date + self.offset).date()
+                self.totals[name][local_date] += float(value)
+            if save_intraday and self.types[name].intraday_support:
+                self.save(name, [
+                    (date.replace(tzinfo=utc), value) for date, value in data
+                    if save_zeros or int(float(value)) != 0
+                ], intraday=True)
+
+    def save(self, name, data, intraday=False):
+        utils.save_time_series_data(
+            self.fbuser.user, self.types[name], data, intraday=intraday)
+        self.counts['values'] += len(data)
+
+    def save_sleep_logs(self, logs):
+        # Only logs with sleep stages have the data we store
+        logs = [log for log in logs if log.get('type') == 'stages']
+        utils.save_sleep_stages(self.fbuser.user, logs)
+        utils.save_sleep_summaries(self.fbuser.user, logs)
+        self.counts['sleep_logs'] += len(logs)
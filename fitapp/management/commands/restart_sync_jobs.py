@@ -0,0 +1,23 @@
+"""
+This django management command restarts the sync jobs of users whose sync
+lease has expired while they still have jobs queued, such as when a worker
+died in the middle of a job. It can be run from cron as an alternative to
+scheduling the ``fitapp.tasks.restart_sync_jobs`` task with celery beat.
+"""
+
+from django.core.management.base import BaseCommand
+
+from fitapp.utils import restart_sync_jobs
+
+
+class Command(BaseCommand):
+    help = """
+        Restarts the sync jobs of users whose sync lease has expired
+    """
+
+    def handle(self, *args, **options):
+        restarted = restart_sync_jobs()
+        msg = 'Restarted the sync jobs of {} users'.format(restarted)
+        # Django 1.8 doesn't have the SUCCESS style, fallback to WARNING
+        success_style = getattr(self.style, 'SUCCESS', self.style.WARNING)
+        self.stdout.write(success_style(msg))
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-19 05:07
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fitapp', '0016_auto_20180430_1118'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='timeseriesdata',
+            index_together=set([('user', 'resource_type', 'intraday', 'date', 'value')]),
+        ),
+    ]
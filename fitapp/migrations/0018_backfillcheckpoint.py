@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-19 05:19
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    UserModel = getattr(settings, 'FITAPP_USER_MODEL', 'auth.User')
+
+    dependencies = [
+        ('fitapp', '0017_timeseriesdata_read_index'),
+        migrations.swappable_dependency(UserModel),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BackfillCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resource', models.CharField(help_text="The data that was retrieved, 'sleep' for sleep logs or the path of a time series resource, eg 'activities/steps'", max_length=128)),
+                ('base_date', models.DateField(help_text='The first date of the window')),
+                ('end_date', models.DateField(help_text='The last date of the window')),
+                ('user', models.ForeignKey(help_text="The data's user", on_delete=django.db.models.deletion.CASCADE, to=UserModel)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='backfillcheckpoint',
+            unique_together=set([('user', 'resource', 'base_date', 'end_date')]),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-19 05:21
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fitapp', '0018_backfillcheckpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userfitbit',
+            name='last_sleep_log_id',
+            field=models.BigIntegerField(blank=True, help_text='The id of the newest sleep log that has been synced', null=True),
+        ),
+        migrations.AddField(
+            model_name='userfitbit',
+            name='last_sleep_start',
+            field=models.DateTimeField(blank=True, help_text='The start time of the newest sleep log that has been synced', null=True),
+        ),
+    ]
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-19 05:25
+from __future__ import unicode_literals
+
+import struct
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.db import migrations, models
+from django.utils import timezone
+import django.db.models.deletion
+
+# Copied from SleepHypnogram, since historical models don't have its methods
+LEVELS = ('wake', 'light', 'deep', 'rem', 'asleep', 'restless', 'awake')
+STAGE = struct.Struct('<IBI')
+# The most seconds between the stages of one sleep log
+LOG_GAP = 60
+
+
+def encode(stages):
+    """Copied from SleepHypnogram.encode, stages of unknown levels are skipped"""
+    stages = sorted(stage for stage in stages if stage[1] in LEVELS)
+    start = stages[0][0]
+    return start, b''.join(STAGE.pack(
+        int((date - start).total_seconds()), LEVELS.index(level), seconds)
+        for date, level, seconds in stages)
+
+
+def get_sleep_logs(rows):
+    """
+    Split the ``(user_id, date, level, seconds)`` sleep stage rows, ordered
+    by user and date, into the ``(user_id, stages)`` of each sleep log. The
+    stages of a sleep log follow on from each other, so a gap between stages
+    starts the next sleep log.
+    """
+    user_id = end = None
+    stages = []
+    for row in rows:
+        if stages and (row[0] != user_id or
+                       row[1] > end + timedelta(seconds=LOG_GAP)):
+            yield user_id, stages
+            stages = []
+        user_id, end = row[0], row[1] + timedelta(seconds=row[3])
+        stages.append(row[1:])
+    if stages:
+        yield user_id, stages
+
+
+def get_night(stages):
+    """
+    The date of the night of a sleep log's stages. The rows don't record the
+    ``dateOfSleep`` of their sleep log, which save_sleep_stages dates
+    hypnograms by, but Fitbit dates sleep logs by the day they end, so it's
+    the date the last stage ends on.
+    """
+    date, _, seconds = stages[-1]
+    end = date + timedelta(seconds=seconds)
+    if settings.USE_TZ:
+        end = timezone.localtime(end, timezone.get_default_timezone())
+    night = datetime.combine(end.date(), time())
+    if settings.USE_TZ:
+        night = timezone.make_aware(night, timezone.get_default_timezone())
+    return night
+
+
+def create_hypnograms(apps, schema_editor):
+    """
+    Create the sleep hypnogram of each night from the existing sleep stage
+    time series data. Naps are in the same night as the sleep log that ends
+    on the same date.
+    """
+    SleepStageTimeSeriesData = apps.get_model(
+        'fitapp', 'SleepStageTimeSeriesData')
+    SleepHypnogram = apps.get_model('fitapp', 'SleepHypnogram')
+
+    hypnograms = []
+    night = stages = None
+    rows = SleepStageTimeSeriesData.objects.order_by('user', 'date').values_list(
+        'user', 'date', 'level', 'seconds').iterator()
+    for user_id, log in get_sleep_logs(rows):
+        if (user_id, get_night(log)) != night:
+            if stages and any(stage[1] in LEVELS for stage in stages):
+                start, data = encode(stages)
+                hypnograms.append(SleepHypnogram(
+                    user_id=night[0], date=night[1], start=start, data=data))
+            night, stages = (user_id, get_night(log)), []
+        stages.extend(log)
+        if len(hypnograms) >= 500:
+            SleepHypnogram.objects.bulk_create(hypnograms)
+            hypnograms = []
+    if stages and any(stage[1] in LEVELS for stage in stages):
+        start, data = encode(stages)
+        hypnograms.append(SleepHypnogram(
+            user_id=night[0], date=night[1], start=start, data=data))
+    SleepHypnogram.objects.bulk_create(hypnograms)
+
+
+class Migration(migrations.Migration):
+
+    UserModel = getattr(settings, 'FITAPP_USER_MODEL', 'auth.User')
+
+    dependencies = [
+        ('fitapp', '0019_userfitbit_sleep_sync'),
+        migrations.swappable_dependency(UserModel),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SleepHypnogram',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateTimeField(help_text='The date of the night of sleep')),
+                ('start', models.DateTimeField(help_text='The date and time the first sleep stage started')),
+                ('data', models.BinaryField(help_text='The encoded sleep stages')),
+                ('user', models.ForeignKey(help_text="The data's user", on_delete=django.db.models.deletion.CASCADE, to=UserModel)),
+            ],
+            options={
+                'ordering': ['-date'],
+                'get_latest_by': 'date',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='sleephypnogram',
+            unique_together=set([('user', 'date')]),
+        ),
+        migrations.RunPython(create_hypnograms, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-19 05:30
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    UserModel = getattr(settings, 'FITAPP_USER_MODEL', 'auth.User')
+
+    dependencies = [
+        ('fitapp', '0020_sleephypnogram'),
+        migrations.swappable_dependency(UserModel),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncWatermark',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('intraday', models.BooleanField(default=False)),
+                ('date', models.DateField(help_text='The newest fully synced date')),
+                ('resource_type', models.ForeignKey(help_text='The type of time series data', on_delete=django.db.models.deletion.CASCADE, to='fitapp.TimeSeriesDataType')),
+                ('user', models.ForeignKey(help_text="The data's user", on_delete=django.db.models.deletion.CASCADE, to=UserModel)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='syncwatermark',
+            unique_together=set([('user', 'resource_type', 'intraday')]),
+        ),
+    ]
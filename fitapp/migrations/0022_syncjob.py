@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-19 05:36
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fitapp', '0021_syncwatermark'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fitbit_user', models.CharField(help_text='The Fitbit user ID of the job', max_length=32)),
+                ('task', models.CharField(help_text='The name of the Celery task to run', max_length=255)),
+                ('arguments', models.TextField(help_text='The JSON encoded positional and keyword arguments')),
+                ('lane', models.CharField(help_text='The lane of FITAPP_TASK_LANES of the job', max_length=32)),
+                ('priority', models.IntegerField(default=0, help_text='Jobs with a higher priority run first')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('started', models.DateTimeField(blank=True, help_text='When the job started running', null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SyncLease',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fitbit_user', models.CharField(help_text='The Fitbit user ID', max_length=32, unique=True)),
+                ('owner', models.CharField(help_text='The token of the task holding the lease', max_length=32)),
+                ('expires', models.DateTimeField(help_text='When the lease expires')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='syncjob',
+            index_together=set([('fitbit_user', 'priority')]),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-19 12:10
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fitapp', '0022_syncjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sleepstagesummary',
+            name='updated',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now, help_text='When the summary or the sleep stages of the night last changed'),
+            preserve_default=False,
+        ),
+    ]
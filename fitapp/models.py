@@ -1,11 +1,19 @@
 import logging
+import struct
 import uuid
 from base64 import urlsafe_b64encode
+from datetime import timedelta
 
 from django.conf import settings
 from django.db import models
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.db.models import Avg, Count, Max, Min, Sum
+from django.utils import six
 from django.utils.encoding import python_2_unicode_compatible
 
+from .expressions import DateBucket, EpochBucket, NumericValue
+
 logger = logging.getLogger(__name__)
 
 UserModel = getattr(settings, 'FITAPP_USER_MODEL', 'auth.User')
@@ -29,6 +37,13 @@ class UserFitbit(models.Model):
         help_text='The timestamp when the access token expires')
     # This url-safe uuid is to allow non-conflicting subscription ids
     uuid = models.CharField(max_length=32, default=None, null=True)
+    # Where the last incremental sync of the user's sleep logs stopped
+    last_sleep_log_id = models.BigIntegerField(
+        null=True, blank=True,
+        help_text='The id of the newest sleep log that has been synced')
+    last_sleep_start = models.DateTimeField(
+        null=True, blank=True,
+        help_text='The start time of the newest sleep log that has been synced')
 
     def __str__(self):
         return self.user.__str__()
@@ -130,6 +145,54 @@ class TimeSeriesDataType(models.Model):
         return '/'.join([self.get_category_display(), self.resource])
 
 
+class TimeSeriesDataQuerySet(models.QuerySet):
+    AGGREGATE_FUNCTIONS = {'sum': Sum, 'avg': Avg, 'min': Min, 'max': Max}
+
+    def _aggregate_by(self, bucket, function):
+        aggregate = self.AGGREGATE_FUNCTIONS[function]
+        return self.annotate(bucket=bucket).values('bucket').annotate(
+            aggregate=aggregate(NumericValue('value'))
+        ).order_by('bucket')
+
+    def daily_series(self):
+        """
+        The daily data as ``(date, value)`` tuples, ordered from oldest to
+        newest. Only the columns in the ``(user, resource_type, intraday,
+        date, value)`` index are read, so this is an index range scan.
+        """
+        return self.filter(intraday=False).order_by('date').values_list(
+            'date', 'value')
+
+    def intraday_buckets(self, seconds, function='sum'):
+        """
+        Aggregate intraday data into buckets of the given number of seconds
+        in the database. Each row is a dict of the start of the bucket
+        (*bucket*, in seconds since the epoch) and the *aggregate* of the
+        values within it, ordered from oldest to newest.
+
+        :param function: One of 'sum', 'avg', 'min' or 'max'.
+        """
+        return self.filter(intraday=True)._aggregate_by(
+            EpochBucket('date', seconds), function)
+
+    def daily_buckets(self, bucket, function='sum'):
+        """
+        Aggregate daily data by day, week, month or year with a single GROUP
+        BY query. Each row is a dict of the first date of the bucket
+        (*bucket*) and the *aggregate* of the values within it, ordered from
+        oldest to newest.
+
+        Fitbit's daily data is itself a rollup of the intraday data, so this
+        never needs to read any intraday data.
+
+        :param bucket: One of 'day', 'week' (starting on Monday), 'month' or
+            'year'.
+        :param function: One of 'sum', 'avg', 'min' or 'max'.
+        """
+        return self.filter(intraday=False)._aggregate_by(
+            DateBucket('date', bucket), function)
+
+
 class TimeSeriesData(models.Model):
     """
     The purpose of this model is to store Fitbit user data obtained from their
@@ -162,8 +225,14 @@ class TimeSeriesData(models.Model):
         ))
     intraday = models.BooleanField(default=False)
 
+    objects = TimeSeriesDataQuerySet.as_manager()
+
     class Meta:
         unique_together = ('user', 'resource_type', 'date', 'intraday')
+        # Matches how the data is read: by user, resource type and daily or
+        # intraday data over a range of dates. The value is included so the
+        # index covers those reads.
+        index_together = [('user', 'resource_type', 'intraday', 'date', 'value')]
         get_latest_by = 'date'
 
     def string_date(self):
@@ -202,6 +271,98 @@ class SleepStageTimeSeriesData(models.Model):
             )
 
 
+class SleepHypnogram(models.Model):
+    """
+    The sleep stages of a user's night of sleep, stored compactly in one row
+    per night rather than one SleepStageTimeSeriesData row per stage.
+
+    Each stage is encoded as its offset in seconds from the start of the
+    first stage, the code of its level (its index in ``LEVELS``) and its
+    length in seconds, packed into 9 bytes.
+    """
+    LEVELS = ('wake', 'light', 'deep', 'rem', 'asleep', 'restless', 'awake')
+    STAGE = struct.Struct('<IBI')
+
+    user = models.ForeignKey(UserModel, help_text="The data's user")
+    date = models.DateTimeField(help_text='The date of the night of sleep')
+    start = models.DateTimeField(
+        help_text='The date and time the first sleep stage started')
+    data = models.BinaryField(help_text='The encoded sleep stages')
+
+    class Meta:
+        unique_together = ('user', 'date')
+        ordering = ['-date']
+        get_latest_by = 'date'
+
+    @classmethod
+    def encode(cls, stages):
+        """
+        Encode a list of ``(date, level, seconds)`` sleep stages, returning
+        the start of the first stage and the encoded data. Stages of levels
+        that aren't in ``LEVELS`` are skipped, there must be at least one
+        other stage.
+        """
+        stages = sorted(stage for stage in stages if stage[1] in cls.LEVELS)
+        start = stages[0][0]
+        return start, b''.join(cls.STAGE.pack(
+            int((date - start).total_seconds()), cls.LEVELS.index(level),
+            seconds) for date, level, seconds in stages)
+
+    def decode(self):
+        """
+        The sleep stages, from oldest to newest, as unsaved
+        SleepStageTimeSeriesData instances.
+        """
+        data = six.binary_type(self.data)
+        stages = []
+        for i in range(0, len(data), self.STAGE.size):
+            offset, level, seconds = self.STAGE.unpack_from(data, i)
+            stages.append(SleepStageTimeSeriesData(
+                user_id=self.user_id, level=self.LEVELS[level],
+                date=self.start + timedelta(seconds=offset), seconds=seconds))
+        return stages
+
+
+class SleepStageSummaryQuerySet(models.QuerySet):
+    def with_levels(self):
+        """
+        Prefetch the summary of each sleep level, so that
+        ``get_summary_data`` of every sleep summary is read in one query.
+        """
+        return self.prefetch_related('sleeptypedata_set')
+
+    def nights(self, stages=False):
+        """
+        A list of the sleep summaries, from oldest to newest, with the
+        summary of each sleep level prefetched.
+
+        With *stages*, the sleep hypnograms of the nights are read in one more
+        query and the stages of each night are set as the ``stages`` list of
+        its sleep summary, from oldest to newest.
+        """
+        summaries = list(self.with_levels().order_by('date'))
+        if not stages or not summaries:
+            return summaries
+        hypnograms = dict(
+            ((hypnogram.user_id, hypnogram.date), hypnogram)
+            for hypnogram in SleepHypnogram.objects.filter(
+                user__in=set(summary.user_id for summary in summaries),
+                date__in=set(summary.date for summary in summaries)))
+        for summary in summaries:
+            hypnogram = hypnograms.get((summary.user_id, summary.date))
+            summary.stages = hypnogram.decode() if hypnogram else []
+        return summaries
+
+    def version(self):
+        """
+        The number of sleep summaries and when the newest change to any of
+        them or their sleep stages was, read with one aggregate query, to
+        tell cheaply whether the nights have changed.
+        """
+        result = self.aggregate(count=Count('pk'), updated=Max('updated'))
+        return result['count'], result['updated']
+
+
 class SleepStageSummary(models.Model):
     """
     This model is intended to store the summary of sleep stage logs.
@@ -212,6 +373,11 @@ class SleepStageSummary(models.Model):
     """
     user = models.ForeignKey(UserModel, help_text="The data's user")
     date = models.DateTimeField(help_text='The date the data was recorded')
+    updated = models.DateTimeField(
+        auto_now=True, help_text=(
+            'When the summary or the sleep stages of the night last changed'))
+
+    objects = SleepStageSummaryQuerySet.as_manager()
 
     class Meta:
         ordering = ['-date']
@@ -223,7 +389,8 @@ class SleepStageSummary(models.Model):
 
     @property
     def get_summary_data(self):
-        return list(SleepTypeData.objects.filter(sleep_summary=self))
+        # Uses the prefetched data of SleepStageSummaryQuerySet.with_levels
+        return list(self.sleeptypedata_set.all())
 
 
 class SleepTypeData(models.Model):
@@ -248,3 +415,107 @@ class SleepTypeData(models.Model):
             user=self.sleep_summary.user,
             level=self.level, year=self.sleep_summary.date.year,
             month=self.sleep_summary.date.month, day=self.sleep_summary.date.day)
+
+
+@python_2_unicode_compatible
+class BackfillCheckpoint(models.Model):
+    """
+    A window of dates of a user's data that has been retrieved from the Fitbit
+    API and saved, so that an interrupted backfill can resume where it
+    stopped instead of retrieving the same data again.
+    """
+    user = models.ForeignKey(UserModel, help_text="The data's user")
+    resource = models.CharField(
+        max_length=128,
+        help_text=(
+            "The data that was retrieved, 'sleep' for sleep logs or the path "
+            "of a time series resource, eg 'activities/steps'"
+        ))
+    base_date = models.DateField(help_text='The first date of the window')
+    end_date = models.DateField(help_text='The last date of the window')
+
+    class Meta:
+        unique_together = ('user', 'resource', 'base_date', 'end_date')
+
+    def __str__(self):
+        return '{user} {resource} from {base_date} to {end_date}'.format(
+            user=self.user, resource=self.resource, base_date=self.base_date,
+            end_date=self.end_date)
+
+
+@python_2_unicode_compatible
+class SyncWatermark(models.Model):
+    """
+    The newest date of a user's time series data that has been fully synced,
+    so that routine syncs only retrieve the data that's newer.
+    """
+    user = models.ForeignKey(UserModel, help_text="The data's user")
+    resource_type = models.ForeignKey(
+        TimeSeriesDataType, help_text='The type of time series data')
+    intraday = models.BooleanField(default=False)
+    date = models.DateField(help_text='The newest fully synced date')
+
+    class Meta:
+        unique_together = ('user', 'resource_type', 'intraday')
+
+    def __str__(self):
+        return '{user} {resource_type}{intraday} synced to {date}'.format(
+            user=self.user, resource_type=self.resource_type.path(),
+            intraday=' intraday' if self.intraday else '', date=self.date)
+
+
+@python_2_unicode_compatible
+class SyncJob(models.Model):
+    """
+    A queued fitapp task that syncs a user's data. Each user's jobs are run
+    one at a time, in turn with the jobs of other users, by the
+    ``run_sync_jobs`` task.
+    """
+    fitbit_user = models.CharField(
+        max_length=32, help_text='The Fitbit user ID of the job')
+    task = models.CharField(
+        max_length=255, help_text='The name of the Celery task to run')
+    arguments = models.TextField(
+        help_text="The JSON encoded positional and keyword arguments")
+    lane = models.CharField(
+        max_length=32, help_text='The lane of FITAPP_TASK_LANES of the job')
+    priority = models.IntegerField(
+        default=0, help_text="Jobs with a higher priority run first")
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(
+        null=True, blank=True, help_text='When the job started running')
+
+    class Meta:
+        index_together = [('fitbit_user', 'priority')]
+
+    def __str__(self):
+        return '{task} for {fitbit_user}'.format(
+            task=self.task, fitbit_user=self.fitbit_user)
+
+
+@python_2_unicode_compatible
+class SyncLease(models.Model):
+    """
+    Held while a user's sync jobs are being run, so that only one task runs
+    them at a time. The task that holds the lease renews it before and
+    during each job, so a lease that has expired was held by a task that
+    died, and can be taken over.
+    """
+    fitbit_user = models.CharField(
+        max_length=32, unique=True, help_text='The Fitbit user ID')
+    owner = models.CharField(
+        max_length=32, help_text='The token of the task holding the lease')
+    expires = models.DateTimeField(help_text='When the lease expires')
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return 'Sync lease of {}'.format(self.fitbit_user)
+
+
+@receiver(post_save, sender=UserFitbit)
+@receiver(post_delete, sender=UserFitbit)
+def clear_integration_cache(sender, instance, **kwargs):
+    """ Forget the cached integration status of the user of a UserFitbit """
+    from .utils import clear_integration_cache
+
+    clear_integration_cache(instance.user_id)
@@ -1,12 +1,12 @@
-from datetime import timedelta
+from datetime import date, timedelta
 import logging
 import random
 import sys
 
-from celery import shared_task
+from celery import current_app, shared_task
 from celery.exceptions import Ignore, Reject
 from dateutil import parser
-from django.core.cache import cache
+from django.utils import timezone
 from django.utils.timezone import utc
 from django.db import transaction
 from fitbit.exceptions import HTTPBadRequest, HTTPTooManyRequests, HTTPUnauthorized
@@ -16,7 +16,6 @@ from .models import UserFitbit, TimeSeriesData, TimeSeriesDataType
 
 
 logger = logging.getLogger(__name__)
-LOCK_EXPIRE = 60 * 5  # Lock expires in 5 minutes
 
 
 @shared_task
@@ -77,50 +76,54 @@ def get_time_series_data(self, fitbit_user, cat, resource, date=None):
             resource, cat))
         raise Reject(e, requeue=False)
 
-    # Create a lock so we don't try to run the same task multiple times
-    sdat = date.strftime('%Y-%m-%d') if date else 'ALL'
-    lock_id = '{0}-lock-{1}-{2}-{3}'.format(__name__, fitbit_user, _type, sdat)
-    if not cache.add(lock_id, 'true', LOCK_EXPIRE):
-        logger.debug('Already retrieving %s data for date %s, user %s' % (
-            _type, fitbit_user, sdat))
-        raise Ignore()
-
+    # The task runs as a sync job of the user, so it doesn't run at the same
+    # time as their other syncs (see utils.queue_sync_job)
     try:
         fbusers = UserFitbit.objects.filter(
             fitbit_user=fitbit_user)
-        default_period = utils.get_setting('FITAPP_DEFAULT_PERIOD')
-        if default_period:
-            dates = {'base_date': 'today', 'period':default_period}
-        else:
-            dates = {'base_date': 'today', 'period': 'max'}
-        if date:
-            dates = {'base_date': date, 'end_date': date}
+        get_intraday = utils.get_setting('FITAPP_GET_INTRADAY')
+        overlap = timedelta(days=utils.get_setting('FITAPP_SYNC_OVERLAP_DAYS'))
         for fbuser in fbusers:
+            if date:
+                dates = {'base_date': date, 'end_date': date}
+            else:
+                # Only retrieve the data that's newer than the last sync
+                dates = utils.get_sync_dates(fbuser.user, _type)
             data = utils.get_fitbit_data(fbuser, _type, **dates)
-            if utils.get_setting('FITAPP_GET_INTRADAY'):
+            if get_intraday and _type.intraday_support:
                 tz_offset = utils.get_fitbit_profile(fbuser,
                                                      'offsetFromUTCMillis')
                 tz_offset = tz_offset / 3600 / 1000 * -1  # Converted to positive hours
+                intraday_types = TimeSeriesDataType.objects.filter(
+                    intraday_support=True)
+                watermarks = dict(
+                    (intraday_type.pk, utils.get_sync_watermark(
+                        fbuser.user, intraday_type, intraday=True))
+                    for intraday_type in intraday_types)
+            newest = None
             for datum in data:
                 # Create new record or update existing record
-                date = parser.parse(datum['dateTime'])
-                if _type.intraday_support and \
-                        utils.get_setting('FITAPP_GET_INTRADAY'):
-                    resources = TimeSeriesDataType.objects.filter(
-                        intraday_support=True)
-                    for i, _type in enumerate(resources):
-                        # Offset each call by 2 seconds so they don't bog down
-                        # the server
-                        get_intraday_data(
-                            fbuser.fitbit_user, _type.category,
-                            _type.resource, date, tz_offset)
+                datum_date = parser.parse(datum['dateTime'])
+                if get_intraday and _type.intraday_support:
+                    for intraday_type in intraday_types:
+                        # Skip the days whose intraday data is already synced
+                        watermark = watermarks[intraday_type.pk]
+                        if not date and watermark and \
+                                datum_date.date() < watermark - overlap:
+                            continue
+                        utils.queue_sync_job(
+                            fbuser.fitbit_user, get_intraday_data,
+                            (fbuser.fitbit_user, intraday_type.category,
+                             intraday_type.resource, datum_date, tz_offset),
+                            lane='intraday')
                 tsd, created = TimeSeriesData.objects.get_or_create(
-                    user=fbuser.user, resource_type=_type, date=date,
+                    user=fbuser.user, resource_type=_type, date=datum_date,
                     intraday=False)
                 tsd.value = datum['value']
                 tsd.save()
-        # Release the lock
-        cache.delete(lock_id)
+                newest = max(newest or datum_date, datum_date)
+            if not date and newest is not None:
+                utils.update_sync_watermark(fbuser.user, _type, newest.date())
     except HTTPTooManyRequests as e:
         # We have hit the rate limit for the user, retry when it's reset,
         # according to the reply from the failing API call
@@ -145,6 +148,77 @@ def get_time_series_data(self, fitbit_user, cat, resource, date=None):
         raise Reject(exc, requeue=False)
 
 
+@shared_task(bind=True)
+def backfill_time_series_data(self, fitbit_user, cat, resource,
+                              start_date=None):
+    """
+    Get the user's history of time series data one window at a time.
+
+    The first run gets the user's ``FITAPP_BACKFILL_RECENT_DAYS`` most recent
+    days, so their current data is available right away. Each later run
+    walks back through the history, saving a window with a checkpoint before
+    the task queues itself for the next one in the 'backfill' lane of
+    ``FITAPP_TASK_LANES``, so a failed backfill resumes from
+    the newest window that wasn't saved. ``start_date`` (yyyy-mm-dd) is the
+    first date of the history, it's found from the user's profile on the
+    first run.
+    """
+    try:
+        _type = TimeSeriesDataType.objects.get(category=cat, resource=resource)
+    except TimeSeriesDataType.DoesNotExist as e:
+        logger.exception("The resource %s in category %s doesn't exist" % (
+            resource, cat))
+        raise Reject(e, requeue=False)
+
+    fbusers = UserFitbit.objects.filter(fitbit_user=fitbit_user)
+    try:
+        for fbuser in fbusers:
+            end_date = date.today()
+            recent_start = end_date - timedelta(
+                days=utils.get_setting('FITAPP_BACKFILL_RECENT_DAYS') - 1)
+            if start_date is None:
+                start = utils.get_backfill_start(fbuser, end_date)
+                windows = [(max(start, recent_start), end_date)]
+            else:
+                start = parser.parse(start_date).date()
+                windows = []
+            windows += utils.get_backfill_windows(
+                fbuser, _type, start, recent_start - timedelta(days=1))
+            if not windows:
+                continue
+            utils.backfill_time_series_window(fbuser, _type, *windows[0])
+            if len(windows) > 1:
+                utils.queue_sync_job(
+                    fitbit_user, backfill_time_series_data,
+                    (fitbit_user, cat, resource, start.strftime('%Y-%m-%d')),
+                    lane='backfill')
+    except HTTPTooManyRequests as e:
+        # We have hit the rate limit for the user, retry when it's reset,
+        # according to the reply from the failing API call
+        countdown = e.retry_after_secs + int(
+            # Add exponential back-off + random jitter
+            random.uniform(2, 4) ** self.request.retries
+        )
+        logger.debug('Rate limit reached, will try again in {} seconds'.format(
+            countdown))
+        raise backfill_time_series_data.retry(exc=e, countdown=countdown)
+    except HTTPBadRequest as e:
+        # If the resource is elevation or floors, we are just getting this
+        # error because the data doesn't exist for this user, so we can ignore
+        # the error
+        if not ('elevation' in resource or 'floors' in resource):
+            exc = sys.exc_info()[1]
+            logger.exception("Exception backfilling data for user %s: %s" % (
+                fitbit_user, exc))
+            raise Reject(exc, requeue=False)
+    except Exception:
+        exc = sys.exc_info()[1]
+        logger.exception("Exception backfilling data for user %s: %s" % (
+            fitbit_user, exc))
+        raise Reject(exc, requeue=False)
+
+
+@shared_task
 def get_intraday_data(fitbit_user, cat, resource, date, tz_offset):
     """
     Get the user's intraday data for a specified date, convert to UTC prior to
@@ -197,7 +271,8 @@ def get_intraday_data(fitbit_user, cat, resource, date, tz_offset):
                         intraday=True)
                     tsd.value = value
                     tsd.save()
-            # Release the lock
+                utils.update_sync_watermark(
+                    fbuser.user, _type, date.date(), intraday=True)
     except HTTPTooManyRequests:
         # We have hit the rate limit for the user, retry when it's reset,
         # according to the reply from the failing API call
@@ -217,3 +292,130 @@ def get_intraday_data(fitbit_user, cat, resource, date, tz_offset):
         exc = sys.exc_info()[1]
         logger.exception("Exception updating data for user %s: %s" % (fitbit_user, exc))
         raise Reject(exc, requeue=False)
+
+
+@shared_task(bind=True)
+def get_sleep_log(self, fitbit_user, date):
+    """ Get the user's sleep stages and sleep summary for a date """
+    fbusers = UserFitbit.objects.filter(fitbit_user=fitbit_user)
+    try:
+        for fbuser in fbusers:
+            utils.get_fitbit_sleep_log(fbuser, date)
+    except HTTPTooManyRequests as e:
+        # We have hit the rate limit for the user, retry when it's reset,
+        # according to the reply from the failing API call
+        countdown = e.retry_after_secs + int(
+            # Add exponential back-off + random jitter
+            random.uniform(2, 4) ** self.request.retries
+        )
+        logger.debug('Rate limit reached, will try again in {} seconds'.format(
+            countdown))
+        raise get_sleep_log.retry(exc=e, countdown=countdown)
+    except Exception:
+        exc = sys.exc_info()[1]
+        logger.exception("Exception getting sleep log for user %s: %s" % (
+            fitbit_user, exc))
+        raise Reject(exc, requeue=False)
+
+
+@shared_task(bind=True)
+def update_fitbit_profile(self, fitbit_user):
+    """ Get the user's profile into the profile cache """
+    fbusers = UserFitbit.objects.filter(fitbit_user=fitbit_user)
+    try:
+        for fbuser in fbusers:
+            utils.get_fitbit_profile(fbuser)
+    except HTTPTooManyRequests as e:
+        # We have hit the rate limit for the user, retry when it's reset,
+        # according to the reply from the failing API call
+        countdown = e.retry_after_secs + int(
+            # Add exponential back-off + random jitter
+            random.uniform(2, 4) ** self.request.retries
+        )
+        logger.debug('Rate limit reached, will try again in {} seconds'.format(
+            countdown))
+        raise update_fitbit_profile.retry(exc=e, countdown=countdown)
+    except Exception:
+        exc = sys.exc_info()[1]
+        logger.exception("Exception getting profile for user %s: %s" % (
+            fitbit_user, exc))
+        raise Reject(exc, requeue=False)
+
+
+@shared_task(bind=True)
+def sync_sleep_logs(self, fitbit_user):
+    """ Get the sleep logs the user has logged since the last sync """
+    fbusers = UserFitbit.objects.filter(fitbit_user=fitbit_user)
+    try:
+        for fbuser in fbusers:
+            utils.sync_sleep_logs(fbuser)
+    except HTTPTooManyRequests as e:
+        # We have hit the rate limit for the user, retry when it's reset,
+        # according to the reply from the failing API call
+        countdown = e.retry_after_secs + int(
+            # Add exponential back-off + random jitter
+            random.uniform(2, 4) ** self.request.retries
+        )
+        logger.debug('Rate limit reached, will try again in {} seconds'.format(
+            countdown))
+        raise sync_sleep_logs.retry(exc=e, countdown=countdown)
+    except Exception:
+        exc = sys.exc_info()[1]
+        logger.exception("Exception syncing sleep logs for user %s: %s" % (
+            fitbit_user, exc))
+        raise Reject(exc, requeue=False)
+
+
+@shared_task
+def run_sync_jobs(fitbit_user, owner):
+    """
+    Run the user's next sync job, then send this task again for the job
+    after it, so it waits behind the jobs of other users. ``owner`` is the
+    token of the user's SyncLease, which is renewed before and during each
+    job.
+    """
+    if not utils.renew_sync_lease(fitbit_user, owner):
+        # Another task has taken over the user's jobs
+        logger.debug('Lost the sync lease of user %s' % fitbit_user)
+        return
+    countdown = None
+    job = utils.get_next_sync_job(fitbit_user)
+    try:
+        if job is not None:
+            job.started = timezone.now()
+            job.save(update_fields=['started'])
+            args, kwargs = utils.decode_sync_arguments(job.arguments)
+            with utils.sync_lease_heartbeat(fitbit_user, owner):
+                current_app.tasks[job.task](*args, **kwargs)
+            job.delete()
+    except HTTPTooManyRequests as e:
+        # Keep the job and run it again when the user's rate limit resets
+        job.started = None
+        job.save(update_fields=['started'])
+        countdown = e.retry_after_secs + int(random.uniform(2, 4))
+        logger.debug('Rate limit reached, will try again in {} seconds'.format(
+            countdown))
+    except (Ignore, Reject):
+        # The task has logged why it stopped
+        job.delete()
+    except Exception:
+        exc = sys.exc_info()[1]
+        logger.exception("Exception running %s for user %s: %s" % (
+            job.task, fitbit_user, exc))
+        job.delete()
+    finally:
+        # Release the lease if this was the last job, even if the job raised
+        # something not caught above
+        utils.continue_sync_jobs(fitbit_user, owner, countdown=countdown)
+
+
+@shared_task
+def restart_sync_jobs():
+    """
+    Restart the sync jobs of users whose SyncLease has expired while they
+    still have jobs queued. Schedule this to run periodically, every
+    ``FITAPP_SYNC_LEASE_SECONDS`` or so.
+    """
+    restarted = utils.restart_sync_jobs()
+    if restarted:
+        logger.debug('Restarted the sync jobs of %s users' % restarted)
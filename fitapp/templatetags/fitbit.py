@@ -17,5 +17,8 @@ def is_integrated_with_fitbit(user):
         {% else %}
             do something else
         {% endif %}
+
+    To use the filter for a list of users without a query for each one,
+    annotate them with :py:func:`fitapp.utils.annotate_integrated`.
     """
     return utils.is_integrated(user)
@@ -11,6 +11,7 @@ except:
     from string import letters as ascii_letters
 
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.test import TestCase
 
@@ -59,6 +60,8 @@ class FitappTestBase(TestCase):
     TEST_SERVER = 'http://testserver'
 
     def setUp(self):
+        # Cached data isn't rolled back with the database between tests
+        cache.clear()
         self.username = self.random_string(25)
         self.password = self.random_string(25)
         self.login_user = self.create_user(username=self.username,
@@ -1,14 +1,22 @@
 import json
+import os
 import requests_mock
+import shutil
+import tempfile
 import time
+import zipfile
+from datetime import datetime
 
 from django.core import management
+from django.core.management.base import CommandError
 from django.utils.six import StringIO
 from fitbit.api import FitbitOauth2Client
 from mock import patch
 from requests_oauthlib import OAuth2Session
 
-from fitapp.models import UserFitbit
+from fitapp.models import (UserFitbit, TimeSeriesData, TimeSeriesDataType,
+                           SleepStageTimeSeriesData, SleepStageSummary,
+                           SleepTypeData, SyncJob, SyncLease)
 from fitapp.management.commands import refresh_tokens
 
 from .base import FitappTestBase
@@ -78,3 +86,231 @@ class TestCommands(FitappTestBase):
         self.assertIn('Failed to refresh 1 tokens', out.getvalue())
         self.assertIn('Deauthenticated 1 users', out.getvalue())
         self.assertEqual(0, UserFitbit.objects.count())
+
+    @patch('fitapp.tasks.run_sync_jobs.apply_async')
+    def test_restart_sync_jobs_command(self, apply_async):
+        """Test the restart_sync_jobs command."""
+
+        SyncJob.objects.create(
+            fitbit_user=self.fbuser.fitbit_user,
+            task='fitapp.tasks.get_sleep_log', arguments='[[], {}]',
+            lane='realtime', priority=9)
+        out = StringIO()
+        management.call_command('restart_sync_jobs', stdout=out)
+
+        self.assertIn('Restarted the sync jobs of 1 users', out.getvalue())
+        self.assertEqual(apply_async.call_count, 1)
+        self.assertEqual(SyncLease.objects.count(), 1)
+
+        out = StringIO()
+        management.call_command('restart_sync_jobs', stdout=out)
+
+        self.assertIn('Restarted the sync jobs of 0 users', out.getvalue())
+
+
+class TestExportCommand(FitappTestBase):
+    """Tests for the export_fitbit_data command."""
+
+    def setUp(self):
+        super(TestExportCommand, self).setUp()
+        self.output = tempfile.mkdtemp()
+        self.steps = TimeSeriesDataType.objects.get(
+            category=TimeSeriesDataType.activities, resource='steps')
+        self.other_user = self.create_user()
+        for user in (self.user, self.other_user):
+            for date in ('2017-01-30', '2017-01-31', '2017-02-01'):
+                TimeSeriesData.objects.create(
+                    user=user, resource_type=self.steps, date=date,
+                    value='10')
+        TimeSeriesData.objects.create(
+            user=self.user, resource_type=self.steps,
+            date='2017-01-31 10:15:00', value='5', intraday=True)
+        summary = SleepStageSummary.objects.create(
+            user=self.user, date='2017-01-31')
+        SleepTypeData.objects.create(
+            sleep_summary=summary, level='deep', count=3, minute=70)
+
+    def tearDown(self):
+        shutil.rmtree(self.output)
+        super(TestExportCommand, self).tearDown()
+
+    def _export(self, **kwargs):
+        out = StringIO()
+        management.call_command('export_fitbit_data', output=self.output,
+                                stdout=out, **kwargs)
+        return out.getvalue()
+
+    def _read(self, filename):
+        with open(os.path.join(self.output, filename)) as f:
+            return f.read().splitlines()
+
+    def test_export_csv(self):
+        """All time series data is exported, a chunk at a time"""
+        out = self._export(chunk_size=2)
+        self.assertIn('Wrote 7 rows', out)
+        self.assertIn('Exported 7 rows', out)
+        self.assertIn('rows/second', out)
+        lines = self._read('timeseries.csv')
+        self.assertEqual(lines[0], 'user,resource,date,value,intraday')
+        self.assertEqual(len(lines), 8)
+        self.assertIn('{},activities/steps,2017-01-31T10:15:00,5,True'.format(
+            self.user.pk), lines)
+
+    def test_export_filters(self):
+        """The exported data can be filtered"""
+        self._export(users=[self.user.pk], base_date='2017-01-31',
+                     end_date='2017-01-31', intraday='exclude',
+                     resources=['activities/steps'])
+        self.assertEqual(self._read('timeseries.csv')[1:], [
+            '{},activities/steps,2017-01-31T00:00:00,10,False'.format(
+                self.user.pk)])
+        self._export(resources=['activities/distance'])
+        self.assertEqual(len(self._read('timeseries.csv')), 1)
+
+    def test_export_partitions(self):
+        """One file is written per user or month"""
+        self._export(partition='user', intraday='only')
+        self.assertEqual(os.listdir(self.output), [
+            'timeseries-user-{}.csv'.format(self.user.pk)])
+        self._export(partition='month', intraday='exclude')
+        self.assertEqual(len(self._read('timeseries-2017-01.csv')), 5)
+        self.assertEqual(len(self._read('timeseries-2017-02.csv')), 3)
+
+    def test_export_sleep_json(self):
+        """Sleep data can be exported as newline-delimited JSON"""
+        self._export(data='sleep_summaries', format='json')
+        lines = self._read('sleep_summaries.jsonl')
+        self.assertEqual([json.loads(line) for line in lines], [{
+            'user': self.user.pk, 'date': '2017-01-31T00:00:00',
+            'level': 'deep', 'count': 3, 'minutes': 70,
+        }])
+
+    def test_export_errors(self):
+        """Invalid options raise a CommandError"""
+        for kwargs in ({'resources': ['activities/bogus']},
+                       {'base_date': 'bad'},
+                       {'data': 'sleep_stages', 'intraday': 'only'}):
+            self.assertRaises(CommandError, self._export, **kwargs)
+
+    def test_export_arrow_requires_pyarrow(self):
+        """The Parquet and Arrow formats need the optional pyarrow package"""
+        try:
+            import pyarrow
+        except ImportError:
+            self.assertRaises(CommandError, self._export, format='parquet')
+            self.assertRaises(CommandError, self._export, format='arrow')
+        else:
+            self._export(format='parquet')
+            self.assertTrue(os.path.exists(
+                os.path.join(self.output, 'timeseries.parquet')))
+
+
+class TestImportCommand(FitappTestBase):
+    """Tests for the import_fitbit_export command."""
+
+    def setUp(self):
+        super(TestImportCommand, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.archive = os.path.join(self.directory, 'export.zip')
+        prefix = 'User/user-site-export/'
+        files = {
+            'steps-2017-01-31.json': [
+                {'dateTime': '01/31/17 22:00:00', 'value': '10'},
+                {'dateTime': '01/31/17 23:00:00', 'value': '0'},
+                {'dateTime': '02/01/17 01:00:00', 'value': '20'},
+            ],
+            'steps-2017-02-01.json': [
+                {'dateTime': '02/01/17 03:00:00', 'value': '5'},
+            ],
+            'very_active_minutes-2017-01-31.json': [
+                {'dateTime': '01/31/17 00:00:00', 'value': '12'},
+            ],
+            'heart_rate-2017-01-31.json': [
+                {'dateTime': '01/31/17 00:00:05',
+                 'value': {'bpm': 60, 'confidence': 2}},
+            ],
+            'sleep-2017-01-31.json': [{
+                'dateOfSleep': '2017-01-31',
+                'type': 'stages',
+                'levels': {
+                    'summary': dict((level, {'count': 1, 'minutes': 30})
+                                    for level in ('wake', 'rem', 'light',
+                                                  'deep')),
+                    'data': [
+                        {'dateTime': '2017-01-30T23:00:00.000',
+                         'level': 'light', 'seconds': 600},
+                        {'dateTime': '2017-01-30T23:10:00.000',
+                         'level': 'deep', 'seconds': 300},
+                    ],
+                },
+            }, {
+                'dateOfSleep': '2017-01-31',
+                'type': 'classic',
+                'levels': {'summary': {}, 'data': []},
+            }],
+        }
+        with zipfile.ZipFile(self.archive, 'w') as archive:
+            for name, data in files.items():
+                archive.writestr(prefix + name, json.dumps(data))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(TestImportCommand, self).tearDown()
+
+    def _import(self, **kwargs):
+        out = StringIO()
+        management.call_command(
+            'import_fitbit_export', self.fbuser.fitbit_user, self.archive,
+            stdout=out, **kwargs)
+        return out.getvalue()
+
+    def _values(self, resource, intraday):
+        return list(TimeSeriesData.objects.filter(
+            user=self.user, resource_type__resource=resource,
+            intraday=intraday,
+        ).order_by('date').values_list('date', 'value'))
+
+    def _assert_imported(self):
+        self.assertEqual(self._values('steps', False), [
+            (datetime(2017, 1, 31), '10'), (datetime(2017, 2, 1), '25')])
+        self.assertEqual(self._values('steps', True), [
+            (datetime(2017, 1, 31, 22), '10'),
+            (datetime(2017, 2, 1, 1), '20'),
+            (datetime(2017, 2, 1, 3), '5'),
+        ])
+        self.assertEqual(self._values('minutesVeryActive', False), [
+            (datetime(2017, 1, 31), '12')])
+        self.assertEqual(SleepStageTimeSeriesData.objects.filter(
+            user=self.user).count(), 2)
+        self.assertEqual(SleepTypeData.objects.filter(
+            sleep_summary__user=self.user).count(), 4)
+
+    def test_import(self):
+        """The data of an export archive is stored"""
+        out = self._import(processes=1)
+        self.assertIn('Imported 4 files with 6 time series values and 1 '
+                      'sleep logs', out)
+        self._assert_imported()
+
+        # Importing again doesn't duplicate any data
+        self._import(processes=1)
+        self._assert_imported()
+
+    def test_import_processes(self):
+        """The archive can be parsed by a pool of processes"""
+        self._import(processes=2)
+        self._assert_imported()
+
+    def test_import_utc_offset(self):
+        """Minute by minute data is totalled by the user's local days"""
+        self._import(processes=1, utc_offset=-2)
+        self.assertEqual(self._values('steps', False), [
+            (datetime(2017, 1, 31), '30'), (datetime(2017, 2, 1), '5')])
+
+    def test_import_errors(self):
+        """An unknown user or invalid archive raises a CommandError"""
+        self.assertRaises(CommandError, management.call_command,
+                          'import_fitbit_export', 'bogus', self.archive)
+        self.assertRaises(CommandError, management.call_command,
+                          'import_fitbit_export', self.fbuser.fitbit_user,
+                          os.path.join(self.directory, 'missing.zip'))
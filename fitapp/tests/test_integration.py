@@ -8,9 +8,11 @@ from datetime import datetime
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.http import HttpRequest
 from django.test.utils import override_settings
+from fitbit.api import Fitbit
 from fitbit.exceptions import HTTPConflict
 from freezegun import freeze_time
 from mock import patch
@@ -21,7 +23,9 @@ from test_models import TestUserModel
 from fitapp import utils
 from fitapp.decorators import fitbit_integration_warning
 from fitapp.models import UserFitbit, TimeSeriesDataType
-from fitapp.tasks import subscribe, unsubscribe
+from fitapp.tasks import (backfill_time_series_data, subscribe, unsubscribe,
+                          update_fitbit_profile)
+from fitapp.views import create_fitbit_session, normalize_date_range
 
 from .base import FitappTestBase
 
@@ -42,6 +46,101 @@ class TestIntegrationUtility(FitappTestBase):
         user = self.create_user()
         self.assertFalse(utils.is_integrated(user))
 
+    def test_is_integrated_cached(self):
+        """Integration status is cached until the UserFitbit changes"""
+        user_model = type(self.user)
+        with self.assertNumQueries(1):
+            self.assertTrue(utils.is_integrated(self.user))
+            # Remembered on the user
+            self.assertTrue(utils.is_integrated(self.user))
+        with self.assertNumQueries(0):
+            self.assertTrue(utils.is_integrated(user_model(pk=self.user.pk)))
+        self.fbuser.delete()
+        # Not remembered on the user anymore either
+        self.assertFalse(utils.is_integrated(self.user))
+        self.assertFalse(utils.is_integrated(user_model(pk=self.user.pk)))
+        self.create_userfitbit(user=self.user)
+        self.assertTrue(utils.is_integrated(user_model(pk=self.user.pk)))
+
+    def test_annotate_integrated(self):
+        """Users are annotated with their integration status in one query"""
+        other = self.create_user()
+        with self.assertNumQueries(1):
+            users = utils.annotate_integrated(type(self.user).objects.filter(
+                pk__in=[self.user.pk, other.pk]).order_by('pk'))
+            self.assertEqual(
+                [(user.pk, utils.is_integrated(user)) for user in users],
+                [(self.user.pk, True), (other.pk, False)])
+
+
+class TestFitbitProfile(FitappTestBase):
+    """Tests for the cache of users' Fitbit profiles."""
+
+    profile = {
+        'timezone': 'Pacific/Kiritimati',
+        'displayName': 'Name',
+        'memberSince': '2013-01-01',
+    }
+
+    def _cache_profile(self):
+        cache.set(utils.PROFILE_CACHE_KEY.format(self.user.pk), self.profile)
+
+    @patch.object(Fitbit, 'user_profile_get')
+    def test_update(self, user_profile_get):
+        """The profile task saves the user's profile in the cache"""
+        user_profile_get.return_value = {'user': self.profile}
+        self.assertEqual(utils.get_cached_profile(self.user), None)
+        update_fitbit_profile(self.fbuser.fitbit_user)
+        self.assertEqual(utils.get_cached_profile(self.user), self.profile)
+        self.assertEqual(
+            utils.get_cached_profile(self.user.pk, 'timezone'),
+            'Pacific/Kiritimati')
+
+    @patch('fitapp.tasks.update_fitbit_profile.apply_async')
+    def test_login(self, apply_async):
+        """Logging in updates the profile without waiting on Fitbit"""
+        self.user.is_authenticated = lambda: True
+        self.user.is_active = True
+        request = HttpRequest()
+        request.session = {}
+        create_fitbit_session(None, request, self.user)
+        self.assertEqual(request.session, {})
+        apply_async.assert_called_once_with(
+            (self.fbuser.fitbit_user,), priority=9)
+
+        # Only a few fields of a cached profile are kept in the session
+        self._cache_profile()
+        create_fitbit_session(None, request, self.user)
+        self.assertEqual(request.session, {'fitbit_profile': {
+            'timezone': 'Pacific/Kiritimati', 'displayName': 'Name'}})
+
+    @freeze_time('2014-06-30 12:00:00')
+    def test_normalize_date_range(self):
+        """Today is the date in the timezone of the cached profile"""
+        request = HttpRequest()
+        request.session = {}
+        request.user = AnonymousUser()
+        fitbit_data = {'base_date': 'today', 'end_date': '2014-07-01'}
+        self.assertEqual(normalize_date_range(
+            request, fitbit_data, self.user)['date__gte'], '2014-06-30')
+        self._cache_profile()
+        self.assertEqual(normalize_date_range(
+            request, fitbit_data, self.user)['date__gte'], '2014-07-01')
+
+    @freeze_time('2014-06-30 12:00:00')
+    def test_normalize_date_range_old_session(self):
+        """A session holding the whole profile is still read, and slimmed"""
+        request = HttpRequest()
+        request.session = {'fitbit_profile': {'user': {
+            'timezone': 'Pacific/Kiritimati', 'displayName': 'Name',
+            'memberSince': '2013-01-01'}}}
+        request.user = AnonymousUser()
+        fitbit_data = {'base_date': 'today', 'end_date': '2014-07-01'}
+        self.assertEqual(normalize_date_range(
+            request, fitbit_data, self.user)['date__gte'], '2014-07-01')
+        self.assertEqual(request.session, {'fitbit_profile': {
+            'timezone': 'Pacific/Kiritimati', 'displayName': 'Name'}})
+
 
 class TestIntegrationDecorator(FitappTestBase):
 
@@ -157,34 +256,38 @@ class TestCompleteView(FitappTestBase):
         super(TestCompleteView, self).setUp()
         self.fbuser.delete()
 
+    @patch('fitapp.tasks.update_fitbit_profile.apply_async')
     @patch('fitapp.tasks.subscribe.apply_async')
-    @patch('fitapp.tasks.get_time_series_data.apply_async')
-    def test_complete(self, tsd_apply_async, sub_apply_async):
+    @patch('fitapp.utils.queue_sync_jobs')
+    def test_complete(self, queue_sync_jobs, sub_apply_async,
+                      profile_apply_async):
         """Complete view should fetch & store user's access credentials."""
         response = self._mock_client(
             client_kwargs=self.token, get_kwargs={'code': self.code})
         self.assertRedirectsNoFollow(
             response, utils.get_setting('FITAPP_LOGIN_REDIRECT'))
         fbuser = UserFitbit.objects.get()
+        profile_apply_async.assert_called_once_with(
+            (fbuser.fitbit_user,), priority=9)
         sub_apply_async.assert_called_once_with(
-            (fbuser.fitbit_user, settings.FITAPP_SUBSCRIBER_ID), countdown=5)
+            (fbuser.fitbit_user, settings.FITAPP_SUBSCRIBER_ID), countdown=5,
+            priority=3)
         tsdts = TimeSeriesDataType.objects.all()
-        self.assertEqual(tsd_apply_async.call_count, tsdts.count())
-        for i, _type in enumerate(tsdts):
-            tsd_apply_async.assert_any_call(
-                (fbuser.fitbit_user, _type.category, _type.resource,),
-                countdown=10 + (i * 5))
+        queue_sync_jobs.assert_called_once_with(
+            fbuser.fitbit_user, backfill_time_series_data,
+            [(fbuser.fitbit_user, _type.category, _type.resource,)
+             for _type in tsdts],
+            countdown=10)
         self.assertEqual(fbuser.user, self.user)
         self.assertEqual(fbuser.access_token, self.token['access_token'])
         self.assertEqual(fbuser.refresh_token, self.token['refresh_token'])
         self.assertEqual(fbuser.fitbit_user, self.user_id)
 
     @override_settings(FITAPP_HISTORICAL_INIT_DELAY=11)
-    @override_settings(FITAPP_BETWEEN_DELAY=6)
     @patch('fitapp.tasks.subscribe.apply_async')
-    @patch('fitapp.tasks.get_time_series_data.apply_async')
-    def test_complete_different_delays(self, tsd_apply_async, sub_apply_async):
-        """Complete view should use configured delays"""
+    @patch('fitapp.utils.queue_sync_jobs')
+    def test_complete_different_delays(self, queue_sync_jobs, sub_apply_async):
+        """Complete view should use the configured delay"""
         tsdts = TimeSeriesDataType.objects.all()
         response = self._mock_client(
             client_kwargs=self.token, get_kwargs={'code': self.code})
@@ -192,41 +295,42 @@ class TestCompleteView(FitappTestBase):
 
         self.assertRedirectsNoFollow(
             response, utils.get_setting('FITAPP_LOGIN_REDIRECT'))
-        for i, _type in enumerate(tsdts):
-            tsd_apply_async.assert_any_call(
-                (fbuser.fitbit_user, _type.category, _type.resource,),
-                countdown=11 + (i * 6))
+        queue_sync_jobs.assert_called_once_with(
+            fbuser.fitbit_user, backfill_time_series_data,
+            [(fbuser.fitbit_user, _type.category, _type.resource,)
+             for _type in tsdts],
+            countdown=11)
 
     @override_settings(FITAPP_SUBSCRIPTIONS=OrderedDict([]))
     @patch('fitapp.tasks.subscribe.apply_async')
-    @patch('fitapp.tasks.get_time_series_data.apply_async')
-    def test_complete_empty_subs(self, tsd_apply_async, sub_apply_async):
+    @patch('fitapp.utils.queue_sync_jobs')
+    def test_complete_empty_subs(self, queue_sync_jobs, sub_apply_async):
         """Complete view should not import data if subs dict is empty"""
         response = self._mock_client(
             client_kwargs=self.token, get_kwargs={'code': self.code})
 
         self.assertRedirectsNoFollow(
             response, utils.get_setting('FITAPP_LOGIN_REDIRECT'))
-        self.assertEqual(tsd_apply_async.call_count, 0)
+        self.assertEqual(queue_sync_jobs.call_count, 0)
 
     @override_settings(FITAPP_SUBSCRIPTIONS=OrderedDict([('foods', [])]))
     @patch('fitapp.tasks.subscribe.apply_async')
-    @patch('fitapp.tasks.get_time_series_data.apply_async')
-    def test_complete_no_res(self, tsd_apply_async, sub_apply_async):
+    @patch('fitapp.utils.queue_sync_jobs')
+    def test_complete_no_res(self, queue_sync_jobs, sub_apply_async):
         """Complete view shouldn't import data if subs dict has no resources"""
         response = self._mock_client(
             client_kwargs=self.token, get_kwargs={'code': self.code})
 
         self.assertRedirectsNoFollow(
             response, utils.get_setting('FITAPP_LOGIN_REDIRECT'))
-        self.assertEqual(tsd_apply_async.call_count, 0)
+        self.assertEqual(queue_sync_jobs.call_count, 0)
 
     @override_settings(FITAPP_SUBSCRIPTIONS=OrderedDict([
         ('foods', ['steps'])
     ]))
     @patch('fitapp.tasks.subscribe.apply_async')
-    @patch('fitapp.tasks.get_time_series_data.apply_async')
-    def test_complete_bad_resources(self, tsd_apply_async, sub_apply_async):
+    @patch('fitapp.utils.queue_sync_jobs')
+    def test_complete_bad_resources(self, queue_sync_jobs, sub_apply_async):
         """
         Complete view shouldn't import data if subs dict has invalid resources
         """
@@ -238,15 +342,15 @@ class TestCompleteView(FitappTestBase):
             "['steps'] resources are invalid for the foods category",
             status_code=500
         )
-        self.assertEqual(tsd_apply_async.call_count, 0)
+        self.assertEqual(queue_sync_jobs.call_count, 0)
 
     @override_settings(FITAPP_SUBSCRIPTIONS=OrderedDict([
         ('activities', ['steps', 'calories', 'distance', 'activityCalories']),
         ('foods', ['log/water']),
     ]))
     @patch('fitapp.tasks.subscribe.apply_async')
-    @patch('fitapp.tasks.get_time_series_data.apply_async')
-    def test_complete_sub_list(self, tsd_apply_async, sub_apply_async):
+    @patch('fitapp.utils.queue_sync_jobs')
+    def test_complete_sub_list(self, queue_sync_jobs, sub_apply_async):
         """
         Complete view should only import the listed subscriptions, in the right
         order
@@ -258,21 +362,19 @@ class TestCompleteView(FitappTestBase):
 
         self.assertRedirectsNoFollow(
             response, utils.get_setting('FITAPP_LOGIN_REDIRECT'))
-        tsd_apply_async.assert_any_call(
-            (fbuser.fitbit_user, activities, 'steps',), countdown=10)
-        tsd_apply_async.assert_any_call(
-            (fbuser.fitbit_user, activities, 'calories',), countdown=15)
-        tsd_apply_async.assert_any_call(
-            (fbuser.fitbit_user, activities, 'distance',), countdown=20)
-        tsd_apply_async.assert_any_call(
-            (fbuser.fitbit_user, activities, 'activityCalories'), countdown=25)
-        tsd_apply_async.assert_any_call(
-            (fbuser.fitbit_user, TimeSeriesDataType.foods, 'log/water',),
-            countdown=30)
+        self.assertEqual(queue_sync_jobs.call_count, 1)
+        self.assertEqual(queue_sync_jobs.call_args[0][2], [
+            (fbuser.fitbit_user, activities, 'steps'),
+            (fbuser.fitbit_user, activities, 'calories'),
+            (fbuser.fitbit_user, activities, 'distance'),
+            (fbuser.fitbit_user, activities, 'activityCalories'),
+            (fbuser.fitbit_user, TimeSeriesDataType.foods, 'log/water'),
+        ])
+        self.assertEqual(queue_sync_jobs.call_args[1], {'countdown': 10})
 
     @patch('fitapp.tasks.subscribe.apply_async')
-    @patch('fitapp.tasks.get_time_series_data.apply_async')
-    def test_complete_already_integrated(self, tsd_apply_async, sub_apply_async):
+    @patch('fitapp.utils.queue_sync_jobs')
+    def test_complete_already_integrated(self, queue_sync_jobs, sub_apply_async):
         """
         Complete view redirect to the error view if a user attempts to connect
         an already integrated fitbit user to a second user.
@@ -287,7 +389,7 @@ class TestCompleteView(FitappTestBase):
         self.assertRedirectsNoFollow(response, reverse('fitbit-error'))
         self.assertEqual(UserFitbit.objects.all().count(), 1)
         self.assertEqual(sub_apply_async.call_count, 0)
-        self.assertEqual(tsd_apply_async.call_count, 0)
+        self.assertEqual(queue_sync_jobs.call_count, 0)
 
     def test_unauthenticated(self):
         """User must be logged in to access Complete view."""
@@ -297,8 +399,8 @@ class TestCompleteView(FitappTestBase):
         self.assertEqual(UserFitbit.objects.count(), 0)
 
     @patch('fitapp.tasks.subscribe.apply_async')
-    @patch('fitapp.tasks.get_time_series_data.apply_async')
-    def test_next(self, tsd_apply_async, sub_apply_async):
+    @patch('fitapp.utils.queue_sync_jobs')
+    def test_next(self, queue_sync_jobs, sub_apply_async):
         """
         Complete view should redirect to session['fitbit_next'] if available.
         """
@@ -308,9 +410,10 @@ class TestCompleteView(FitappTestBase):
         self.assertRedirectsNoFollow(response, '/test')
         fbuser = UserFitbit.objects.get()
         sub_apply_async.assert_called_once_with(
-            (fbuser.fitbit_user, settings.FITAPP_SUBSCRIBER_ID), countdown=5)
-        self.assertEqual(
-            tsd_apply_async.call_count, TimeSeriesDataType.objects.count())
+            (fbuser.fitbit_user, settings.FITAPP_SUBSCRIBER_ID), countdown=5,
+            priority=3)
+        self.assertEqual(len(queue_sync_jobs.call_args[0][2]),
+                         TimeSeriesDataType.objects.count())
         self.assertEqual(fbuser.user, self.user)
         self.assertEqual(fbuser.access_token, self.token['access_token'])
         self.assertEqual(fbuser.refresh_token, self.token['refresh_token'])
@@ -347,8 +450,8 @@ class TestCompleteView(FitappTestBase):
         self.assertEqual(UserFitbit.objects.count(), 0)
 
     @patch('fitapp.tasks.subscribe.apply_async')
-    @patch('fitapp.tasks.get_time_series_data.apply_async')
-    def test_integrated(self, tsd_apply_async, sub_apply_async):
+    @patch('fitapp.utils.queue_sync_jobs')
+    def test_integrated(self, queue_sync_jobs, sub_apply_async):
         """Complete view should overwrite existing credentials for this user.
         """
         self.fbuser = self.create_userfitbit(user=self.user)
@@ -356,8 +459,9 @@ class TestCompleteView(FitappTestBase):
             client_kwargs=self.token, get_kwargs={'code': self.code})
         fbuser = UserFitbit.objects.get()
         sub_apply_async.assert_called_with(
-            (fbuser.fitbit_user, settings.FITAPP_SUBSCRIBER_ID), countdown=5)
-        self.assertEqual(tsd_apply_async.call_count,
+            (fbuser.fitbit_user, settings.FITAPP_SUBSCRIBER_ID), countdown=5,
+            priority=3)
+        self.assertEqual(len(queue_sync_jobs.call_args[0][2]),
                          TimeSeriesDataType.objects.count())
         self.assertEqual(fbuser.user, self.user)
         self.assertEqual(fbuser.access_token, self.token['access_token'])
@@ -400,7 +504,8 @@ class TestLogoutView(FitappTestBase):
         response = self._get()
         kwargs = self.fbuser.get_user_data()
         del kwargs['refresh_cb']
-        apply_async.assert_called_once_with(kwargs=kwargs, countdown=5)
+        apply_async.assert_called_once_with(
+            kwargs=kwargs, countdown=5, priority=3)
         self.assertRedirectsNoFollow(
             response, utils.get_setting('FITAPP_LOGIN_REDIRECT'))
         self.assertEqual(UserFitbit.objects.count(), 0)
@@ -464,7 +569,7 @@ class TestLogoutView(FitappTestBase):
         response = self._get(get_kwargs={'next': '/test'})
         kwargs = self.fbuser.get_user_data()
         del kwargs['refresh_cb']
-        apply_async.assert_called_with(kwargs=kwargs, countdown=5)
+        apply_async.assert_called_with(kwargs=kwargs, countdown=5, priority=3)
         self.assertRedirectsNoFollow(response, '/test')
         self.assertEqual(UserFitbit.objects.count(), 0)
 
@@ -1,5 +1,8 @@
-from fitapp.models import TimeSeriesDataType
-from django.db import IntegrityError, models
+from datetime import datetime
+from importlib import import_module
+
+from fitapp.models import TimeSeriesData, TimeSeriesDataType
+from django.db import IntegrityError, connection, models
 
 from .base import FitappTestBase
 
@@ -36,3 +39,78 @@ class TestFitappModels(FitappTestBase):
 class TestUserModel(models.Model):
     class Meta:
         app_label = 'fitapp.tests'
+
+
+class TestTimeSeriesDataQueryPlans(FitappTestBase):
+    """
+    The hot read paths should stay index range scans as the table grows.
+    """
+
+    def setUp(self):
+        super(TestTimeSeriesDataQueryPlans, self).setUp()
+        if connection.vendor != 'sqlite':
+            self.skipTest('Query plans are only checked on SQLite')
+        self.steps = TimeSeriesDataType.objects.get(
+            category=TimeSeriesDataType.activities, resource='steps')
+        other_user = self.create_user()
+        for user in (self.user, other_user):
+            for day in range(1, 29):
+                TimeSeriesData.objects.create(
+                    user=user, resource_type=self.steps,
+                    date='2012-02-%02d' % day, value=str(day))
+                TimeSeriesData.objects.create(
+                    user=user, resource_type=self.steps,
+                    date='2012-02-%02d 12:00' % day, value=str(day),
+                    intraday=True)
+
+    def _query_plan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return ' '.join(row[-1] for row in cursor.fetchall())
+
+    def test_daily_series_plan(self):
+        """Reading daily data is a covering index range scan, with no sort"""
+        plan = self._query_plan(TimeSeriesData.objects.filter(
+            user=self.user, resource_type=self.steps,
+            date__gte='2012-02-03', date__lte='2012-02-10'
+        ).daily_series())
+        self.assertIn('USING COVERING INDEX', plan)
+        self.assertIn('date>? AND date<?', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+        self.assertNotIn('SCAN', plan)
+
+    def test_intraday_buckets_plan(self):
+        """Aggregating intraday data is a covering index range scan"""
+        plan = self._query_plan(TimeSeriesData.objects.filter(
+            user=self.user, resource_type=self.steps,
+            date__gte='2012-02-03', date__lt='2012-02-10'
+        ).intraday_buckets(900))
+        self.assertIn('USING COVERING INDEX', plan)
+        self.assertIn('date>? AND date<?', plan)
+        self.assertNotIn('SCAN', plan)
+
+
+class TestSleepHypnogramMigration(FitappTestBase):
+    def test_nights(self):
+        """
+        Stage rows are grouped into nights by the date their sleep log ends,
+        like the dateOfSleep that new hypnograms are saved by
+        """
+        migration = import_module('fitapp.migrations.0020_sleephypnogram')
+        rows = [
+            (1, datetime(2017, 1, 30, 23), 'light', 600),
+            (1, datetime(2017, 1, 30, 23, 10), 'deep', 3600),
+            # A nap the next afternoon
+            (1, datetime(2017, 1, 31, 14), 'light', 900),
+            (2, datetime(2017, 1, 31, 14, 15), 'light', 60),
+        ]
+        logs = list(migration.get_sleep_logs(iter(rows)))
+        self.assertEqual([(user_id, len(stages)) for user_id, stages in logs],
+                         [(1, 2), (1, 1), (2, 1)])
+        self.assertEqual(
+            [migration.get_night(stages) for _, stages in logs],
+            [datetime(2017, 1, 31)] * 3)
+        start, data = migration.encode(
+            logs[0][1] + [(datetime(2017, 1, 31, 1), 'unknown', 60)])
+        self.assertEqual((start, len(data)), (datetime(2017, 1, 30, 23), 18))
@@ -2,14 +2,16 @@ from __future__ import absolute_import
 
 import celery
 import json
+import requests
 import sys
 import time
 
 from collections import OrderedDict
+from datetime import date, datetime, timedelta
 from dateutil import parser
-from django.core.cache import cache
 from django.core.files.uploadedfile import InMemoryUploadedFile
 from django.core.urlresolvers import reverse
+from django.db import IntegrityError, connection
 from django.test.utils import override_settings
 from freezegun import freeze_time
 from mock import MagicMock, patch
@@ -19,13 +21,23 @@ from fitbit import exceptions as fitbit_exceptions
 from fitbit.api import Fitbit, FitbitOauth2Client
 
 from fitapp import utils
-from fitapp.models import UserFitbit, TimeSeriesData, TimeSeriesDataType
-from fitapp.tasks import get_time_series_data
+from fitapp.expressions import EpochBucket
+from fitapp.models import (UserFitbit, TimeSeriesData, TimeSeriesDataType,
+                           SleepStageTimeSeriesData, SleepStageSummary,
+                           SleepTypeData, BackfillCheckpoint, SyncJob,
+                           SyncLease, SyncWatermark)
+from fitapp.tasks import (backfill_time_series_data, get_sleep_log,
+                          get_time_series_data, run_sync_jobs,
+                          sync_sleep_logs)
 
 try:
     from io import BytesIO
 except ImportError:  # Python 2.x fallback
     from StringIO import StringIO as BytesIO
+try:
+    from urllib.parse import urlencode
+except ImportError:  # Python 2.x fallback
+    from urllib import urlencode
 
 from .base import FitappTestBase
 
@@ -170,12 +182,9 @@ class TestRetrievalTask(FitappTestBase):
         resources = TimeSeriesDataType.objects.filter(category=category)
         self._receive_fitbit_updates()
         self.assertEqual(get_fitbit_data.call_count, resources.count())
-        # Check that the cache locks have been deleted
-        for resource in resources:
-            self.assertEqual(
-                cache.get('fitapp.get_time_series_data-lock-%s-%s-%s' % (
-                    category, resource.resource, self.date)
-                ), None)
+        # Check that the jobs have run and the user's lease is released
+        self.assertEqual(SyncJob.objects.count(), 0)
+        self.assertEqual(SyncLease.objects.count(), 0)
         date = parser.parse(self.date)
         for tsd in TimeSeriesData.objects.filter(user=self.user, date=date):
             assert tsd.value == self.value
@@ -189,12 +198,9 @@ class TestRetrievalTask(FitappTestBase):
         resources = TimeSeriesDataType.objects.filter(category=category)
         self._receive_fitbit_updates(file=True)
         self.assertEqual(get_fitbit_data.call_count, resources.count())
-        # Check that the cache locks have been deleted
-        for resource in resources:
-            self.assertEqual(
-                cache.get('fitapp.get_time_series_data-lock-%s-%s-%s' % (
-                    category, resource.resource, self.date)
-                ), None)
+        # Check that the jobs have run and the user's lease is released
+        self.assertEqual(SyncJob.objects.count(), 0)
+        self.assertEqual(SyncLease.objects.count(), 0)
         date = parser.parse(self.date)
         for tsd in TimeSeriesData.objects.filter(user=self.user, date=date):
             assert tsd.value == self.value
@@ -231,8 +237,8 @@ class TestRetrievalTask(FitappTestBase):
     @override_settings(FITAPP_SUBSCRIPTIONS=OrderedDict([
         ('foods', ['log/water', 'log/caloriesIn']),
     ]))
-    @patch('fitapp.tasks.get_time_series_data.apply_async')
-    def test_subscription_update_file_part_match_subs(self, tsd_apply_async):
+    @patch('fitapp.utils.queue_sync_jobs')
+    def test_subscription_update_file_part_match_subs(self, queue_sync_jobs):
         # Check that we only retrieve the data requested
         fbuser = UserFitbit.objects.get()
         foods = TimeSeriesDataType.foods
@@ -244,17 +250,17 @@ class TestRetrievalTask(FitappTestBase):
             'date': self.date
         })
 
-        self.assertEqual(tsd_apply_async.call_count, 2)
-        tsd_apply_async.assert_any_call(
-            (fbuser.fitbit_user, foods, 'log/water',), kwargs, countdown=0)
-        tsd_apply_async.assert_any_call(
-            (fbuser.fitbit_user, foods, 'log/caloriesIn'), kwargs, countdown=5)
+        queue_sync_jobs.assert_called_once_with(
+            fbuser.fitbit_user, get_time_series_data, [
+                (fbuser.fitbit_user, foods, 'log/water',),
+                (fbuser.fitbit_user, foods, 'log/caloriesIn',),
+            ], kwargs)
 
     @override_settings(FITAPP_SUBSCRIPTIONS=OrderedDict([
         ('foods', ['log/water', 'log/caloriesIn', 'bogus']),
     ]))
-    @patch('fitapp.tasks.get_time_series_data.apply_async')
-    def test_subscription_update_file_bogus_error(self, tsd_apply_async):
+    @patch('fitapp.utils.queue_sync_jobs')
+    def test_subscription_update_file_bogus_error(self, queue_sync_jobs):
         # Check that we only retrieve the data requested
         fbuser = UserFitbit.objects.get()
         foods = TimeSeriesDataType.foods
@@ -266,19 +272,29 @@ class TestRetrievalTask(FitappTestBase):
             'date': self.date
         })
 
-        self.assertEqual(tsd_apply_async.call_count, 0)
+        self.assertEqual(queue_sync_jobs.call_count, 0)
 
     @patch('fitapp.utils.get_fitbit_data')
-    @patch('django.core.cache.cache.add')
-    def test_subscription_update_locked(self, mock_add, get_fitbit_data):
-        # Check that celery tasks do not get made when a notification is
-        # received from Fitbit, but there is already a matching task in
-        # progress
-        mock_add.return_value = False
-        self.assertEqual(TimeSeriesData.objects.count(), 0)
+    @patch('fitapp.tasks.run_sync_jobs.apply_async')
+    def test_subscription_update_running(self, apply_async, get_fitbit_data):
+        # Check that notifications received from Fitbit while the user's data
+        # is already being retrieved are collapsed into one pending job each
+        get_fitbit_data.return_value = [{'value': self.value}]
+        category = getattr(TimeSeriesDataType, self.category)
+        resources = TimeSeriesDataType.objects.filter(category=category)
+        self._receive_fitbit_updates()
         self._receive_fitbit_updates()
+        self.assertEqual(apply_async.call_count, 1)
         self.assertEqual(get_fitbit_data.call_count, 0)
-        self.assertEqual(TimeSeriesData.objects.count(), 0)
+        self.assertEqual(SyncJob.objects.count(), resources.count())
+        self.assertEqual(SyncLease.objects.count(), 1)
+
+        # Each job runs once
+        apply_async.side_effect = lambda args, **kwargs: run_sync_jobs(*args)
+        run_sync_jobs(*apply_async.call_args[0][0])
+        self.assertEqual(get_fitbit_data.call_count, resources.count())
+        self.assertEqual(SyncJob.objects.count(), 0)
+        self.assertEqual(SyncLease.objects.count(), 0)
 
     @patch('fitapp.utils.get_fitbit_profile')
     @patch('fitapp.utils.get_fitbit_data')
@@ -287,14 +303,11 @@ class TestRetrievalTask(FitappTestBase):
         # Check that celery tasks get postponed if the rate limit is hit
         cat_id = getattr(TimeSeriesDataType, self.category)
         _type = TimeSeriesDataType.objects.filter(category=cat_id)[0]
-        lock_id = 'fitapp.tasks-lock-{0}-{1}-{2}'.format(
-            self.fbuser.fitbit_user, _type, self.date)
         exc = fitbit_exceptions.HTTPTooManyRequests(self._error_response())
         exc.retry_after_secs = 21
         def side_effect(*args, **kwargs):
-            # Delete the cache lock after the first try and adjust the
-            # get_fitbit_data mock to be successful
-            cache.delete(lock_id)
+            # Adjust the get_fitbit_data mock to be successful after the
+            # first try
             get_fitbit_data.side_effect = None
             get_fitbit_data.return_value = [{
                 'dateTime': self.date,
@@ -340,6 +353,231 @@ class TestRetrievalTask(FitappTestBase):
         self.assertEqual(get_fitbit_data.call_count, 1)
         self.assertEqual(TimeSeriesData.objects.count(), 0)
 
+    @patch('fitapp.utils.queue_sync_jobs')
+    @patch('fitapp.utils.queue_sync_job')
+    def test_subscription_update_sleep(self, queue_sync_job, queue_sync_jobs):
+        # Check that a sleep update creates a task for the new sleep logs,
+        # and one for the night's sleep log when it may have been synced
+        self.category = 'sleep'
+        self._receive_fitbit_updates()
+        fitbit_user = self.fbuser.fitbit_user
+        self.assertEqual(queue_sync_job.call_args_list, [
+            ((fitbit_user, sync_sleep_logs, (fitbit_user,)),),
+            ((fitbit_user, get_sleep_log,
+              (fitbit_user, parser.parse(self.date))),),
+        ])
+        self.assertEqual(
+            len(queue_sync_jobs.call_args[0][2]),
+            TimeSeriesDataType.objects.filter(
+                category=TimeSeriesDataType.sleep).count())
+
+        # The night after the last synced sleep log can only be a new one
+        queue_sync_job.reset_mock()
+        self.fbuser.last_sleep_start = datetime(2013, 5, 1, 1)
+        self.fbuser.save()
+        self._receive_fitbit_updates()
+        self.assertEqual(len(queue_sync_job.call_args_list), 2)
+        queue_sync_job.reset_mock()
+        self.fbuser.last_sleep_start = datetime(2013, 4, 30, 23)
+        self.fbuser.save()
+        self._receive_fitbit_updates()
+        self.assertEqual(queue_sync_job.call_args_list, [
+            ((fitbit_user, sync_sleep_logs, (fitbit_user,)),)])
+
+    @patch('fitapp.utils.sync_sleep_logs')
+    def test_sync_sleep_logs(self, mock_sync_sleep_logs):
+        # Check that the sleep log sync task syncs each of the Fitbit user's
+        # UserFitbits
+        sync_sleep_logs.apply_async((self.fbuser.fitbit_user,))
+        mock_sync_sleep_logs.assert_called_once_with(self.fbuser)
+
+    @patch('fitapp.tasks.sync_sleep_logs.retry')
+    @patch('fitapp.utils.sync_sleep_logs')
+    def test_sync_sleep_logs_too_many_retry(self, mock_sync_sleep_logs,
+                                            mock_retry):
+        # Check that the sleep log sync task is retried when the rate limit
+        # resets
+        exc = fitbit_exceptions.HTTPTooManyRequests(self._error_response())
+        exc.retry_after_secs = 21
+        mock_sync_sleep_logs.side_effect = exc
+        mock_retry.return_value = Exception()
+
+        result = sync_sleep_logs.apply_async((self.fbuser.fitbit_user,))
+
+        sync_sleep_logs.retry.assert_called_once_with(countdown=22, exc=exc)
+        self.assertRaises(Exception, result.get)
+
+    @patch('fitapp.utils.sync_sleep_logs')
+    def test_sync_sleep_logs_error(self, mock_sync_sleep_logs):
+        # Check that other errors reject the sleep log sync task
+        exc = KeyError('sleep')
+        mock_sync_sleep_logs.side_effect = exc
+        result = sync_sleep_logs.apply_async((self.fbuser.fitbit_user,))
+        self.assertEqual(result.successful(), False)
+        self.assertEqual(type(result.result), celery.exceptions.Reject)
+        self.assertEqual(result.result.reason, exc)
+
+    @patch.object(Fitbit, 'get_sleep')
+    def test_sleep_log(self, get_sleep):
+        # Check that the sleep stages and summary are saved from one request
+        get_sleep.return_value = {'sleep': [{
+            'dateOfSleep': self.date,
+            'levels': {
+                'summary': {'deep': {'count': 1, 'minutes': 60}},
+                'data': [{'dateTime': self.date + 'T01:00:00.000',
+                          'level': 'deep', 'seconds': 3600}],
+            },
+        }]}
+        date = parser.parse(self.date)
+        get_sleep_log.apply_async((self.fbuser.fitbit_user, date))
+        get_sleep.assert_called_once_with(date)
+        self.assertEqual(SleepStageTimeSeriesData.objects.get(
+            user=self.user).seconds, 3600)
+        self.assertEqual(SleepTypeData.objects.get(
+            sleep_summary__user=self.user, level='deep').minute, 60)
+
+    @patch('fitapp.tasks.get_sleep_log.retry')
+    @patch('fitapp.utils.get_fitbit_sleep_log')
+    def test_sleep_log_too_many_retry(self, get_fitbit_sleep_log, mock_retry):
+        # Check that the sleep log task is retried when the rate limit resets
+        exc = fitbit_exceptions.HTTPTooManyRequests(self._error_response())
+        exc.retry_after_secs = 21
+        get_fitbit_sleep_log.side_effect = exc
+        mock_retry.return_value = Exception()
+        date = parser.parse(self.date)
+
+        result = get_sleep_log.apply_async((self.fbuser.fitbit_user, date))
+
+        get_sleep_log.retry.assert_called_once_with(countdown=22, exc=exc)
+        self.assertRaises(Exception, result.get)
+        get_fitbit_sleep_log.assert_called_once_with(self.fbuser, date)
+
+    @freeze_time('2014-06-30')
+    @patch('fitapp.utils.get_fitbit_profile')
+    @patch('fitapp.utils.get_fitbit_data')
+    def test_backfill(self, get_fitbit_data, get_fitbit_profile):
+        # Check that the most recent days are retrieved first, then the
+        # history a window at a time, newest first, with a checkpoint for
+        # each history window
+        get_fitbit_profile.return_value = {'memberSince': '2013-01-01'}
+        get_fitbit_data.side_effect = lambda fbuser, _type, base_date, \
+            end_date: [{'dateTime': str(base_date), 'value': '1'},
+                       {'dateTime': str(end_date), 'value': '2'}]
+        _type = TimeSeriesDataType.objects.get(
+            category=TimeSeriesDataType.activities, resource='steps')
+
+        backfill_time_series_data.apply_async(
+            (self.fbuser.fitbit_user, _type.category, _type.resource))
+
+        get_fitbit_profile.assert_called_once_with(self.fbuser)
+        self.assertEqual([c[1] for c in get_fitbit_data.call_args_list], [
+            {'base_date': date(2014, 6, 24), 'end_date': date(2014, 6, 30)},
+            {'base_date': date(2014, 1, 1), 'end_date': date(2014, 6, 23)},
+            {'base_date': date(2013, 1, 1), 'end_date': date(2013, 12, 31)},
+        ])
+        self.assertEqual(TimeSeriesData.objects.filter(
+            user=self.user, resource_type=_type).count(), 6)
+        self.assertEqual(list(BackfillCheckpoint.objects.order_by(
+            'base_date').values_list('resource', 'base_date', 'end_date')), [
+            ('activities/steps', date(2013, 1, 1), date(2013, 12, 31)),
+            ('activities/steps', date(2014, 1, 1), date(2014, 6, 23)),
+        ])
+        self.assertEqual(SyncWatermark.objects.get(
+            user=self.user, resource_type=_type).date, date(2014, 6, 29))
+
+    @freeze_time('2014-06-30')
+    @patch('fitapp.utils.get_fitbit_profile')
+    @patch('fitapp.utils.get_fitbit_data')
+    def test_backfill_resume(self, get_fitbit_data, get_fitbit_profile):
+        # Check that checkpointed windows aren't retrieved again
+        get_fitbit_data.return_value = []
+        _type = TimeSeriesDataType.objects.get(
+            category=TimeSeriesDataType.activities, resource='steps')
+        BackfillCheckpoint.objects.create(
+            user=self.user, resource=_type.path(),
+            base_date=date(2014, 1, 1), end_date=date(2014, 6, 23))
+
+        backfill_time_series_data.apply_async(
+            (self.fbuser.fitbit_user, _type.category, _type.resource,
+             '2013-01-01'))
+
+        self.assertEqual(get_fitbit_profile.call_count, 0)
+        get_fitbit_data.assert_called_once_with(
+            self.fbuser, _type, base_date=date(2013, 1, 1),
+            end_date=date(2013, 12, 31))
+
+    @freeze_time('2014-06-30')
+    @patch('fitapp.utils.get_fitbit_data')
+    def test_sync_watermark(self, get_fitbit_data):
+        # Check that undated syncs only retrieve data from shortly before the
+        # newest fully synced date
+        get_fitbit_data.return_value = [
+            {'dateTime': '2014-06-29', 'value': '1'},
+            {'dateTime': '2014-06-30', 'value': '2'},
+        ]
+        _type = TimeSeriesDataType.objects.get(
+            category=TimeSeriesDataType.foods, resource='log/water')
+
+        get_time_series_data.apply_async(
+            (self.fbuser.fitbit_user, _type.category, _type.resource))
+        get_fitbit_data.assert_called_once_with(
+            self.fbuser, _type, base_date='today', period='max')
+        watermark = SyncWatermark.objects.get(user=self.user)
+        self.assertEqual(watermark.date, date(2014, 6, 29))
+        self.assertEqual(watermark.intraday, False)
+
+        get_fitbit_data.reset_mock()
+        get_time_series_data.apply_async(
+            (self.fbuser.fitbit_user, _type.category, _type.resource))
+        get_fitbit_data.assert_called_once_with(
+            self.fbuser, _type, base_date=date(2014, 6, 27), end_date='today')
+        self.assertEqual(TimeSeriesData.objects.filter(
+            user=self.user, resource_type=_type).count(), 2)
+
+    @freeze_time('2014-06-30')
+    @patch('fitapp.utils.queue_sync_job')
+    @patch('fitapp.utils.get_fitbit_profile')
+    @patch('fitapp.utils.get_fitbit_data')
+    def test_sync_watermark_intraday(self, get_fitbit_data, get_fitbit_profile,
+                                     queue_sync_job):
+        # Check that intraday data isn't retrieved again for synced days
+        get_fitbit_profile.return_value = 0
+        get_fitbit_data.return_value = [
+            {'dateTime': '2014-06-2{}'.format(day), 'value': '1'}
+            for day in range(5, 10)]
+        _type = TimeSeriesDataType.objects.get(
+            category=TimeSeriesDataType.activities, resource='steps')
+        SyncWatermark.objects.create(
+            user=self.user, resource_type=_type, intraday=True,
+            date=date(2014, 6, 28))
+
+        get_time_series_data.apply_async(
+            (self.fbuser.fitbit_user, _type.category, _type.resource))
+
+        dates = [c[0][2][3] for c in queue_sync_job.call_args_list
+                 if c[0][2][2] == 'steps']
+        self.assertEqual(dates, [datetime(2014, 6, d) for d in (26, 27, 28, 29)])
+
+    @patch('fitapp.tasks.backfill_time_series_data.retry')
+    @patch('fitapp.utils.get_fitbit_data')
+    def test_backfill_too_many_retry(self, get_fitbit_data, mock_retry):
+        # Check that the backfill is retried when the rate limit resets
+        exc = fitbit_exceptions.HTTPTooManyRequests(self._error_response())
+        exc.retry_after_secs = 21
+        get_fitbit_data.side_effect = exc
+        mock_retry.return_value = Exception()
+        _type = TimeSeriesDataType.objects.get(
+            category=TimeSeriesDataType.activities, resource='steps')
+
+        result = backfill_time_series_data.apply_async(
+            (self.fbuser.fitbit_user, _type.category, _type.resource,
+             '2013-01-01'))
+
+        backfill_time_series_data.retry.assert_called_once_with(
+            countdown=22, exc=exc)
+        self.assertRaises(Exception, result.get)
+        self.assertEqual(BackfillCheckpoint.objects.count(), 0)
+
     @patch('fitapp.utils.get_fitbit_data')
     def test_subscription_update_bad_request(self, get_fitbit_data):
         # Make sure bad requests for floors and elevation are ignored,
@@ -635,3 +873,521 @@ class TestRetrieveRange(RetrievalViewTestBase, FitappTestBase):
         response = self._mock_utility(response=steps,
                                       get_kwargs=self._data())
         self._check_response(response, 100, steps)
+
+
+class TestRetrieveBatch(FitappTestBase):
+    url_name = 'fitbit-batch-data'
+
+    def setUp(self):
+        super(TestRetrieveBatch, self).setUp()
+        self.steps = TimeSeriesDataType.objects.get(
+            category=TimeSeriesDataType.activities, resource='steps')
+        self.distance = TimeSeriesDataType.objects.get(
+            category=TimeSeriesDataType.activities, resource='distance')
+        for resource_type, date, value in (
+                (self.steps, '2012-06-08', '12'),
+                (self.steps, '2012-06-07', '10'),
+                (self.distance, '2012-06-07', '1.5')):
+            TimeSeriesData.objects.create(
+                user=self.user, resource_type=resource_type, date=date,
+                value=value)
+
+    def _data(self, **kwargs):
+        data = {'resource': ['activities/steps', 'activities/distance'],
+                'base_date': '2012-06-06', 'end_date': '2012-07-07'}
+        data.update(kwargs)
+        return data
+
+    def _get_batch(self, data):
+        url = reverse(self.url_name) + '?' + urlencode(data, doseq=True)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content.decode('utf8'))
+
+    def test_batch(self):
+        """All requested resources are returned, grouped by resource"""
+        data = self._get_batch(self._data())
+        self.assertEqual(data['meta'], {'total_count': 2, 'status_code': 100})
+        self.assertEqual(data['objects'], {
+            'activities/steps': [
+                {'dateTime': '2012-06-07', 'value': '10'},
+                {'dateTime': '2012-06-08', 'value': '12'},
+            ],
+            'activities/distance': [
+                {'dateTime': '2012-06-07', 'value': '1.5'},
+            ],
+        })
+
+    def test_batch_excludes_intraday(self):
+        """Intraday records are not included in the daily series"""
+        TimeSeriesData.objects.create(
+            user=self.user, resource_type=self.steps,
+            date='2012-06-07 12:15:00', value='3', intraday=True)
+        data = self._get_batch(self._data(resource='activities/steps'))
+        self.assertEqual(data['objects'], {'activities/steps': [
+            {'dateTime': '2012-06-07', 'value': '10'},
+            {'dateTime': '2012-06-08', 'value': '12'},
+        ]})
+
+    def test_batch_invalid_resource(self):
+        """Status code should be 104 when any resource is invalid"""
+        for resource in (['activities/steps', 'activities/bogus'],
+                         ['bogus/steps'], ['activities'], []):
+            data = self._get_batch(self._data(resource=resource))
+            self.assertEqual(data['meta']['status_code'], 104)
+
+    def test_batch_invalid_dates(self):
+        """Status code should be 104 when the date parameters are invalid"""
+        data = self._get_batch(self._data(period='30d'))
+        self.assertEqual(data['meta']['status_code'], 104)
+
+    def test_batch_not_authenticated(self):
+        """Status code should be 101 when user isn't logged in."""
+        self.client.logout()
+        data = self._get_batch(self._data())
+        self.assertEqual(data['meta']['status_code'], 101)
+
+    @override_settings(FITAPP_SUBSCRIBE=False)
+    @patch('fitapp.utils.get_fitbit_data')
+    def test_batch_api(self, get_fitbit_data):
+        """Each resource is retrieved from the API when not subscribed"""
+        get_fitbit_data.side_effect = lambda fbuser, _type, **kw: [
+            {'dateTime': '2012-06-07', 'value': _type.resource}]
+        data = self._get_batch(self._data())
+        self.assertEqual(get_fitbit_data.call_count, 2)
+        self.assertEqual(data['objects'], {
+            'activities/steps': [
+                {'dateTime': '2012-06-07', 'value': 'steps'}],
+            'activities/distance': [
+                {'dateTime': '2012-06-07', 'value': 'distance'}],
+        })
+
+    @override_settings(FITAPP_SUBSCRIBE=False)
+    @patch('fitapp.utils.get_fitbit_data')
+    def test_batch_api_rate_limited(self, get_fitbit_data):
+        """Status code should be 105 when Fitbit rate limit is hit."""
+        get_fitbit_data.side_effect = fitbit_exceptions.HTTPConflict(
+            self._error_response())
+        data = self._get_batch(self._data())
+        self.assertEqual(data['meta']['status_code'], 105)
+
+
+class TestRetrievePages(FitappTestBase):
+    url_name = 'fitbit-data'
+
+    def setUp(self):
+        super(TestRetrievePages, self).setUp()
+        steps = TimeSeriesDataType.objects.get(
+            category=TimeSeriesDataType.activities, resource='steps')
+        for day in range(1, 11):
+            TimeSeriesData.objects.create(
+                user=self.user, resource_type=steps,
+                date=datetime(2012, 6, day), value=str(day))
+
+    def _get_page(self, **kwargs):
+        data = {'base_date': '2012-06-02', 'end_date': '2012-06-30'}
+        data.update(kwargs)
+        response = self._get(
+            url_kwargs={'category': 'activities', 'resource': 'steps'},
+            get_kwargs=data)
+        return json.loads(response.content.decode('utf8'))
+
+    def test_pages(self):
+        """Stored data can be retrieved a page at a time with a cursor"""
+        data = self._get_page(limit=4)
+        self.assertEqual([d['value'] for d in data['objects']],
+                         ['2', '3', '4', '5'])
+        data = self._get_page(limit=4, cursor=data['meta']['next'])
+        self.assertEqual([d['value'] for d in data['objects']],
+                         ['6', '7', '8', '9'])
+        data = self._get_page(limit=4, cursor=data['meta']['next'])
+        self.assertEqual([d['value'] for d in data['objects']], ['10'])
+        self.assertEqual(data['meta'], {
+            'total_count': 1, 'status_code': 100, 'next': None})
+
+    @override_settings(FITAPP_MAX_PAGE_SIZE=3)
+    def test_max_page_size(self):
+        """Pages are no larger than FITAPP_MAX_PAGE_SIZE"""
+        data = self._get_page(limit=5)
+        self.assertEqual(data['meta']['total_count'], 3)
+        data = self._get_page(cursor=data['meta']['next'])
+        self.assertEqual([d['value'] for d in data['objects']],
+                         ['5', '6', '7'])
+
+    def test_no_pages(self):
+        """All of the data is returned without pagination parameters"""
+        data = self._get_page()
+        self.assertEqual(data['meta'], {'total_count': 9, 'status_code': 100})
+
+    def test_invalid(self):
+        """Status code should be 104 for invalid pagination parameters"""
+        for kwargs in ({'limit': 0}, {'limit': 'bad'}, {'cursor': 'bad'},
+                       {'cursor': utils.encode_cursor(datetime(2012, 6, 1))[:-3]}):
+            data = self._get_page(**kwargs)
+            self.assertEqual(data['meta']['status_code'], 104)
+
+
+@override_settings(FITAPP_READ_THROUGH=True)
+@freeze_time('2012-06-12')
+class TestRetrieveReadThrough(FitappTestBase):
+    url_name = 'fitbit-data'
+
+    def setUp(self):
+        super(TestRetrieveReadThrough, self).setUp()
+        self.steps = TimeSeriesDataType.objects.get(
+            category=TimeSeriesDataType.activities, resource='steps')
+        for day in range(1, 10):
+            TimeSeriesData.objects.create(
+                user=self.user, resource_type=self.steps,
+                date=datetime(2012, 6, day), value=str(day))
+        SyncWatermark.objects.create(
+            user=self.user, resource_type=self.steps, date=date(2012, 6, 9))
+
+    def _get_values(self, **kwargs):
+        data = {'base_date': '2012-06-02', 'end_date': '2012-06-30'}
+        data.update(kwargs)
+        response = self._get(
+            url_kwargs={'category': 'activities', 'resource': 'steps'},
+            get_kwargs=data)
+        data = json.loads(response.content.decode('utf8'))
+        return [d['value'] for d in data['objects']]
+
+    @patch('fitapp.utils.get_fitbit_data')
+    def test_read_through(self, get_fitbit_data):
+        """Only the unsynced days are retrieved from Fitbit, and saved"""
+        get_fitbit_data.return_value = [
+            {'dateTime': '2012-06-1{}'.format(day), 'value': '1{}'.format(day)}
+            for day in range(3)]
+        self.assertEqual(
+            self._get_values(), [str(day) for day in range(2, 13)])
+        get_fitbit_data.assert_called_once_with(
+            self.fbuser, self.steps, base_date=date(2012, 6, 10),
+            end_date=date(2012, 6, 12))
+        self.assertEqual(TimeSeriesData.objects.count(), 12)
+        self.assertEqual(SyncWatermark.objects.get().date, date(2012, 6, 11))
+
+        # The same days aren't retrieved again right away
+        self.assertEqual(len(self._get_values()), 11)
+        self.assertEqual(get_fitbit_data.call_count, 1)
+
+    @patch('fitapp.utils.queue_sync_job')
+    @patch('fitapp.utils.get_fitbit_data')
+    def test_unsynced(self, get_fitbit_data, queue_sync_job):
+        """Only the most recent days of a long gap are retrieved right away"""
+        SyncWatermark.objects.all().delete()
+        get_fitbit_data.return_value = []
+        self._get_values(base_date='2012-01-01')
+        get_fitbit_data.assert_called_once_with(
+            self.fbuser, self.steps, base_date=date(2012, 6, 6),
+            end_date=date(2012, 6, 12))
+        fitbit_user = self.fbuser.fitbit_user
+        queue_sync_job.assert_called_once_with(
+            fitbit_user, backfill_time_series_data,
+            (fitbit_user, self.steps.category, 'steps', '2012-01-01'),
+            lane='backfill')
+
+    @patch('fitapp.utils.get_fitbit_data')
+    def test_synced(self, get_fitbit_data):
+        """Ranges that are synced are served from the database only"""
+        self.assertEqual(self._get_values(end_date='2012-06-09'),
+                         [str(day) for day in range(2, 10)])
+        self.assertEqual(get_fitbit_data.call_count, 0)
+
+    @patch('fitapp.utils.get_fitbit_data')
+    def test_error(self, get_fitbit_data):
+        """The stored data is served when Fitbit can't be reached"""
+        for exc in (fitbit_exceptions.HTTPServerError(self._error_response()),
+                    requests.ConnectionError(), IntegrityError()):
+            get_fitbit_data.side_effect = exc
+            self.assertEqual(
+                self._get_values(), [str(day) for day in range(2, 10)])
+        get_fitbit_data.side_effect = None
+        get_fitbit_data.return_value = []
+        self._get_values()
+        self.assertEqual(get_fitbit_data.call_count, 4)
+
+
+class TestRetrieveIntraday(FitappTestBase):
+    url_name = 'fitbit-intraday-data'
+
+    def setUp(self):
+        super(TestRetrieveIntraday, self).setUp()
+        self.steps = TimeSeriesDataType.objects.get(
+            category=TimeSeriesDataType.activities, resource='steps')
+        start = datetime(2012, 6, 7, 10, 0)
+        for minute in range(30):
+            TimeSeriesData.objects.create(
+                user=self.user, resource_type=self.steps,
+                date=start + timedelta(minutes=minute), value=str(minute),
+                intraday=True)
+        # Daily data should not be included
+        TimeSeriesData.objects.create(
+            user=self.user, resource_type=self.steps, date='2012-06-07',
+            value='1000')
+
+    def _get_intraday(self, resource='steps', **kwargs):
+        data = {'base_date': '2012-06-07', 'end_date': '2012-06-07',
+                'resolution': '15min'}
+        data.update(kwargs)
+        response = self._get(
+            url_kwargs={'category': 'activities', 'resource': resource},
+            get_kwargs=data)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content.decode('utf8'))
+
+    def test_resolutions(self):
+        """Minute data is summed into points of the requested resolution"""
+        data = self._get_intraday(resolution='1min')
+        self.assertEqual(data['meta']['total_count'], 30)
+        self.assertEqual(data['objects'][1],
+                         {'dateTime': '2012-06-07 10:01:00', 'value': 1})
+        data = self._get_intraday(resolution='15min')
+        self.assertEqual(data['objects'], [
+            {'dateTime': '2012-06-07 10:00:00', 'value': sum(range(15))},
+            {'dateTime': '2012-06-07 10:15:00', 'value': sum(range(15, 30))},
+        ])
+        data = self._get_intraday(resolution='1h')
+        self.assertEqual(data['objects'], [
+            {'dateTime': '2012-06-07 10:00:00', 'value': sum(range(30))},
+        ])
+
+    def test_time_range(self):
+        """Times can be used to narrow down the range"""
+        data = self._get_intraday(base_date='2012-06-07 10:10',
+                                  end_date='2012-06-07 10:20')
+        self.assertEqual(data['objects'], [
+            {'dateTime': '2012-06-07 10:00:00', 'value': sum(range(10, 15))},
+            {'dateTime': '2012-06-07 10:15:00', 'value': sum(range(15, 20))},
+        ])
+        data = self._get_intraday(base_date='2012-06-08', end_date='2012-06-09')
+        self.assertEqual(data['objects'], [])
+
+    def test_functions(self):
+        """The aggregate function can be chosen"""
+        data = self._get_intraday(resolution='1h', function='avg')
+        self.assertEqual(data['objects'][0]['value'], sum(range(30)) / 30.0)
+        data = self._get_intraday(resolution='1h', function='max')
+        self.assertEqual(data['objects'][0]['value'], 29)
+
+    @override_settings(FITAPP_INTRADAY_MAX_POINTS=5)
+    def test_max_points(self):
+        """The number of points returned is capped"""
+        data = self._get_intraday(resolution='1min')
+        self.assertEqual(data['meta']['total_count'], 5)
+        self.assertEqual(data['objects'][-1]['dateTime'], '2012-06-07 10:04:00')
+
+    def test_pages(self):
+        """Intraday data can be retrieved a page at a time"""
+        data = self._get_intraday(resolution='1min', limit=20)
+        self.assertEqual(data['meta']['total_count'], 20)
+        self.assertEqual(data['objects'][-1]['dateTime'], '2012-06-07 10:19:00')
+        data = self._get_intraday(resolution='1min', limit=20,
+                                  cursor=data['meta']['next'])
+        self.assertEqual(data['meta']['total_count'], 10)
+        self.assertEqual(data['objects'][0]['dateTime'], '2012-06-07 10:20:00')
+        self.assertEqual(data['meta']['next'], None)
+
+        data = self._get_intraday(limit=1)
+        self.assertEqual(data['objects'], [
+            {'dateTime': '2012-06-07 10:00:00', 'value': sum(range(15))}])
+        data = self._get_intraday(cursor=data['meta']['next'])
+        self.assertEqual(data['objects'], [
+            {'dateTime': '2012-06-07 10:15:00', 'value': sum(range(15, 30))}])
+        self.assertEqual(data['meta']['next'], None)
+
+    def test_invalid(self):
+        """Status code should be 104 for invalid parameters"""
+        for kwargs in ({'resolution': '2min'}, {'base_date': 'bad'},
+                       {'cursor': 'bad'}, {'limit': 0},
+                       {'base_date': '2012-06-08'}, {'resource': 'weight'},
+                       {'resource': 'bogus'}):
+            data = self._get_intraday(**kwargs)
+            self.assertEqual(data['meta']['status_code'], 104)
+
+
+class TestRetrieveAggregate(FitappTestBase):
+    url_name = 'fitbit-aggregate-data'
+
+    def setUp(self):
+        super(TestRetrieveAggregate, self).setUp()
+        self.steps = TimeSeriesDataType.objects.get(
+            category=TimeSeriesDataType.activities, resource='steps')
+        # Monday 2012-05-28 through Sunday 2012-06-10
+        for day in range(14):
+            TimeSeriesData.objects.create(
+                user=self.user, resource_type=self.steps,
+                date=datetime(2012, 5, 28) + timedelta(days=day),
+                value=str(day + 1))
+        TimeSeriesData.objects.create(
+            user=self.user, resource_type=self.steps,
+            date=datetime(2012, 6, 1, 12), value='1000', intraday=True)
+
+    def _get_aggregate(self, **kwargs):
+        data = {'base_date': '2012-05-01', 'end_date': '2012-06-30',
+                'bucket': 'week'}
+        data.update(kwargs)
+        response = self._get(
+            url_kwargs={'category': 'activities', 'resource': 'steps'},
+            get_kwargs=data)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content.decode('utf8'))
+
+    def test_buckets(self):
+        """Daily data is summed by day, week, month and year"""
+        data = self._get_aggregate(bucket='day')
+        self.assertEqual(data['meta']['total_count'], 14)
+        self.assertEqual(data['objects'][0],
+                         {'dateTime': '2012-05-28', 'value': 1})
+        data = self._get_aggregate(bucket='week')
+        self.assertEqual(data['objects'], [
+            {'dateTime': '2012-05-28', 'value': sum(range(1, 8))},
+            {'dateTime': '2012-06-04', 'value': sum(range(8, 15))},
+        ])
+        data = self._get_aggregate(bucket='month')
+        self.assertEqual(data['objects'], [
+            {'dateTime': '2012-05-01', 'value': sum(range(1, 5))},
+            {'dateTime': '2012-06-01', 'value': sum(range(5, 15))},
+        ])
+        data = self._get_aggregate(bucket='year')
+        self.assertEqual(data['objects'], [
+            {'dateTime': '2012-01-01', 'value': sum(range(1, 15))},
+        ])
+
+    def test_functions(self):
+        """The aggregate function can be chosen"""
+        for function, values in (('avg', [4, 11]), ('min', [1, 8]),
+                                 ('max', [7, 14]), ('sum', [28, 77])):
+            data = self._get_aggregate(function=function)
+            self.assertEqual([d['value'] for d in data['objects']], values)
+
+    def test_period(self):
+        """The date range may be given as a period"""
+        data = self._get_aggregate(base_date='2012-06-04', period='1w',
+                                   end_date='')
+        self.assertEqual(data['objects'], [
+            {'dateTime': '2012-06-04', 'value': sum(range(8, 15))},
+        ])
+
+    def test_invalid(self):
+        """Status code should be 104 for invalid parameters"""
+        for kwargs in ({'bucket': 'hour'}, {'bucket': ''},
+                       {'function': 'median'}, {'end_date': 'bad'}):
+            data = self._get_aggregate(**kwargs)
+            self.assertEqual(data['meta']['status_code'], 104)
+
+    def test_queryset(self):
+        """The aggregation is available as a queryset method"""
+        buckets = TimeSeriesData.objects.filter(
+            user=self.user, resource_type=self.steps
+        ).daily_buckets('week', 'max')
+        self.assertEqual(
+            [(b['bucket'].strftime('%Y-%m-%d'), b['aggregate'])
+             for b in buckets],
+            [('2012-05-28', 7), ('2012-06-04', 14)])
+
+    def test_epoch_bucket_mysql(self):
+        """MySQL epoch buckets don't depend on the session time zone"""
+        query = TimeSeriesData.objects.annotate(
+            bucket=EpochBucket('date', 300)).query
+        sql, params = query.annotations['bucket'].as_mysql(
+            query.get_compiler(using='default'), connection)
+        self.assertIn("TIMESTAMPDIFF(SECOND, '1970-01-01 00:00:00', ", sql)
+        self.assertNotIn('UNIX_TIMESTAMP', sql)
+        self.assertTrue(sql.endswith(') / 300) * 300'))
+
+
+class TestRetrieveSleep(FitappTestBase):
+    url_name = 'fitbit-sleep-data'
+
+    def setUp(self):
+        super(TestRetrieveSleep, self).setUp()
+        for day in (30, 31):
+            summary = SleepStageSummary.objects.create(
+                user=self.user, date=datetime(2017, 1, day))
+            for level in ('wake', 'rem', 'light', 'deep'):
+                SleepTypeData.objects.create(
+                    sleep_summary=summary, level=level, count=1, minute=day)
+        # One sleep stage of each night
+        utils.save_sleep_stages(self.user, [{
+            'dateOfSleep': date_of_sleep,
+            'levels': {'data': [
+                {'dateTime': date, 'level': 'deep', 'seconds': 300}]},
+        } for date_of_sleep, date in (('2017-01-30', '2017-01-29T23:00:00'),
+                                      ('2017-01-31', '2017-01-31T02:00:00'))])
+
+    def _get_sleep(self, status_code=200, headers={}, **kwargs):
+        data = {'base_date': '2017-01-01', 'end_date': '2017-01-31'}
+        data.update(kwargs)
+        response = self._get(get_kwargs=data, **headers)
+        self.assertEqual(response.status_code, status_code)
+        return response
+
+    def test_summaries(self):
+        """Each night's summary is read with one query for all levels"""
+        with self.assertNumQueries(5):
+            # The session, user, ETag validator, summaries and levels
+            response = self._get_sleep()
+        data = json.loads(response.content.decode('utf8'))
+        self.assertEqual(data['meta'], {'total_count': 2, 'status_code': 100})
+        self.assertEqual([night['dateOfSleep'] for night in data['objects']],
+                         ['2017-01-30', '2017-01-31'])
+        self.assertEqual(data['objects'][1]['levels'], {'summary': dict(
+            (level, {'count': 1, 'minutes': 31})
+            for level in ('wake', 'rem', 'light', 'deep'))})
+
+        response = self._get_sleep(end_date='2017-01-30')
+        data = json.loads(response.content.decode('utf8'))
+        self.assertEqual(data['meta']['total_count'], 1)
+
+    def test_stages(self):
+        """Each night's sleep stages can be included"""
+        with self.assertNumQueries(6):
+            response = self._get_sleep(stages='true')
+        data = json.loads(response.content.decode('utf8'))
+        self.assertEqual(
+            [night['levels']['data'] for night in data['objects']], [
+                [{'dateTime': '2017-01-29T23:00:00', 'level': 'deep',
+                  'seconds': 300}],
+                [{'dateTime': '2017-01-31T02:00:00', 'level': 'deep',
+                  'seconds': 300}],
+            ])
+
+    def test_conditional_get(self):
+        """Unchanged data isn't sent again"""
+        etag = self._get_sleep()['ETag']
+        headers = {'HTTP_IF_NONE_MATCH': etag}
+        with self.assertNumQueries(3):
+            # The nights aren't read, only the ETag validator
+            self._get_sleep(status_code=304, headers=headers)
+        self.assertNotEqual(
+            self._get_sleep(stages='true', headers=headers)['ETag'], etag)
+
+        # Saving a changed summary changes the ETag
+        sleep_log = {'dateOfSleep': '2017-01-31', 'levels': {'summary': dict(
+            (level, {'count': 1, 'minutes': 31})
+            for level in ('wake', 'rem', 'light', 'deep'))}}
+        utils.save_sleep_summaries(self.user, [sleep_log])
+        self._get_sleep(status_code=304, headers=headers)
+        sleep_log['levels']['summary']['deep']['minutes'] = 5
+        later = datetime.now() + timedelta(minutes=1)
+        with patch('django.utils.timezone.now', return_value=later):
+            utils.save_sleep_summaries(self.user, [sleep_log])
+        etag = self._get_sleep(headers=headers)['ETag']
+        self.assertNotEqual(etag, headers['HTTP_IF_NONE_MATCH'])
+
+        # So does saving changed sleep stages
+        headers = {'HTTP_IF_NONE_MATCH': etag}
+        later += timedelta(minutes=1)
+        with patch('django.utils.timezone.now', return_value=later):
+            utils.save_sleep_stages(self.user, [{
+                'dateOfSleep': '2017-01-31',
+                'levels': {'data': [{'dateTime': '2017-01-31T02:00:00',
+                                     'level': 'rem', 'seconds': 300}]},
+            }])
+        self.assertNotEqual(self._get_sleep(headers=headers)['ETag'], etag)
+
+    def test_invalid(self):
+        """Invalid dates are rejected"""
+        response = self._get_sleep(base_date='bogus')
+        data = json.loads(response.content.decode('utf8'))
+        self.assertEqual(data['meta']['status_code'], 104)
@@ -1,11 +1,31 @@
+import time
 from collections import OrderedDict
+from datetime import date, datetime, timedelta
 
+from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured
 from django.test import TestCase
 from django.test.utils import override_settings
 from fitbit import Fitbit
+from fitbit.exceptions import HTTPTooManyRequests
+from freezegun import freeze_time
+from mock import Mock, patch
 
-from fitapp.utils import create_fitbit, get_setting
+from fitapp.models import (BackfillCheckpoint, SleepHypnogram,
+                           SleepStageTimeSeriesData, SleepStageSummary,
+                           SleepTypeData, SyncJob, SyncLease,
+                           TimeSeriesDataType, UserFitbit)
+from fitapp.tasks import get_sleep_log, run_sync_jobs
+from fitapp.utils import (create_fitbit, get_setting, parse_sleep_data,
+                          get_all_sleep_log, sweep_sleep_logs, SWEEP_SUCCESS,
+                          SWEEP_DEFERRED, SWEEP_FAILED, get_date_windows,
+                          get_sleep_log_by_date_range, sync_sleep_logs,
+                          get_task_options, queue_sync_job, queue_sync_jobs,
+                          encode_sync_arguments, decode_sync_arguments,
+                          get_cached_fitbit_data, get_live_cache_key,
+                          restart_sync_jobs)
+
+from .base import FitappTestBase
 
 
 class TestFitappUtilities(TestCase):
@@ -71,3 +91,634 @@ class TestFitappUtilities(TestCase):
         subs = get_setting('FITAPP_SUBSCRIPTIONS')
 
         self.assertEqual(subs['activities'], ['steps'])
+
+    @override_settings(FITAPP_TASK_LANES={
+        'backfill': {'queue': 'fitapp-backfill'},
+    })
+    def test_get_task_options(self):
+        """
+        Check that the task options of a lane combine FITAPP_TASK_LANES with
+        the defaults, leaving out options that aren't set
+        """
+        self.assertEqual(get_task_options('backfill'), {
+            'queue': 'fitapp-backfill', 'priority': 0})
+        self.assertEqual(get_task_options('realtime'), {'priority': 9})
+
+
+class TestSaveSleepData(FitappTestBase):
+    """Tests for saving sleep logs in bulk."""
+
+    def _sleep_data(self, level='deep', minutes=30):
+        return {'sleep': [{
+            'dateOfSleep': '2017-01-31',
+            'levels': {
+                'summary': {
+                    'wake': {'count': 2, 'minutes': 10},
+                    'rem': {'count': 1, 'minutes': None},
+                    'light': {'count': 3, 'minutes': 200},
+                    'deep': {'count': 1, 'minutes': minutes},
+                },
+                'data': [
+                    {'dateTime': '2017-01-30T23:00:00.000', 'level': 'light',
+                     'seconds': 600},
+                    {'dateTime': '2017-01-30T23:10:00.000', 'level': level,
+                     'seconds': 300},
+                ],
+            },
+        }]}
+
+    def _stages(self):
+        return list(SleepStageTimeSeriesData.objects.filter(
+            user=self.user).order_by('date').values_list(
+                'date', 'level', 'seconds'))
+
+    def _summary(self):
+        return sorted(SleepTypeData.objects.filter(
+            sleep_summary__user=self.user).values_list(
+                'level', 'count', 'minute'))
+
+    def test_parse_sleep_stages(self):
+        """Sleep stages are created, then updated in place"""
+        parse_sleep_data(self.fbuser, self._sleep_data())
+        self.assertEqual(self._stages(), [
+            (datetime(2017, 1, 30, 23), 'light', 600),
+            (datetime(2017, 1, 30, 23, 10), 'deep', 300),
+        ])
+        # Only the changed night and stage are updated in place: a read and
+        # an update of each, within a savepoint, after the stored night is
+        # read to merge the stages into, and the night's summary is marked
+        # as updated
+        pks = list(SleepStageTimeSeriesData.objects.order_by(
+            'date').values_list('pk', flat=True))
+        with self.assertNumQueries(8):
+            parse_sleep_data(self.fbuser, self._sleep_data(level='rem'))
+        self.assertEqual(list(SleepStageTimeSeriesData.objects.order_by(
+            'date').values_list('pk', flat=True)), pks)
+        self.assertEqual(self._stages(), [
+            (datetime(2017, 1, 30, 23), 'light', 600),
+            (datetime(2017, 1, 30, 23, 10), 'rem', 300),
+        ])
+        self.assertEqual(
+            [(stage.date, stage.level, stage.seconds) for stage in
+             SleepHypnogram.objects.get(user=self.user).decode()],
+            self._stages())
+        # Nothing is written when nothing has changed
+        with self.assertNumQueries(5):
+            parse_sleep_data(self.fbuser, self._sleep_data(level='rem'))
+
+    def test_parse_sleep_stages_merged(self):
+        """The sleep logs of a night saved separately are all kept"""
+        nap = self._sleep_data()
+        nap['sleep'][0]['levels']['data'] = [
+            {'dateTime': '2017-01-31T14:00:00.000', 'level': 'light',
+             'seconds': 900}]
+        parse_sleep_data(self.fbuser, self._sleep_data())
+        parse_sleep_data(self.fbuser, nap)
+        stages = [
+            (datetime(2017, 1, 30, 23), 'light', 600),
+            (datetime(2017, 1, 30, 23, 10), 'deep', 300),
+            (datetime(2017, 1, 31, 14), 'light', 900),
+        ]
+        self.assertEqual(self._stages(), stages)
+        self.assertEqual(
+            [(stage.date, stage.level, stage.seconds) for stage in
+             SleepHypnogram.objects.get(user=self.user).decode()],
+            stages)
+
+    def test_parse_sleep_stages_shifted(self):
+        """The stages of a sleep log saved again replace its stored stages"""
+        parse_sleep_data(self.fbuser, self._sleep_data())
+        # The log was edited so that its stages moved
+        edited = self._sleep_data()
+        edited['sleep'][0]['levels']['data'] = [
+            {'dateTime': '2017-01-30T23:05:00.000', 'level': 'light',
+             'seconds': 300},
+            {'dateTime': '2017-01-30T23:10:00.000', 'level': 'rem',
+             'seconds': 600},
+        ]
+        edited['sleep'][0]['startTime'] = '2017-01-30T23:00:00.000'
+        parse_sleep_data(self.fbuser, edited)
+        stages = [
+            (datetime(2017, 1, 30, 23, 5), 'light', 300),
+            (datetime(2017, 1, 30, 23, 10), 'rem', 600),
+        ]
+        self.assertEqual(self._stages(), stages)
+        self.assertEqual(
+            [(stage.date, stage.level, stage.seconds) for stage in
+             SleepHypnogram.objects.get(user=self.user).decode()],
+            stages)
+
+    def test_parse_sleep_stages_unknown_level(self):
+        """Stages of unknown levels are only saved as rows"""
+        parse_sleep_data(self.fbuser, self._sleep_data(level='unknown'))
+        self.assertEqual(len(self._stages()), 2)
+        self.assertEqual(
+            [stage.level for stage in
+             SleepHypnogram.objects.get(user=self.user).decode()], ['light'])
+
+    @override_settings(FITAPP_SAVE_SLEEP_STAGE_ROWS=False)
+    def test_parse_sleep_stages_hypnogram_only(self):
+        """Sleep stages can be saved only as a hypnogram"""
+        parse_sleep_data(self.fbuser, self._sleep_data())
+        self.assertEqual(self._stages(), [])
+        hypnogram = SleepHypnogram.objects.get(user=self.user)
+        self.assertEqual(hypnogram.date, datetime(2017, 1, 31))
+        self.assertEqual(hypnogram.start, datetime(2017, 1, 30, 23))
+        self.assertEqual(len(hypnogram.data), 18)
+
+    def test_parse_sleep_summary(self):
+        """Sleep summaries are created, then updated in place"""
+        parse_sleep_data(self.fbuser, self._sleep_data(), summary=True)
+        self.assertEqual(self._summary(), [
+            ('deep', 1, 30), ('light', 3, 200), ('rem', 1, 0),
+            ('wake', 2, 10)])
+        parse_sleep_data(self.fbuser, self._sleep_data(minutes=45),
+                         summary=True)
+        self.assertEqual(SleepStageSummary.objects.count(), 1)
+        self.assertEqual(self._summary(), [
+            ('deep', 1, 45), ('light', 3, 200), ('rem', 1, 0),
+            ('wake', 2, 10)])
+        # Nothing is written when nothing has changed
+        with self.assertNumQueries(2):
+            parse_sleep_data(self.fbuser, self._sleep_data(minutes=45),
+                             summary=True)
+
+
+class TestSleepSweep(FitappTestBase):
+    """Tests for getting every user's sleep log."""
+
+    def setUp(self):
+        super(TestSleepSweep, self).setUp()
+        self.date = datetime(2017, 1, 31)
+        self.limited = self.create_userfitbit()
+        self.failing = self.create_userfitbit()
+        self.error = ValueError('bogus')
+
+    def _get_fitbit_sleep_log(self, fbuser, date):
+        if fbuser == self.limited:
+            exc = HTTPTooManyRequests(Mock())
+            exc.retry_after_secs = 21
+            raise exc
+        if fbuser == self.failing:
+            raise self.error
+
+    @patch('fitapp.utils.queue_sync_job')
+    @patch('fitapp.utils.get_fitbit_sleep_log')
+    def test_sweep(self, get_fitbit_sleep_log, queue_sync_job):
+        """Each user's outcome is reported separately"""
+        get_fitbit_sleep_log.side_effect = self._get_fitbit_sleep_log
+        for concurrency in (1, 3):
+            queue_sync_job.reset_mock()
+            results = list(sweep_sleep_logs(self.date, concurrency))
+            self.assertEqual(sorted(results, key=lambda r: r[1]), [
+                (self.limited, SWEEP_DEFERRED, 21),
+                (self.failing, SWEEP_FAILED, self.error),
+                (self.fbuser, SWEEP_SUCCESS, None),
+            ])
+            # The deferred user's sleep log is retrieved once their rate
+            # limit resets
+            queue_sync_job.assert_called_once_with(
+                self.limited.fitbit_user, get_sleep_log,
+                (self.limited.fitbit_user, self.date), lane='maintenance',
+                countdown=21)
+
+    @patch('fitapp.utils.queue_sync_job')
+    @patch('fitapp.utils.get_fitbit_sleep_log')
+    def test_get_all_sleep_log(self, get_fitbit_sleep_log, queue_sync_job):
+        """The number of users of each outcome is returned"""
+        get_fitbit_sleep_log.side_effect = self._get_fitbit_sleep_log
+        self.assertEqual(get_all_sleep_log(self.date), {
+            SWEEP_SUCCESS: 1, SWEEP_DEFERRED: 1, SWEEP_FAILED: 1})
+
+
+class TestSyncJobs(FitappTestBase):
+    """Tests for running each user's sync jobs in turn."""
+
+    def setUp(self):
+        super(TestSyncJobs, self).setUp()
+        self.date = datetime(2017, 1, 31)
+        self.other = self.create_userfitbit()
+        self.sent = []
+        self.synced = []
+
+    def _apply_async(self, args, countdown=None, **options):
+        self.sent.append((args, countdown))
+
+    def _get_fitbit_sleep_log(self, fbuser, date):
+        self.synced.append((fbuser.fitbit_user, date.day))
+
+    def _queue(self, fbuser, day, lane='realtime'):
+        queue_sync_job(fbuser.fitbit_user, get_sleep_log, (
+            fbuser.fitbit_user, datetime(2017, 1, day)), lane=lane)
+
+    def _run_sent(self):
+        while self.sent:
+            args, _ = self.sent.pop(0)
+            run_sync_jobs(*args)
+
+    def test_arguments(self):
+        """Dates survive encoding the arguments of a job"""
+        args, kwargs = decode_sync_arguments(encode_sync_arguments(
+            ('user', self.date), {'date': self.date.date(), 'n': 1}))
+        self.assertEqual(args, ['user', self.date])
+        self.assertEqual(kwargs, {'date': self.date.date(), 'n': 1})
+
+    @patch('fitapp.utils.get_fitbit_sleep_log')
+    @patch('fitapp.tasks.run_sync_jobs.apply_async')
+    def test_round_robin(self, apply_async, get_fitbit_sleep_log):
+        """Users take turns, each running one job at a time"""
+        apply_async.side_effect = self._apply_async
+        get_fitbit_sleep_log.side_effect = self._get_fitbit_sleep_log
+        for day in (1, 2, 3):
+            self._queue(self.fbuser, day)
+        self._queue(self.other, 4)
+        # One task is sent for each user
+        self.assertEqual([(a[0], countdown) for a, countdown in self.sent], [
+            (self.fbuser.fitbit_user, None), (self.other.fitbit_user, None)])
+        self.assertEqual(SyncLease.objects.count(), 2)
+
+        self._run_sent()
+        self.assertEqual(self.synced, [
+            (self.fbuser.fitbit_user, 1), (self.other.fitbit_user, 4),
+            (self.fbuser.fitbit_user, 2), (self.fbuser.fitbit_user, 3)])
+        self.assertEqual(SyncJob.objects.count(), 0)
+        self.assertEqual(SyncLease.objects.count(), 0)
+
+    @patch('fitapp.utils.get_fitbit_sleep_log')
+    @patch('fitapp.tasks.run_sync_jobs.apply_async')
+    def test_priority(self, apply_async, get_fitbit_sleep_log):
+        """A user's jobs in higher priority lanes run first"""
+        apply_async.side_effect = self._apply_async
+        get_fitbit_sleep_log.side_effect = self._get_fitbit_sleep_log
+        self._queue(self.fbuser, 1, lane='backfill')
+        self._queue(self.fbuser, 2, lane='maintenance')
+        self._queue(self.fbuser, 3)
+        self._run_sent()
+        self.assertEqual([day for _, day in self.synced], [3, 2, 1])
+
+    @patch('fitapp.utils.get_fitbit_sleep_log')
+    @patch('fitapp.tasks.run_sync_jobs.apply_async')
+    def test_rate_limited(self, apply_async, get_fitbit_sleep_log):
+        """A rate limited job is kept until the user's rate limit resets"""
+        apply_async.side_effect = self._apply_async
+        exc = HTTPTooManyRequests(Mock())
+        exc.retry_after_secs = 21
+        get_fitbit_sleep_log.side_effect = exc
+        self._queue(self.fbuser, 1)
+        args, _ = self.sent.pop(0)
+        with patch('random.uniform', return_value=2):
+            run_sync_jobs(*args)
+        self.assertEqual(self.sent, [(args, 23)])
+        self.assertEqual(SyncJob.objects.get().started, None)
+        self.assertEqual(SyncLease.objects.count(), 1)
+
+    @patch('fitapp.utils.get_fitbit_sleep_log')
+    @patch('fitapp.tasks.run_sync_jobs.apply_async')
+    def test_collapse(self, apply_async, get_fitbit_sleep_log):
+        """A job that's already pending isn't queued again"""
+        apply_async.side_effect = self._apply_async
+        get_fitbit_sleep_log.side_effect = self._get_fitbit_sleep_log
+        self._queue(self.fbuser, 1, lane='backfill')
+        self._queue(self.fbuser, 2, lane='maintenance')
+        self._queue(self.fbuser, 1)
+        self.assertEqual(SyncJob.objects.count(), 2)
+        self.assertEqual(len(self.sent), 1)
+        self._run_sent()
+        # The collapsed job keeps the higher priority
+        self.assertEqual([day for _, day in self.synced], [1, 2])
+
+    @patch('fitapp.utils.get_fitbit_sleep_log')
+    @patch('fitapp.tasks.run_sync_jobs.apply_async')
+    def test_batch(self, apply_async, get_fitbit_sleep_log):
+        """A batch of jobs is queued in order, sending one task"""
+        apply_async.side_effect = self._apply_async
+        get_fitbit_sleep_log.side_effect = self._get_fitbit_sleep_log
+        self._queue(self.fbuser, 2)
+        queue_sync_jobs(self.fbuser.fitbit_user, get_sleep_log, [
+            (self.fbuser.fitbit_user, datetime(2017, 1, day))
+            for day in (3, 1, 2, 3)])
+        self.assertEqual(SyncJob.objects.count(), 3)
+        self.assertEqual(len(self.sent), 1)
+        self._run_sent()
+        self.assertEqual([day for _, day in self.synced], [2, 3, 1])
+
+    @patch('fitapp.utils.get_fitbit_sleep_log')
+    @patch('fitapp.tasks.run_sync_jobs.apply_async')
+    def test_lease(self, apply_async, get_fitbit_sleep_log):
+        """An expired lease is taken over, and its old holder stops"""
+        apply_async.side_effect = self._apply_async
+        get_fitbit_sleep_log.side_effect = self._get_fitbit_sleep_log
+        self._queue(self.fbuser, 1)
+        old_args, _ = self.sent.pop(0)
+        # The task holding the lease died while running the job, so it
+        # stopped renewing the lease a lease's length after starting it
+        SyncJob.objects.update(
+            started=datetime.now() - timedelta(seconds=301))
+        self._queue(self.fbuser, 2)
+        self.assertEqual(self.sent, [])
+
+        SyncLease.objects.update(expires=datetime.now() - timedelta(seconds=1))
+        self._queue(self.fbuser, 3)
+        self.assertEqual(len(self.sent), 1)
+        self.assertNotEqual(self.sent[0][0], old_args)
+        self.assertEqual(SyncJob.objects.filter(started=None).count(), 3)
+        run_sync_jobs(*old_args)
+        self.assertEqual(self.synced, [])
+        self._run_sent()
+        self.assertEqual([day for _, day in self.synced], [1, 2, 3])
+        self.assertEqual(SyncLease.objects.count(), 0)
+
+    @patch('fitapp.utils.get_fitbit_sleep_log')
+    @patch('fitapp.tasks.run_sync_jobs.apply_async')
+    def test_lease_running_job(self, apply_async, get_fitbit_sleep_log):
+        """A job started since the lease was last renewed isn't run again"""
+        apply_async.side_effect = self._apply_async
+        self._queue(self.fbuser, 1)
+        self.sent.pop(0)
+        SyncJob.objects.update(started=datetime.now())
+        SyncLease.objects.update(expires=datetime.now() - timedelta(seconds=1))
+        self._queue(self.fbuser, 2)
+        self.assertEqual(len(self.sent), 1)
+        self.assertEqual(SyncJob.objects.filter(started=None).count(), 1)
+
+    @patch('fitapp.utils.get_fitbit_sleep_log')
+    @patch('fitapp.tasks.run_sync_jobs.apply_async')
+    def test_restart(self, apply_async, get_fitbit_sleep_log):
+        """The jobs of users whose lease expired are restarted"""
+        apply_async.side_effect = self._apply_async
+        get_fitbit_sleep_log.side_effect = self._get_fitbit_sleep_log
+        self._queue(self.fbuser, 1)
+        self._queue(self.other, 2)
+        # Both tasks died, but only the first user's lease has expired
+        self.sent = []
+        SyncLease.objects.filter(fitbit_user=self.fbuser.fitbit_user).update(
+            expires=datetime.now() - timedelta(seconds=1))
+        self.assertEqual(restart_sync_jobs(), 1)
+        self.assertEqual([a[0] for a, _ in self.sent],
+                         [self.fbuser.fitbit_user])
+        self.assertEqual(restart_sync_jobs(), 0)
+
+        # Jobs left without a lease are restarted too
+        SyncLease.objects.filter(fitbit_user=self.other.fitbit_user).delete()
+        self.assertEqual(restart_sync_jobs(), 1)
+        self._run_sent()
+        self.assertEqual([day for _, day in self.synced], [1, 2])
+        self.assertEqual(SyncLease.objects.count(), 0)
+        self.assertEqual(restart_sync_jobs(), 0)
+
+    @override_settings(FITAPP_SYNC_LEASE_SECONDS=0.3)
+    @patch('fitapp.utils.renew_sync_lease')
+    @patch('fitapp.utils.get_fitbit_sleep_log')
+    @patch('fitapp.tasks.run_sync_jobs.apply_async')
+    def test_heartbeat(self, apply_async, get_fitbit_sleep_log,
+                       renew_sync_lease):
+        """The lease is renewed while a long job runs"""
+        apply_async.side_effect = self._apply_async
+        renew_sync_lease.return_value = True
+        get_fitbit_sleep_log.side_effect = lambda *args: time.sleep(0.35)
+        self._queue(self.fbuser, 1)
+        args, _ = self.sent.pop(0)
+        run_sync_jobs(*args)
+        # Once before the job and at least twice while it ran
+        self.assertGreaterEqual(renew_sync_lease.call_count, 3)
+        self.assertEqual(SyncJob.objects.count(), 0)
+
+    @patch('fitapp.utils.get_fitbit_sleep_log')
+    @patch('fitapp.tasks.run_sync_jobs.apply_async')
+    def test_error(self, apply_async, get_fitbit_sleep_log):
+        """A failed job is dropped and the lease released"""
+        apply_async.side_effect = self._apply_async
+        get_fitbit_sleep_log.side_effect = ValueError
+        self._queue(self.fbuser, 1)
+        self._run_sent()
+        self.assertEqual(SyncJob.objects.count(), 0)
+        self.assertEqual(SyncLease.objects.count(), 0)
+
+
+class TestLiveCache(FitappTestBase):
+    """Tests for caching live responses from Fitbit."""
+
+    def setUp(self):
+        super(TestLiveCache, self).setUp()
+        self.steps = TimeSeriesDataType.objects.get(
+            category=TimeSeriesDataType.activities, resource='steps')
+        self.data = [{'dateTime': '2017-01-31', 'value': '10'}]
+
+    def _get(self, **kwargs):
+        kwargs = kwargs or {'base_date': 'today', 'period': '7d'}
+        return get_cached_fitbit_data(self.fbuser, self.steps, **kwargs)
+
+    def _lock(self):
+        # Another request is retrieving the data
+        key = get_live_cache_key(
+            self.fbuser, self.steps, base_date='today', period='7d')
+        cache.add(key + '-lock', True)
+        return key
+
+    @patch('fitapp.utils.get_fitbit_data')
+    def test_cached(self, get_fitbit_data):
+        """Identical requests are retrieved from Fitbit once"""
+        get_fitbit_data.return_value = self.data
+        self.assertEqual(self._get(), self.data)
+        self.assertEqual(self._get(), self.data)
+        self.assertEqual(get_fitbit_data.call_count, 1)
+        self._get(base_date='today', period='30d')
+        self.assertEqual(get_fitbit_data.call_count, 2)
+
+    @override_settings(FITAPP_LIVE_CACHE_TIMEOUT=0)
+    @patch('fitapp.utils.get_fitbit_data')
+    def test_disabled(self, get_fitbit_data):
+        """Responses aren't cached with a timeout of 0"""
+        get_fitbit_data.return_value = self.data
+        self._get()
+        self._get()
+        self.assertEqual(get_fitbit_data.call_count, 2)
+
+    @patch('time.sleep')
+    @patch('fitapp.utils.get_fitbit_data')
+    def test_single_flight(self, get_fitbit_data, sleep):
+        """Concurrent requests wait for the response of the first one"""
+        key = self._lock()
+        sleep.side_effect = lambda seconds: cache.set(key, self.data)
+        self.assertEqual(self._get(), self.data)
+        self.assertEqual(get_fitbit_data.call_count, 0)
+        self.assertEqual(sleep.call_count, 1)
+
+    @override_settings(FITAPP_LIVE_CACHE_WAIT=0)
+    @patch('fitapp.utils.get_fitbit_data')
+    def test_wait_timeout(self, get_fitbit_data):
+        """Requests stop waiting after FITAPP_LIVE_CACHE_WAIT seconds"""
+        key = self._lock()
+        get_fitbit_data.return_value = self.data
+        self.assertEqual(self._get(), self.data)
+        self.assertEqual(get_fitbit_data.call_count, 1)
+        # The lock of the other request is left alone
+        self.assertTrue(cache.get(key + '-lock'))
+
+
+class TestSleepBackfill(FitappTestBase):
+    """Tests for getting a user's sleep logs over a date range."""
+
+    def setUp(self):
+        super(TestSleepBackfill, self).setUp()
+        self.requested = []
+        self.failing = None
+
+    def _make_request(self, url, *args, **kwargs):
+        start_date, end_date = url.rsplit('/', 2)[1:]
+        end_date = end_date.replace('.json', '')
+        self.requested.append((start_date, end_date))
+        if start_date == self.failing:
+            exc = HTTPTooManyRequests(Mock())
+            exc.retry_after_secs = 21
+            raise exc
+        return {'sleep': [{
+            'dateOfSleep': start_date,
+            'levels': {
+                'summary': {},
+                'data': [{'dateTime': start_date + 'T23:00:00.000',
+                          'level': 'deep', 'seconds': 60}],
+            },
+        }]}
+
+    def _backfill(self, concurrency=1):
+        with patch.object(Fitbit, 'make_request') as make_request:
+            make_request.side_effect = self._make_request
+            get_sleep_log_by_date_range(
+                self.fbuser, datetime(2017, 1, 1), datetime(2017, 9, 7),
+                concurrency=concurrency)
+
+    def _saved(self):
+        return sorted(SleepStageSummary.objects.filter(
+            user=self.user).values_list('date', flat=True))
+
+    def test_get_date_windows(self):
+        """Date ranges are split into windows of at most the given days"""
+        windows = get_date_windows(date(2017, 1, 1), date(2017, 1, 7), 3)
+        self.assertEqual(windows, [
+            (date(2017, 1, 1), date(2017, 1, 3)),
+            (date(2017, 1, 4), date(2017, 1, 6)),
+            (date(2017, 1, 7), date(2017, 1, 7)),
+        ])
+        self.assertEqual(
+            get_date_windows(date(2017, 1, 2), date(2017, 1, 1), 3), [])
+
+    def test_backfill(self):
+        """Each window of up to 100 days is requested and saved"""
+        for concurrency in (1, 3):
+            self.requested = []
+            BackfillCheckpoint.objects.all().delete()
+            self._backfill(concurrency)
+            self.assertEqual(sorted(self.requested), [
+                ('2017-01-01', '2017-04-10'),
+                ('2017-04-11', '2017-07-19'),
+                ('2017-07-20', '2017-09-07'),
+            ])
+            self.assertEqual(self._saved(), [
+                datetime(2017, 1, 1), datetime(2017, 4, 11),
+                datetime(2017, 7, 20)])
+            self.assertEqual(SleepStageTimeSeriesData.objects.count(), 3)
+            self.assertEqual(BackfillCheckpoint.objects.filter(
+                user=self.user, resource='sleep').count(), 3)
+
+    def test_backfill_resume(self):
+        """An interrupted backfill resumes from the first unsaved window"""
+        self.failing = '2017-04-11'
+        self.assertRaises(HTTPTooManyRequests, self._backfill)
+        # No more windows are requested after an error
+        self.assertEqual(self.requested, [
+            ('2017-01-01', '2017-04-10'), ('2017-04-11', '2017-07-19')])
+        self.assertEqual(self._saved(), [datetime(2017, 1, 1)])
+
+        self.requested = []
+        self.failing = None
+        self._backfill()
+        self.assertEqual(self.requested, [
+            ('2017-04-11', '2017-07-19'), ('2017-07-20', '2017-09-07')])
+        self.assertEqual(self._saved(), [
+            datetime(2017, 1, 1), datetime(2017, 4, 11),
+            datetime(2017, 7, 20)])
+
+    @freeze_time('2017-09-07')
+    def test_backfill_today(self):
+        """A window that ends today is saved without a checkpoint"""
+        for concurrency in (1, 3):
+            self._backfill(concurrency)
+            self.assertEqual(list(BackfillCheckpoint.objects.filter(
+                user=self.user, resource='sleep',
+            ).order_by('base_date').values_list('end_date', flat=True)), [
+                date(2017, 4, 10), date(2017, 7, 19)])
+        # So it's requested again
+        self.assertEqual(self.requested[3:], [('2017-07-20', '2017-09-07')])
+
+
+class TestSleepSync(FitappTestBase):
+    """Tests for syncing a user's sleep logs incrementally."""
+
+    def _log(self, log_id, date):
+        return {
+            'logId': log_id,
+            'dateOfSleep': date,
+            'startTime': date + 'T01:00:00.000',
+            'type': 'stages',
+            'levels': {
+                'summary': {'deep': {'count': 1, 'minutes': 60}},
+                'data': [{'dateTime': date + 'T01:00:00.000',
+                          'level': 'deep', 'seconds': 3600}],
+            },
+        }
+
+    def _sync(self, pages, **kwargs):
+        self.requests = []
+
+        def make_request(url, params=None):
+            self.requests.append((url, params))
+            return pages.pop(0)
+
+        with patch.object(Fitbit, 'make_request') as mock_make_request:
+            mock_make_request.side_effect = make_request
+            return sync_sleep_logs(self.fbuser, **kwargs)
+
+    def test_sync(self):
+        """New sleep logs are saved a page at a time"""
+        next_url = 'https://api.fitbit.com/1.2/user/-/sleep/list.json?offset=2'
+        count = self._sync([
+            {'sleep': [self._log(1, '2017-01-30'), self._log(2, '2017-01-31')],
+             'pagination': {'next': next_url}},
+            {'sleep': [self._log(3, '2017-02-01')],
+             'pagination': {'next': ''}},
+        ])
+        self.assertEqual(count, 3)
+        self.assertEqual(self.requests, [
+            ('https://api.fitbit.com/1.2/user/-/sleep/list.json', {
+                'afterDate': '2009-01-01T00:00:00', 'sort': 'asc',
+                'offset': 0, 'limit': 100}),
+            (next_url, None),
+        ])
+        self.assertEqual(SleepStageSummary.objects.count(), 3)
+        self.fbuser = UserFitbit.objects.get(pk=self.fbuser.pk)
+        self.assertEqual(self.fbuser.last_sleep_log_id, 3)
+        self.assertEqual(self.fbuser.last_sleep_start,
+                         datetime(2017, 2, 1, 1))
+
+        # The next sync starts from the newest sleep log
+        count = self._sync([{
+            'sleep': [self._log(3, '2017-02-01'), self._log(4, '2017-02-02')],
+            'pagination': {'next': ''},
+        }])
+        self.assertEqual(count, 1)
+        self.assertEqual(self.requests[0][1]['afterDate'],
+                         '2017-02-01T01:00:00')
+        self.assertEqual(SleepStageSummary.objects.count(), 4)
+        self.assertEqual(SleepStageTimeSeriesData.objects.count(), 4)
+
+    def test_sync_start(self):
+        """The first sync starts from the newest saved sleep summary"""
+        SleepStageSummary.objects.create(user=self.user, date='2017-01-15')
+        self._sync([{'sleep': [], 'pagination': {'next': ''}}])
+        self.assertEqual(self.requests[0][1]['afterDate'],
+                         '2017-01-15T00:00:00')
+        self._sync([{'sleep': [], 'pagination': {'next': ''}}],
+                   after_date=datetime(2016, 1, 1))
+        self.assertEqual(self.requests[0][1]['afterDate'],
+                         '2016-01-01T00:00:00')
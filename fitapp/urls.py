@@ -16,5 +16,11 @@ urlpatterns = [
     # Fitbit data retrieval
     url(r'^get_data/(?P<category>[\w]+)/(?P<resource>[/\w]+)/$',
         views.get_data, name='fitbit-data'),
+    url(r'^get_batch_data/$', views.get_batch_data, name='fitbit-batch-data'),
+    url(r'^get_intraday_data/(?P<category>[\w]+)/(?P<resource>[/\w]+)/$',
+        views.get_intraday_data, name='fitbit-intraday-data'),
+    url(r'^get_aggregate_data/(?P<category>[\w]+)/(?P<resource>[/\w]+)/$',
+        views.get_aggregate_data, name='fitbit-aggregate-data'),
+    url(r'^get_sleep_data/$', views.get_sleep_data, name='fitbit-sleep-data'),
     url(r'^get_steps/$', views.get_steps, name='fitbit-steps')
 ]
@@ -1,14 +1,84 @@
-import sys
+import hashlib
+import json
+import logging
+import threading
+import time
+import uuid
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from multiprocessing.pool import ThreadPool
 
+from dateutil import parser
+from dateutil.relativedelta import relativedelta
 from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, connection, transaction
+from django.db.models import BooleanField, Case, Value, When
+from django.utils import six, timezone
 
 from fitbit import Fitbit
-from fitbit.exceptions import HTTPBadRequest, HTTPTooManyRequests, HTTPUnauthorized
+from fitbit.exceptions import HTTPTooManyRequests, HTTPUnauthorized
 
 from . import defaults
-from .models import UserFitbit, TimeSeriesDataType, SleepStageTimeSeriesData,\
-    SleepStageSummary, SleepTypeData
+from .models import UserFitbit, TimeSeriesData, TimeSeriesDataType,\
+    SleepStageTimeSeriesData, SleepStageSummary, SleepTypeData,\
+    BackfillCheckpoint, SleepHypnogram, SyncWatermark, SyncJob, SyncLease
+
+logger = logging.getLogger(__name__)
+
+# The number of rows to write in each INSERT or DELETE statement
+BATCH_SIZE = 500
+# The number of rows to change in each UPDATE statement, which has a
+# parameter for each value as well as each row, to stay within SQLite's limit
+UPDATE_BATCH_SIZE = 100
+# The types binary data can be read from the database as
+BUFFER_TYPES = (memoryview,) + ((buffer,) if six.PY2 else ())
+
+# The outcomes of getting a user's sleep log in a sweep over every user
+SWEEP_SUCCESS = 'success'
+SWEEP_DEFERRED = 'deferred'
+SWEEP_FAILED = 'failed'
+
+# The resource name of sleep logs in backfill checkpoints
+SLEEP_RESOURCE = 'sleep'
+# The most days of sleep logs the Fitbit API returns in one request
+SLEEP_RANGE_MAX_DAYS = 100
+# The most sleep logs the Fitbit API lists in one request
+SLEEP_LIST_PAGE_SIZE = 100
+# Sleep logs are listed from here when a user has never been synced, no
+# sleep logs are older than Fitbit's first trackers
+SLEEP_LIST_START = datetime(2009, 1, 1)
+
+# No Fitbit data is older than this date
+HISTORY_START = SLEEP_LIST_START.date()
+
+# The cache key of a user's Fitbit profile, by the pk of the user
+PROFILE_CACHE_KEY = 'fitapp-profile-{0}'
+# The fields of a user's Fitbit profile kept in their session
+SESSION_PROFILE_FIELDS = ('timezone', 'displayName')
+
+# The cache key of whether a user is integrated, by the pk of the user
+INTEGRATED_CACHE_KEY = 'fitapp-integrated-{0}'
+# The attribute annotate_integrated sets on users
+INTEGRATED_ATTR = 'fitbit_integrated'
+# The attribute of a user whether they're integrated is remembered in, with
+# the number of times integration statuses had changed in this process then
+INTEGRATED_MEMO_ATTR = '_fitbit_integrated_memo'
+_integration_changes = [0]
+
+# The cache key of a live response from Fitbit, by the Fitbit user ID and a
+# hash of the resource and date arguments
+LIVE_CACHE_KEY = 'fitapp-live-{0}-{1}'
+# The number of seconds between checks for a live response another request
+# is retrieving
+LIVE_CACHE_POLL = 0.1
+
+# The cache key marking a gap of a user's time series data as just read
+# through, by the pk of the user and resource type and the end of the gap
+READ_THROUGH_CACHE_KEY = 'fitapp-read-through-{0}-{1}-{2}'
 
 
 def create_fitbit(consumer_key=None, consumer_secret=None, **kwargs):
@@ -38,9 +108,56 @@ def is_integrated(user):
 
     This does not require that the token and secret are valid.
 
+    The status is cached for ``FITAPP_INTEGRATION_CACHE_TIMEOUT`` seconds,
+    until the user's :py:class:`fitapp.models.UserFitbit` is saved or
+    deleted, and is remembered on the user object itself until a UserFitbit
+    is saved or deleted, so it's looked up at most once a request. Users from
+    :py:func:`annotate_integrated` don't need to be looked up at all.
+
     :param user: A Django User.
     """
-    return UserFitbit.objects.filter(user=user).exists()
+    integrated = getattr(user, INTEGRATED_ATTR, None)
+    if integrated is not None:
+        # Some databases annotate booleans as integers
+        return bool(integrated)
+    if user.pk is None:
+        return False
+    memo = getattr(user, INTEGRATED_MEMO_ATTR, None)
+    if memo is not None and memo[0] == _integration_changes[0]:
+        return memo[1]
+    key = INTEGRATED_CACHE_KEY.format(user.pk)
+    integrated = cache.get(key)
+    if integrated is None:
+        integrated = UserFitbit.objects.filter(user=user).exists()
+        cache.set(key, integrated,
+                  get_setting('FITAPP_INTEGRATION_CACHE_TIMEOUT'))
+    setattr(user, INTEGRATED_MEMO_ATTR, (_integration_changes[0], integrated))
+    return integrated
+
+
+def annotate_integrated(queryset):
+    """
+    Annotate a queryset of users with whether they're integrated with
+    Fitbit, in the same query, for :py:func:`is_integrated` and the
+    :ref:`is_integrated_with_fitbit` filter. Use it for pages that list many
+    users::
+
+        users = annotate_integrated(User.objects.all())
+
+    :param queryset: A queryset of Django Users.
+    """
+    return queryset.annotate(**{INTEGRATED_ATTR: Case(
+        When(userfitbit__isnull=False, then=Value(True)),
+        default=Value(False), output_field=BooleanField())})
+
+
+def clear_integration_cache(user_pk):
+    """
+    Forget the cached integration status of a user, and the statuses
+    remembered on user objects in this process, such as ``request.user``.
+    """
+    cache.delete(INTEGRATED_CACHE_KEY.format(user_pk))
+    _integration_changes[0] += 1
 
 
 def get_valid_periods():
@@ -48,6 +165,33 @@ def get_valid_periods():
     return ['1d', '7d', '30d', '1w', '1m', '3m', '6m', '1y', 'max']
 
 
+def get_valid_resolutions():
+    """
+    Returns a dict of the resolutions for which one may request intraday time
+    series data, mapped to the size of each resolution in seconds.
+    """
+    return {'1min': 60, '15min': 60 * 15, '1h': 60 * 60}
+
+
+def encode_cursor(date):
+    """
+    Encode the date of the last item of a page of data as an opaque cursor
+    that can be used to request the next page.
+    """
+    return urlsafe_b64encode(date.isoformat().encode('utf8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor created by :py:func:`encode_cursor`, returning the date it
+    holds. Raises ValueError if the cursor is invalid.
+    """
+    try:
+        return parser.parse(urlsafe_b64decode(str(cursor)).decode('utf8'))
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError('Invalid cursor: {}'.format(cursor))
+
+
 def get_fitbit_data(fbuser, resource_type, base_date=None, period=None,
                     end_date=None, return_all=False):
     """Creates a Fitbit API instance and retrieves step data for the period.
@@ -76,19 +220,302 @@ def get_fitbit_data(fbuser, resource_type, base_date=None, period=None,
     return data[resource_path.replace('/', '-')]
 
 
+def get_live_cache_key(fbuser, resource_type, **kwargs):
+    """
+    Return the cache key of the response to a request for time series data,
+    see :py:func:`get_cached_fitbit_data`.
+    """
+    arguments = repr((resource_type.path(), sorted(kwargs.items())))
+    return LIVE_CACHE_KEY.format(
+        fbuser.fitbit_user, hashlib.md5(arguments.encode('utf8')).hexdigest())
+
+
+def get_cached_fitbit_data(fbuser, resource_type, **kwargs):
+    """
+    Retrieve time series data like :py:func:`get_fitbit_data`, caching the
+    response for ``FITAPP_LIVE_CACHE_TIMEOUT`` seconds. While one request
+    retrieves the data, identical requests wait up to
+    ``FITAPP_LIVE_CACHE_WAIT`` seconds for its response instead of making
+    their own request to Fitbit. Errors aren't cached.
+    """
+    timeout = get_setting('FITAPP_LIVE_CACHE_TIMEOUT')
+    if not timeout:
+        return get_fitbit_data(fbuser, resource_type, **kwargs)
+    key = get_live_cache_key(fbuser, resource_type, **kwargs)
+    data = cache.get(key)
+    if data is not None:
+        return data
+
+    wait = get_setting('FITAPP_LIVE_CACHE_WAIT')
+    lock_id = key + '-lock'
+    deadline = time.time() + wait
+    locked = cache.add(lock_id, True, wait)
+    while not locked and time.time() < deadline:
+        # Another request is retrieving the data, wait for its response
+        time.sleep(LIVE_CACHE_POLL)
+        data = cache.get(key)
+        if data is not None:
+            return data
+        locked = cache.add(lock_id, True, wait)
+    try:
+        data = get_fitbit_data(fbuser, resource_type, **kwargs)
+        cache.set(key, data, timeout)
+    finally:
+        if locked:
+            cache.delete(lock_id)
+    return data
+
+
 def get_fitbit_profile(fbuser, key=None):
     """
-    Creates a Fitbit API instance and retrieves a user's profile.
+    Creates a Fitbit API instance and retrieves a user's profile. The profile
+    is saved in the cache, for :py:func:`get_cached_profile`.
     """
     fb = create_fitbit(**fbuser.get_user_data())
     data = fb.user_profile_get()
 
     data = data['user']
+    cache.set(PROFILE_CACHE_KEY.format(fbuser.user_id), data,
+              get_setting('FITAPP_PROFILE_CACHE_TIMEOUT'))
     if key:
         return data[key]
     return data
 
 
+def get_cached_profile(user, key=None):
+    """
+    Return a user's Fitbit profile, or one of its fields, from the cache
+    without a request to Fitbit. Returns ``None`` if the profile isn't
+    cached, see :py:func:`fitapp.tasks.update_fitbit_profile`.
+
+    :param user: A Django User, or its pk.
+    """
+    data = cache.get(PROFILE_CACHE_KEY.format(getattr(user, 'pk', user)))
+    if data is not None and key:
+        return data.get(key)
+    return data
+
+
+def get_session_profile(profile):
+    """
+    Return the fields of a Fitbit profile that are kept in the session, see
+    ``SESSION_PROFILE_FIELDS``. The profile may also be the whole response of
+    Fitbit's profile API, which older versions kept in the session.
+    """
+    profile = profile.get('user', profile)
+    return dict((field, profile.get(field))
+                for field in SESSION_PROFILE_FIELDS)
+
+
+def _normalize_date(date):
+    """
+    Make a datetime aware when time zone support is enabled, otherwise make
+    it naive (in UTC), so that it can be compared to the dates read from the
+    database.
+    """
+    if settings.USE_TZ and timezone.is_naive(date):
+        return timezone.make_aware(date, timezone.get_default_timezone())
+    elif not settings.USE_TZ and timezone.is_aware(date):
+        return timezone.make_naive(date, timezone.utc)
+    return date
+
+
+def _python_value(value):
+    # Binary data is read from some databases as a buffer
+    if isinstance(value, BUFFER_TYPES):
+        return six.binary_type(value)
+    return value
+
+
+def _bulk_upsert(queryset, key, rows, replaced=None, **fields):
+    """
+    Create or update rows of the queryset's model in bulk, matching them to
+    existing rows on the *key* field.
+
+    The existing rows are read in one query, then any that have changed are
+    updated in place, a batch per UPDATE statement, so that they keep their
+    primary keys, and the new rows are inserted in batches, all in one
+    transaction. Rows that haven't changed aren't written at all.
+
+    :param queryset: A queryset that includes any existing rows for the keys.
+    :param key: The name of the field the rows are matched on.
+    :param rows: A dict of keys mapped to dicts of the other values to store.
+    :param replaced: A function of a key that returns whether an existing
+        row that isn't in *rows* is replaced by them, and so is deleted.
+    :param fields: Values of fields that are the same for every row.
+
+    Returns a list of the keys of the rows that were created or updated.
+    """
+    if not rows:
+        return []
+    model = queryset.model
+    names = list(next(iter(rows.values())))
+    existing = dict((row[key], row) for row in
+                    queryset.order_by().values('pk', key, *names))
+    changed = dict((value, (row['pk'], rows[value]))
+                   for value, row in existing.items()
+                   if value in rows and any(
+                       rows[value][name] != _python_value(row[name])
+                       for name in names))
+    stale = [row['pk'] for value, row in existing.items()
+             if value not in rows and replaced is not None and
+             replaced(value)]
+    objs = [
+        model(**dict(values, **dict(fields, **{key: value})))
+        for value, values in rows.items() if value not in existing
+    ]
+    written = list(changed) + [getattr(obj, key) for obj in objs]
+    if not written and not stale:
+        return written
+    changed = list(changed.values())
+    db = transaction.get_connection(queryset.db)
+    with transaction.atomic(using=queryset.db, savepoint=False):
+        for i in range(0, len(stale), BATCH_SIZE):
+            model.objects.filter(pk__in=stale[i:i + BATCH_SIZE]).delete()
+        for i in range(0, len(changed), UPDATE_BATCH_SIZE):
+            batch = changed[i:i + UPDATE_BATCH_SIZE]
+            updates = {}
+            for name in names:
+                field = model._meta.get_field(name)
+                updates[name] = Case(*[
+                    When(pk=pk, then=Value(
+                        field.get_db_prep_save(values[name], db)))
+                    for pk, values in batch], output_field=field)
+            model.objects.filter(
+                pk__in=[pk for pk, _ in batch]).update(**updates)
+        model.objects.bulk_create(objs, batch_size=BATCH_SIZE)
+    return written
+
+
+def save_time_series_data(user, resource_type, data, intraday=False):
+    """
+    Create or update a user's time series data in bulk, reading the existing
+    data over the range of dates in one query and only writing the values
+    that are new or have changed.
+
+    :param user: The user the data belongs to.
+    :param resource_type: A TimeSeriesDataType instance.
+    :param data: An iterable of ``(date, value)`` pairs, where date is a
+        datetime. Intraday dates should be in UTC.
+    :param intraday: Whether the data is intraday data.
+    """
+    rows = dict(
+        (_normalize_date(date), {'value': None if value is None else str(value)})
+        for date, value in data)
+    if not rows:
+        return
+    queryset = TimeSeriesData.objects.filter(
+        user=user, resource_type=resource_type, intraday=intraday,
+        date__gte=min(rows), date__lte=max(rows))
+    _bulk_upsert(queryset, 'date', rows, user=user,
+                 resource_type=resource_type, intraday=intraday)
+
+
+def get_sync_watermark(user, resource_type, intraday=False):
+    """
+    Return the newest fully synced date of a user's time series data, or
+    ``None`` if it has never been synced.
+    """
+    return SyncWatermark.objects.filter(
+        user=user, resource_type=resource_type, intraday=intraday,
+    ).values_list('date', flat=True).first()
+
+
+def update_sync_watermark(user, resource_type, synced_date, intraday=False):
+    """
+    Move the watermark of a user's time series data forward to
+    ``synced_date``. Today isn't over, so it isn't fully synced yet and the
+    watermark is moved to yesterday at most. The watermark is never moved
+    backwards.
+    """
+    synced_date = min(synced_date, date.today() - timedelta(days=1))
+    updated = SyncWatermark.objects.filter(
+        user=user, resource_type=resource_type, intraday=intraday,
+        date__lt=synced_date,
+    ).update(date=synced_date)
+    if not updated:
+        SyncWatermark.objects.get_or_create(
+            user=user, resource_type=resource_type, intraday=intraday,
+            defaults={'date': synced_date})
+
+
+def read_through_time_series(fbuser, resource_type, start_date, end_date=None):
+    """
+    Retrieve the days of a user's time series data from ``start_date`` to
+    ``end_date`` (today by default) that are newer than its sync watermark,
+    and save them, so the stored data is up to date over the range. The gap
+    is retrieved with one request, at most once every
+    ``FITAPP_READ_THROUGH_MAX_AGE`` seconds. Returns the number of days
+    retrieved.
+
+    Only the ``FITAPP_BACKFILL_RECENT_DAYS`` most recent days of a longer gap
+    are retrieved right away, the rest is queued as a backfill job, so that a
+    wide range doesn't make many requests while the user waits.
+
+    The watermark is moved forward when the retrieved days follow on from it.
+
+    :param fbuser: The user's UserFitbit.
+    :param resource_type: A TimeSeriesDataType instance.
+    :param start_date: The first date of the range.
+    :param end_date: The last date of the range.
+    """
+    from .tasks import backfill_time_series_data
+
+    today = date.today()
+    end_date = min(end_date or today, today)
+    watermark = get_sync_watermark(fbuser.user, resource_type)
+    if watermark is not None:
+        start_date = max(start_date, watermark + timedelta(days=1))
+    if start_date > end_date:
+        return 0
+    # The start of the gap moves forward with the watermark, so only its end
+    # identifies it
+    key = READ_THROUGH_CACHE_KEY.format(
+        fbuser.user_id, resource_type.pk, end_date)
+    if not cache.add(key, True, get_setting('FITAPP_READ_THROUGH_MAX_AGE')):
+        return 0
+    base_date = max(start_date, end_date - timedelta(
+        days=get_setting('FITAPP_BACKFILL_RECENT_DAYS') - 1))
+    if base_date > start_date:
+        queue_sync_job(
+            fbuser.fitbit_user, backfill_time_series_data,
+            (fbuser.fitbit_user, resource_type.category,
+             resource_type.resource, start_date.strftime('%Y-%m-%d')),
+            lane='backfill')
+    try:
+        data = get_fitbit_data(fbuser, resource_type, base_date=base_date,
+                               end_date=end_date)
+    except Exception:
+        # Try again on the next request
+        cache.delete(key)
+        raise
+    rows = [(parser.parse(datum['dateTime']), datum['value'])
+            for datum in data]
+    with transaction.atomic():
+        save_time_series_data(fbuser.user, resource_type, rows)
+        if rows and watermark is not None and \
+                base_date == watermark + timedelta(days=1):
+            update_sync_watermark(
+                fbuser.user, resource_type, max(rows)[0].date())
+    return len(rows)
+
+
+def get_sync_dates(user, resource_type):
+    """
+    Return the date arguments of :py:func:`get_fitbit_data` to sync a user's
+    time series data. Data that has been synced before is retrieved from
+    ``FITAPP_SYNC_OVERLAP_DAYS`` days before its watermark until today, so
+    data a device synced late is still updated, otherwise the whole
+    ``FITAPP_DEFAULT_PERIOD`` is retrieved.
+    """
+    watermark = get_sync_watermark(user, resource_type)
+    if watermark is None:
+        period = get_setting('FITAPP_DEFAULT_PERIOD') or 'max'
+        return {'base_date': 'today', 'period': period}
+    overlap = timedelta(days=get_setting('FITAPP_SYNC_OVERLAP_DAYS'))
+    return {'base_date': watermark - overlap, 'end_date': 'today'}
+
+
 def get_setting(name, use_defaults=True):
     """Retrieves the specified setting from the settings file.
 
@@ -105,6 +532,225 @@ def get_setting(name, use_defaults=True):
     raise ImproperlyConfigured(msg)
 
 
+def get_task_options(lane):
+    """
+    Return the ``apply_async`` options of a lane of tasks, the queue and
+    priority configured for it in ``FITAPP_TASK_LANES``.
+
+    :param lane: 'realtime', 'backfill', 'intraday' or 'maintenance'.
+    """
+    options = dict(defaults.FITAPP_TASK_LANES[lane])
+    options.update(get_setting('FITAPP_TASK_LANES').get(lane, {}))
+    return dict((key, value) for key, value in options.items()
+                if value is not None)
+
+
+def _encode_json_value(value):
+    if isinstance(value, datetime):
+        return {'__datetime__': value.isoformat()}
+    if isinstance(value, date):
+        return {'__date__': value.isoformat()}
+    raise TypeError('{!r} is not JSON serializable'.format(value))
+
+
+def _decode_json_value(obj):
+    if '__datetime__' in obj:
+        return parser.parse(obj['__datetime__'])
+    if '__date__' in obj:
+        return parser.parse(obj['__date__']).date()
+    return obj
+
+
+def encode_sync_arguments(args, kwargs):
+    """Encode the arguments of a sync job as JSON, dates included."""
+    return json.dumps([list(args), kwargs], default=_encode_json_value)
+
+
+def decode_sync_arguments(arguments):
+    """
+    Decode the arguments encoded by :py:func:`encode_sync_arguments`,
+    returning the positional and keyword arguments.
+    """
+    args, kwargs = json.loads(arguments, object_hook=_decode_json_value)
+    return args, kwargs
+
+
+def queue_sync_job(fitbit_user, task, args=(), kwargs=None, lane='realtime',
+                   countdown=None):
+    """
+    Queue a task that syncs a user's data as a SyncJob.
+
+    A user's jobs are run one at a time, highest priority first, by
+    :py:func:`fitapp.tasks.run_sync_jobs`, which sends itself again after
+    each job so that it takes turns with the jobs of other users. Users with
+    a lot of data to sync then can't hold up the syncs of everyone else.
+
+    A job that is the same as one of the user's jobs that hasn't started yet
+    isn't queued again, since the queued job gets the latest data when it
+    runs. Its priority is raised to the lane's if that is higher.
+
+    :param fitbit_user: The Fitbit user ID of the user.
+    :param task: The Celery task to run.
+    :param args: The positional arguments of the task.
+    :param kwargs: The keyword arguments of the task.
+    :param lane: The lane of ``FITAPP_TASK_LANES`` to run the job in, which
+        also sets its priority.
+    :param countdown: The number of seconds to wait before running the
+        user's jobs, if they aren't being run already.
+    """
+    queue_sync_jobs(fitbit_user, task, [args], kwargs, lane=lane,
+                    countdown=countdown)
+
+
+def queue_sync_jobs(fitbit_user, task, args_list, kwargs=None,
+                    lane='realtime', countdown=None):
+    """
+    Queue a batch of jobs of the same task for a user, like
+    :py:func:`queue_sync_job`, with one job for each item of ``args_list``
+    and the same keyword arguments for all of them.
+
+    The jobs are saved with one query and the task that runs them is sent at
+    most once, however many jobs there are, so views that fan out to many
+    resources don't make a round trip to the broker for each of them.
+    """
+    arguments = []
+    for args in args_list:
+        encoded = encode_sync_arguments(args, kwargs or {})
+        if encoded not in arguments:
+            arguments.append(encoded)
+    if not arguments:
+        return
+    priority = get_task_options(lane).get('priority', 0)
+    queued = SyncJob.objects.filter(
+        fitbit_user=fitbit_user, task=task.name, arguments__in=arguments,
+        started__isnull=True)
+    queued.filter(priority__lt=priority).update(lane=lane, priority=priority)
+    queued = set(queued.values_list('arguments', flat=True))
+    SyncJob.objects.bulk_create([
+        SyncJob(fitbit_user=fitbit_user, task=task.name, arguments=encoded,
+                lane=lane, priority=priority)
+        for encoded in arguments if encoded not in queued
+    ])
+    start_sync_jobs(fitbit_user, countdown=countdown)
+
+
+def get_next_sync_job(fitbit_user):
+    """Return the next SyncJob of a user to run, or ``None``."""
+    return SyncJob.objects.filter(
+        fitbit_user=fitbit_user).order_by('-priority', 'pk').first()
+
+
+def _lease_expiry(countdown=None):
+    return timezone.now() + timedelta(
+        seconds=(countdown or 0) + get_setting('FITAPP_SYNC_LEASE_SECONDS'))
+
+
+def start_sync_jobs(fitbit_user, countdown=None):
+    """
+    Send the task that runs a user's sync jobs, unless another task holds the
+    user's SyncLease. The task is given a new lease, or the expired lease of
+    a task that died. Returns ``True`` if the task was sent.
+    """
+    owner = uuid.uuid4().hex
+    try:
+        with transaction.atomic():
+            SyncLease.objects.create(
+                fitbit_user=fitbit_user, owner=owner,
+                expires=_lease_expiry(countdown))
+    except IntegrityError:
+        taken = SyncLease.objects.filter(
+            fitbit_user=fitbit_user, expires__lt=timezone.now(),
+        ).update(owner=owner, expires=_lease_expiry(countdown))
+        if not taken:
+            return False
+        # Jobs that were running when the task died are run again. The task
+        # renews its lease while a job runs, so they were started before the
+        # lease was last renewed, at least a lease's length ago.
+        SyncJob.objects.filter(
+            fitbit_user=fitbit_user, started__lt=timezone.now() - timedelta(
+                seconds=get_setting('FITAPP_SYNC_LEASE_SECONDS')),
+        ).update(started=None)
+    continue_sync_jobs(fitbit_user, owner, countdown=countdown)
+    return True
+
+
+def restart_sync_jobs():
+    """
+    Start the sync jobs of the users who still have jobs queued but whose
+    task died, or whose task message was lost, so that their SyncLease has
+    expired or was never taken. Without this their jobs wait for the next
+    job to be queued for them. Returns the number of users restarted.
+    """
+    held = SyncLease.objects.filter(expires__gte=timezone.now())
+    fitbit_users = SyncJob.objects.exclude(
+        fitbit_user__in=held.values_list('fitbit_user', flat=True),
+    ).values_list('fitbit_user', flat=True).distinct().order_by('fitbit_user')
+    return len([u for u in fitbit_users if start_sync_jobs(u)])
+
+
+def renew_sync_lease(fitbit_user, owner):
+    """
+    Renew a user's SyncLease for another ``FITAPP_SYNC_LEASE_SECONDS``,
+    returning ``False`` if it's no longer held by ``owner``.
+    """
+    return bool(SyncLease.objects.filter(
+        fitbit_user=fitbit_user, owner=owner,
+    ).update(expires=_lease_expiry()))
+
+
+@contextmanager
+def sync_lease_heartbeat(fitbit_user, owner):
+    """
+    Renew a user's SyncLease from a thread every third of
+    ``FITAPP_SYNC_LEASE_SECONDS`` while the body of the ``with`` statement
+    runs, so that the lease of a task that's running a long job doesn't
+    expire and get taken over.
+    """
+    stop = threading.Event()
+    interval = get_setting('FITAPP_SYNC_LEASE_SECONDS') / 3.0
+
+    def beat():
+        try:
+            while not stop.wait(interval):
+                if not renew_sync_lease(fitbit_user, owner):
+                    break
+        finally:
+            # The thread has its own connection to the database
+            connection.close()
+
+    thread = threading.Thread(target=beat)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def continue_sync_jobs(fitbit_user, owner, countdown=None):
+    """
+    Send the task that runs a user's sync jobs for their next job, in the
+    lane of the job, or release their SyncLease if they have no jobs left.
+    """
+    from .tasks import run_sync_jobs
+
+    job = get_next_sync_job(fitbit_user)
+    if job is None:
+        SyncLease.objects.filter(
+            fitbit_user=fitbit_user, owner=owner).delete()
+        # A job queued before the lease was released didn't start the task
+        if SyncJob.objects.filter(fitbit_user=fitbit_user).exists():
+            start_sync_jobs(fitbit_user)
+        return
+    if countdown:
+        SyncLease.objects.filter(fitbit_user=fitbit_user, owner=owner).update(
+            expires=_lease_expiry(countdown))
+    run_sync_jobs.apply_async(
+        (fitbit_user, owner), countdown=countdown,
+        **get_task_options(job.lane))
+
+
 def _verified_setting(name):
     result = getattr(settings, name)
     if name == 'FITAPP_SUBSCRIPTIONS':
@@ -135,36 +781,248 @@ def get_all_sleep_log(date):
     
     :param date: The date of the sleep log (datetime).
     
-    Throw exceptions if an error occurs during the request. 
+    Errors are logged and isolated to the user they occur for. Returns a dict
+    of the number of users whose sleep log was saved, deferred or failed.
+    """
+    summary = {SWEEP_SUCCESS: 0, SWEEP_DEFERRED: 0, SWEEP_FAILED: 0}
+    for fbuser, status, detail in sweep_sleep_logs(date):
+        summary[status] += 1
+        if status == SWEEP_DEFERRED:
+            logger.info('Rate limit reached for user %s, will try again in '
+                        '%s seconds' % (fbuser, detail))
+        elif status == SWEEP_FAILED:
+            logger.error('Exception getting sleep log for user %s: %s' % (
+                fbuser, detail))
+    logger.info('Sleep logs for %s: %s' % (date, summary))
+    return summary
+
+
+def sweep_sleep_logs(date, concurrency=None):
+    """
+    Get the sleep log of every user at a date, for up to ``concurrency`` users
+    at a time (``FITAPP_SLEEP_SWEEP_CONCURRENCY`` by default). This is a
+    generator yielding a ``(fbuser, status, detail)`` tuple for each user as
+    soon as they are done, where status is one of:
+
+    ``SWEEP_SUCCESS``
+        The sleep log was saved, detail is None.
+    ``SWEEP_DEFERRED``
+        The user's rate limit was reached, so the sleep log will be retrieved
+        by the :py:func:`fitapp.tasks.get_sleep_log` task once it resets.
+        detail is the number of seconds until then.
+    ``SWEEP_FAILED``
+        Any other error occurred, detail is the exception.
+
+    :param date: The date of the sleep log (datetime).
+    :param concurrency: The number of users to get sleep logs for at a time.
     """
-    fbusers = UserFitbit.objects.all()
-    print('Fitbit Users: {}'.format(fbusers))
+    from .tasks import get_sleep_log
+
+    fbusers = list(UserFitbit.objects.all())
+    if concurrency is None:
+        concurrency = get_setting('FITAPP_SLEEP_SWEEP_CONCURRENCY')
+    if concurrency > 1 and len(fbusers) > 1:
+        pool = ThreadPool(min(concurrency, len(fbusers)))
+        results = pool.imap_unordered(
+            lambda fbuser: _sweep_sleep_log(fbuser, date, in_thread=True),
+            fbusers)
+    else:
+        pool = None
+        results = (_sweep_sleep_log(fbuser, date) for fbuser in fbusers)
     try:
-        for fbuser in fbusers:
-            get_fitbit_sleep_log(fbuser=fbuser, date=date)
-    except HTTPTooManyRequests:
-        # We have hit the rate limit for the user, retry when it's reset,
-        # according to the reply from the failing API call
-        print('Rate limit reached for user {}'.format(fbuser))
-    except HTTPBadRequest:
-        # If the resource is elevation or floors, we are just getting this
-        # error because the data doesn't exist for this user, so we can ignore
-        # the error
-        e = sys.exc_info()[1]
-        print('Bad request: {}'.format(e))
-    except Exception:
-        e = sys.exc_info()[1]
-        print('Exception: {}'.format(e))
+        for fbuser, status, detail in results:
+            if status == SWEEP_DEFERRED:
+                queue_sync_job(
+                    fbuser.fitbit_user, get_sleep_log,
+                    (fbuser.fitbit_user, date), lane='maintenance',
+                    countdown=detail)
+            yield fbuser, status, detail
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+def _sweep_sleep_log(fbuser, date, in_thread=False):
+    try:
+        get_fitbit_sleep_log(fbuser=fbuser, date=date)
+        return fbuser, SWEEP_SUCCESS, None
+    except HTTPTooManyRequests as e:
+        return fbuser, SWEEP_DEFERRED, e.retry_after_secs
+    except Exception as e:
+        return fbuser, SWEEP_FAILED, e
+    finally:
+        # Each thread has its own database connection
+        if in_thread:
+            connection.close()
+
+
+def get_date_windows(start_date, end_date, days):
+    """
+    Split a range of dates into consecutive windows of at most ``days`` days,
+    returning a list of ``(start_date, end_date)`` tuples, both inclusive.
+    """
+    windows = []
+    while start_date <= end_date:
+        window_end = min(start_date + timedelta(days=days - 1), end_date)
+        windows.append((start_date, window_end))
+        start_date = window_end + timedelta(days=1)
+    return windows
 
 
-def get_sleep_log_by_date_range(fbuser, start_date, end_date):
+def get_period_start(period, end_date):
+    """
+    Return the first date of a period, such as ``'1y'`` or ``'30d'``, ending
+    on ``end_date``. The first date of ``'max'`` is the earliest date any
+    Fitbit data can have.
+    """
+    if period == 'max':
+        return HISTORY_START
+    units = {'y': 'years', 'm': 'months', 'w': 'weeks', 'd': 'days'}
+    delta = relativedelta(**{units[period[-1]]: int(period[:-1])})
+    return end_date - delta + timedelta(days=1)
+
+
+def get_backfill_start(fbuser, end_date):
+    """
+    Return the first date of a user's history to retrieve, according to the
+    ``FITAPP_DEFAULT_PERIOD`` setting. The whole history of a user starts on
+    the date they became a Fitbit member.
+    """
+    period = get_setting('FITAPP_DEFAULT_PERIOD') or 'max'
+    if period != 'max':
+        return get_period_start(period, end_date)
+    member_since = get_fitbit_profile(fbuser).get('memberSince')
+    if member_since:
+        return parser.parse(member_since).date()
+    return HISTORY_START
+
+
+def get_backfill_windows(fbuser, resource_type, start_date, end_date):
+    """
+    Split a user's history of a time series resource into windows of at most
+    ``FITAPP_BACKFILL_WINDOW_DAYS`` days, returning the windows that don't
+    have a BackfillCheckpoint yet, newest first.
+
+    The windows are counted from ``start_date``, so they stay the same from
+    one day to the next and the checkpoints of an earlier backfill still
+    match them.
+    """
+    checkpoints = BackfillCheckpoint.objects.filter(
+        user=fbuser.user, resource=resource_type.path(),
+        base_date__lte=end_date, end_date__gte=start_date,
+    ).values_list('base_date', 'end_date')
+    return [
+        window for window in reversed(get_date_windows(
+            start_date, end_date, get_setting('FITAPP_BACKFILL_WINDOW_DAYS')))
+        if not any(base_date <= window[0] and window[1] <= end
+                   for base_date, end in checkpoints)
+    ]
+
+
+def backfill_time_series_window(fbuser, resource_type, base_date, end_date):
+    """
+    Retrieve and save a window of a user's time series data, and save a
+    BackfillCheckpoint for it and move its sync watermark forward. Windows
+    that end today or later are saved without a checkpoint, since their data
+    can still change.
+    """
+    data = get_fitbit_data(
+        fbuser, resource_type, base_date=base_date, end_date=end_date)
+    data = [(parser.parse(datum['dateTime']), datum['value'])
+            for datum in data]
+    with transaction.atomic():
+        save_time_series_data(fbuser.user, resource_type, data)
+        if data:
+            update_sync_watermark(
+                fbuser.user, resource_type, max(data)[0].date())
+        if end_date < date.today():
+            BackfillCheckpoint.objects.create(
+                user=fbuser.user, resource=resource_type.path(),
+                base_date=base_date, end_date=end_date)
+
+
+def get_sleep_log_by_date_range(fbuser, start_date, end_date, concurrency=None):
     """
     Get the sleep logs of a user during a date range.
-    
+
+    The range is split into windows of at most 100 days, the most the Fitbit
+    API allows in one request, which are retrieved up to ``concurrency``
+    (``FITAPP_SLEEP_BACKFILL_CONCURRENCY`` by default) at a time. The sleep
+    stages and summaries of each window are saved as soon as it arrives, and a
+    BackfillCheckpoint is saved for it, so the windows already saved are
+    skipped when this is called again after an error. Windows that end today
+    or later are saved without a checkpoint.
+
+    If retrieving any window fails, no more windows are requested and the
+    first error is raised once the windows in progress have been saved.
+
     :param fbuser: A UserFitbit instance (UserFitbit).
     :param start_date: sleep logs start date (datetime).
     :param end_date: sleep logs end date (datetime).
+    :param concurrency: The number of windows to retrieve at a time.
     """
+    if isinstance(start_date, datetime):
+        start_date = start_date.date()
+    if isinstance(end_date, datetime):
+        end_date = end_date.date()
+    checkpoints = BackfillCheckpoint.objects.filter(
+        user=fbuser.user, resource=SLEEP_RESOURCE,
+        base_date__lte=end_date, end_date__gte=start_date,
+    ).values_list('base_date', 'end_date')
+    windows = [
+        window for window in get_date_windows(
+            start_date, end_date, SLEEP_RANGE_MAX_DAYS)
+        if not any(base_date <= window[0] and window[1] <= end
+                   for base_date, end in checkpoints)
+    ]
+    if concurrency is None:
+        concurrency = get_setting('FITAPP_SLEEP_BACKFILL_CONCURRENCY')
+
+    failed = threading.Event()
+    in_thread = concurrency > 1 and len(windows) > 1
+
+    def get_window(window):
+        if failed.is_set():
+            return window, None
+        try:
+            return window, _get_sleep_window(fbuser, *window)
+        except Exception as e:
+            failed.set()
+            return window, e
+        finally:
+            # Each thread has its own database connection, which refreshing
+            # the user's token may have opened
+            if in_thread:
+                connection.close()
+
+    if in_thread:
+        pool = ThreadPool(min(concurrency, len(windows)))
+        results = pool.imap_unordered(get_window, windows)
+    else:
+        pool = None
+        results = (get_window(window) for window in windows)
+    error = None
+    try:
+        for (base_date, end), data in results:
+            if isinstance(data, Exception):
+                error = error or data
+            elif data is not None:
+                with transaction.atomic():
+                    save_sleep_stages(fbuser.user, data['sleep'])
+                    save_sleep_summaries(fbuser.user, data['sleep'])
+                    # Windows that end today or later can still change
+                    if end < date.today():
+                        BackfillCheckpoint.objects.create(
+                            user=fbuser.user, resource=SLEEP_RESOURCE,
+                            base_date=base_date, end_date=end)
+    finally:
+        if pool is not None:
+            pool.terminate()
+    if error is not None:
+        raise error
+
+
+def _get_sleep_window(fbuser, start_date, end_date):
     fb = create_fitbit(**fbuser.get_user_data())
     start_date_string = fb._get_date_string(start_date)
     end_date_string = fb._get_date_string(end_date)
@@ -174,19 +1032,103 @@ def get_sleep_log_by_date_range(fbuser, start_date, end_date):
                 start_date=start_date_string,
                 end_date=end_date_string
                 )
-    data = fb.make_request(url)
-    parse_sleep_data(fbuser=fbuser, json_data=data)
+    return fb.make_request(url)
 
 
-def get_fitbit_sleep_log(fbuser, date, summary=False):
+def sync_sleep_logs(fbuser, after_date=None):
+    """
+    Get the sleep logs a user has logged since the last sync, through
+    Fitbit's paginated sleep log list, and save their sleep stages and
+    summaries. The id and start time of the newest sleep log are saved on
+    the UserFitbit after each page, so the next sync starts from there.
+
+    When the user has never been synced, sleep logs are listed from
+    ``after_date``, the date of the newest sleep summary that has been
+    saved or otherwise from the start.
+
+    Returns the number of sleep logs that were saved.
+
+    :param fbuser: A UserFitbit instance (UserFitbit).
+    :param after_date: The date to list sleep logs from when the user has
+        never been synced (datetime).
+    """
+    after_date = fbuser.last_sleep_start or after_date
+    if after_date is None:
+        summary = SleepStageSummary.objects.filter(
+            user=fbuser.user).order_by('-date').first()
+        after_date = summary.date if summary else SLEEP_LIST_START
+    if timezone.is_aware(after_date):
+        after_date = timezone.make_naive(
+            after_date, timezone.get_default_timezone())
+
+    fb = create_fitbit(**fbuser.get_user_data())
+    url = '{0}/{1}/user/-/sleep/list.json'.format(*fb._get_common_args())
+    params = {
+        'afterDate': after_date.strftime('%Y-%m-%dT%H:%M:%S'),
+        'sort': 'asc',
+        'offset': 0,
+        'limit': SLEEP_LIST_PAGE_SIZE,
+    }
+    count = 0
+    while url:
+        data = fb.make_request(url, params=params)
+        # The newest sleep log of the last sync can be listed again
+        sleep_logs = [log for log in data['sleep']
+                      if log['logId'] != fbuser.last_sleep_log_id]
+        if sleep_logs:
+            with transaction.atomic():
+                save_sleep_stages(fbuser.user, sleep_logs)
+                save_sleep_summaries(fbuser.user, sleep_logs)
+                fbuser.last_sleep_log_id = sleep_logs[-1]['logId']
+                fbuser.last_sleep_start = _normalize_date(
+                    parser.parse(sleep_logs[-1]['startTime']))
+                fbuser.save(update_fields=[
+                    'last_sleep_log_id', 'last_sleep_start'])
+            count += len(sleep_logs)
+        # The url of the next page includes the parameters
+        url, params = data['pagination'].get('next'), None
+    return count
+
+
+def queue_sleep_sync(fitbit_user, night):
+    """
+    Queue the sync of a user's sleep logs for a sleep update from Fitbit.
+
+    New sleep logs are retrieved through the sleep log list by the
+    :py:func:`fitapp.tasks.sync_sleep_logs` job, which a burst of updates
+    queues only once. An edited sleep log isn't listed again though, so the
+    night of the update is retrieved by date as well, with the
+    :py:func:`fitapp.tasks.get_sleep_log` job, unless it's too recent for a
+    log of it to have been synced already.
+
+    :param fitbit_user: The Fitbit user ID of the user.
+    :param night: The date of the sleep update (datetime).
+    """
+    from .tasks import get_sleep_log, sync_sleep_logs
+
+    queue_sync_job(fitbit_user, sync_sleep_logs, (fitbit_user,))
+    last_start = UserFitbit.objects.filter(
+        fitbit_user=fitbit_user,
+    ).values_list('last_sleep_start', flat=True).first()
+    if last_start is not None and timezone.is_aware(last_start):
+        last_start = timezone.make_naive(
+            last_start, timezone.get_default_timezone())
+    # A sleep log's date of sleep is at most a day after it starts
+    if last_start is None or \
+            night.date() <= last_start.date() + timedelta(days=1):
+        queue_sync_job(fitbit_user, get_sleep_log, (fitbit_user, night))
+
+
+def get_fitbit_sleep_log(fbuser, date, summary=None):
     """
     This method calls get_sleep(date) method of a Fitbit instance to get the sleep log, 
-    parse the json data and save it to database after that. This method can be used to get either sleep time 
-    series data or the sleep summary log if summary param is True.
+    parse the json data and save it to database after that. By default both the sleep time
+    series data and the sleep summary are saved from the one request, set the summary param to
+    True or False to save only the sleep summary or only the sleep time series data.
     
     :param fbuser: A UserFitbit instance (UserFitbit).
     :param date: The date of the log (datetime).
-    :param summary: Whether it should be a sleep summary data, set False by default (Bool).
+    :param summary: Whether it should be a sleep summary data, set None by default to save both (Bool).
     """
     fb = create_fitbit(**fbuser.get_user_data())
     data = fb.get_sleep(date)
@@ -199,28 +1141,124 @@ def parse_sleep_data(fbuser, json_data, summary=False):
     
     :param fbuser: A UserFibit instance (UserFitbit).
     :param json_data: Json data that get from Fitbit API 
-    :param summary: Whether it should be a sleep summary data, set False by default (Bool).
+    :param summary: Whether it should be a sleep summary data, set False by default, or None
+        to save both the sleep time series data and the sleep summary (Bool).
     """
     sleep_data = json_data['sleep']
     if sleep_data:
-        for intraday in sleep_data:
-            date_of_sleep = intraday['dateOfSleep']
-            if summary:
-                summary_data = intraday['levels']['summary']
-                keys = ['wake', 'rem', 'light', 'deep']
-                sleep_summary_object, _ = SleepStageSummary.objects.get_or_create(user=fbuser.user, date=date_of_sleep)
-                sleep_summary_object.save()
-                for key in keys:
-                    count = summary_data[key]['count'] if summary_data[key]['count'] else 0
-                    minute = summary_data[key]['minutes'] if summary_data[key]['minutes'] else 0
-                    sleep_summary_data, created = SleepTypeData.objects.get_or_create(
-                        sleep_summary=sleep_summary_object, level=key, count=count, minute=minute)
-                    sleep_summary_data.save()
-            else:
-                short_data = intraday['levels']['data']
-                for data in short_data:
-                    # Create new record or update existing
-                    sleep_time_series_data, created = SleepStageTimeSeriesData.objects.get_or_create(
-                        user=fbuser.user, date=data['dateTime'],
-                        level=data['level'], seconds=data['seconds'])
-                    sleep_time_series_data.save()
+        if summary is not False:
+            save_sleep_summaries(fbuser.user, sleep_data)
+        if not summary:
+            save_sleep_stages(fbuser.user, sleep_data)
+
+
+def save_sleep_stages(user, sleep_logs):
+    """
+    Create or update the sleep stages of a user's sleep logs in bulk: the
+    SleepHypnogram of each night, matched on the date of the night, and
+    unless ``FITAPP_SAVE_SLEEP_STAGE_ROWS`` is False the
+    SleepStageTimeSeriesData of each stage, matched on its date.
+
+    A night can have several sleep logs, such as a nap, which may be saved
+    in separate calls, so the stored stages of a night are kept, except for
+    those within the time span of a sleep log that's saved. Those are
+    replaced by the log's stages, since an edited log's stages can move.
+
+    :param user: The user the sleep logs belong to.
+    :param sleep_logs: A list of sleep logs, as returned by the Fitbit API.
+    """
+    rows = {}
+    nights = defaultdict(dict)
+    spans = defaultdict(list)
+    for sleep_log in sleep_logs:
+        night = _normalize_date(parser.parse(sleep_log['dateOfSleep']))
+        for data in sleep_log['levels']['data']:
+            date = _normalize_date(parser.parse(data['dateTime']))
+            rows[date] = {'level': data['level'], 'seconds': data['seconds']}
+            # Levels the hypnogram can't encode are only saved as rows
+            if data['level'] in SleepHypnogram.LEVELS:
+                nights[night][date] = (data['level'], data['seconds'])
+        if sleep_log['levels']['data']:
+            spans[night].append(_get_sleep_log_span(sleep_log))
+    if not rows:
+        return
+    all_spans = sum(spans.values(), [])
+
+    def replaced(date, spans=all_spans):
+        return any(start <= date < end for start, end in spans)
+
+    with transaction.atomic():
+        for hypnogram in SleepHypnogram.objects.filter(
+                user=user, date__in=list(spans)):
+            stages = nights[hypnogram.date]
+            for stage in hypnogram.decode():
+                if not replaced(stage.date, spans[hypnogram.date]):
+                    stages.setdefault(stage.date, (stage.level, stage.seconds))
+        hypnograms = {}
+        for night, stages in nights.items():
+            if not stages:
+                continue
+            start, data = SleepHypnogram.encode([
+                (date, level, seconds)
+                for date, (level, seconds) in stages.items()])
+            hypnograms[night] = {'start': start, 'data': data}
+        changed = _bulk_upsert(SleepHypnogram.objects.filter(
+            user=user, date__in=list(hypnograms)), 'date', hypnograms,
+            user=user)
+        if changed:
+            # The summaries of the nights tell when their stages changed
+            SleepStageSummary.objects.filter(
+                user=user, date__in=changed).update(updated=timezone.now())
+        if get_setting('FITAPP_SAVE_SLEEP_STAGE_ROWS'):
+            queryset = SleepStageTimeSeriesData.objects.filter(
+                user=user, date__gte=min(start for start, _ in all_spans),
+                date__lt=max(end for _, end in all_spans))
+            _bulk_upsert(queryset, 'date', rows, replaced=replaced, user=user)
+
+
+def _get_sleep_log_span(sleep_log):
+    """
+    The start and end of a sleep log, from its start and end times where
+    they're given, widened to cover all of its stages.
+    """
+    stages = [
+        (_normalize_date(parser.parse(data['dateTime'])), data['seconds'])
+        for data in sleep_log['levels']['data']]
+    start = min(date for date, _ in stages)
+    end = max(date + timedelta(seconds=seconds) for date, seconds in stages)
+    if sleep_log.get('startTime'):
+        start = min(start, _normalize_date(
+            parser.parse(sleep_log['startTime'])))
+    if sleep_log.get('endTime'):
+        end = max(end, _normalize_date(parser.parse(sleep_log['endTime'])))
+    return start, end
+
+
+def save_sleep_summaries(user, sleep_logs):
+    """
+    Create or update the sleep stage summaries of a user's sleep logs, and
+    the summary of each sleep level of them, matching existing summary data
+    on its level.
+
+    :param user: The user the sleep logs belong to.
+    :param sleep_logs: A list of sleep logs, as returned by the Fitbit API.
+    """
+    keys = ['wake', 'rem', 'light', 'deep']
+    for sleep_log in sleep_logs:
+        # Classic sleep logs don't have a summary of the sleep stages
+        if sleep_log.get('type') == 'classic':
+            continue
+        date_of_sleep = _normalize_date(parser.parse(sleep_log['dateOfSleep']))
+        summary_data = sleep_log['levels']['summary']
+        sleep_summary, created = SleepStageSummary.objects.get_or_create(
+            user=user, date=date_of_sleep)
+        rows = {}
+        for key in keys:
+            data = summary_data.get(key) or {}
+            rows[key] = {'count': data.get('count') or 0,
+                         'minute': data.get('minutes') or 0}
+        changed = _bulk_upsert(
+            SleepTypeData.objects.filter(sleep_summary=sleep_summary),
+            'level', rows, sleep_summary=sleep_summary)
+        if changed and not created:
+            sleep_summary.save(update_fields=['updated'])
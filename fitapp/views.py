@@ -1,28 +1,38 @@
-from functools import cmp_to_key
+from datetime import datetime, timedelta
+from functools import cmp_to_key, reduce
 import simplejson as json
+import hashlib
 import logging
+import operator
+import requests
 
 from dateutil import parser
 from dateutil.relativedelta import relativedelta
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.signals import user_logged_in
 from django.core.exceptions import ImproperlyConfigured
 from django.core.urlresolvers import reverse
+from django.db import IntegrityError
+from django.db.models import Q
 from django.dispatch import receiver
-from django.http import HttpResponse, HttpResponseServerError, Http404
+from django.http import (HttpResponse, HttpResponseNotModified,
+                         HttpResponseServerError, Http404)
 from django.shortcuts import redirect, render
 from django.utils import timezone
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_GET
 from six import string_types
 
-from fitbit.exceptions import (HTTPUnauthorized, HTTPForbidden, HTTPConflict,
-                               HTTPServerError)
+from fitbit.exceptions import (HTTPException, HTTPUnauthorized, HTTPForbidden,
+                               HTTPConflict, HTTPServerError)
 
 from . import forms
 from . import utils
-from .models import UserFitbit, TimeSeriesData, TimeSeriesDataType
-from .tasks import get_time_series_data, subscribe, unsubscribe
+from .models import (UserFitbit, TimeSeriesData, TimeSeriesDataType,
+                     SleepStageSummary)
+from .tasks import (backfill_time_series_data, get_time_series_data,
+                    subscribe, unsubscribe, update_fitbit_profile)
 
 
 logger = logging.getLogger(__name__)
@@ -95,7 +105,9 @@ def complete(request):
     :ref:`FITAPP_LOGIN_REDIRECT`.
 
     If :ref:`FITAPP_SUBSCRIBE` is set to True, add a subscription to user
-    data at this time.
+    data at this time, and backfill each subscribed resource: the most recent
+    days first, then the rest of the user's history,
+    ``FITAPP_BACKFILL_WINDOW_DAYS`` days at a time.
 
     Requires the pk of the user or model that will be associated with fitapp
     data to be inserted into request.session['fb_user_id'] prior to calling
@@ -140,12 +152,13 @@ def complete(request):
         'expires_at': token['expires_at'],
     })
 
-    # Add the Fitbit user info to the session
-    fb = utils.create_fitbit(**fbuser.get_user_data())
-    request.session['fitbit_profile'] = fb.user_profile_get()
+    # Get the Fitbit user info in the background, the user is redirected
+    # without waiting on Fitbit
+    request.session.pop('fitbit_profile', None)
+    update_fitbit_profile.apply_async(
+        (fbuser.fitbit_user,), **utils.get_task_options('realtime'))
     if utils.get_setting('FITAPP_SUBSCRIBE'):
         init_delay = utils.get_setting('FITAPP_HISTORICAL_INIT_DELAY')
-        btw_delay = utils.get_setting('FITAPP_BETWEEN_DELAY')
         try:
             subs = utils.get_setting('FITAPP_SUBSCRIPTIONS')
         except ImproperlyConfigured as e:
@@ -156,7 +169,8 @@ def complete(request):
             logger.exception("Error for fbuser %s in views.complete: "
                              "No SUBSCRIBER_ID configured." % fbuser)
             return redirect(reverse('fitbit-error'))
-        subscribe.apply_async((fbuser.fitbit_user, SUBSCRIBER_ID), countdown=5)
+        subscribe.apply_async((fbuser.fitbit_user, SUBSCRIBER_ID), countdown=5,
+                              **utils.get_task_options('maintenance'))
         tsdts = TimeSeriesDataType.objects.all()
         # If FITAPP_SUBSCRIPTIONS is specified, narrow the list of data types
         # to retrieve
@@ -174,13 +188,18 @@ def complete(request):
                 cats.index(tsdt.category) + res.index(tsdt.resource)
             ))
 
-        # Create tasks for all data in all data types
-        for i, _type in enumerate(tsdts):
+        # Create backfill tasks for all data in all data types. Each gets the
+        # most recent days first, so they run right away in the realtime
+        # lane, then walks back through the history in the backfill lane.
+        # They're queued as one batch, so the response waits on the broker
+        # once at most.
+        backfills = [(fbuser.fitbit_user, _type.category, _type.resource,)
+                     for _type in tsdts]
+        if backfills:
             # Delay execution for a few seconds to speed up response
-            # Offset each call a bit so they don't bog down the server
-            get_time_series_data.apply_async(
-                (fbuser.fitbit_user, _type.category, _type.resource,),
-                countdown=init_delay + (i * btw_delay))
+            utils.queue_sync_jobs(
+                fbuser.fitbit_user, backfill_time_series_data, backfills,
+                countdown=init_delay)
 
     next_url = request.session.pop('fitbit_next', None) or utils.get_setting(
         'FITAPP_LOGIN_REDIRECT')
@@ -189,17 +208,21 @@ def complete(request):
 
 @receiver(user_logged_in)
 def create_fitbit_session(sender, request, user, **kwargs):
-    """ If the user is a fitbit user, update the profile in the session. """
+    """
+    If the user is a fitbit user, add their timezone and display name to the
+    session from the profile cache, and update the cached profile in the
+    background.
+    """
 
-    if user.is_authenticated() and utils.is_integrated(user) and \
-            user.is_active:
-        fbuser = UserFitbit.objects.filter(user=user)
-        if fbuser.exists():
-            fb = utils.create_fitbit(**fbuser[0].get_user_data())
-            try:
-                request.session['fitbit_profile'] = fb.user_profile_get()
-            except:
-                pass
+    if user.is_authenticated() and user.is_active:
+        fbuser = UserFitbit.objects.filter(user=user).first()
+        if fbuser is not None:
+            profile = utils.get_cached_profile(user)
+            if profile is not None:
+                request.session['fitbit_profile'] = \
+                    utils.get_session_profile(profile)
+            update_fitbit_profile.apply_async(
+                (fbuser.fitbit_user,), **utils.get_task_options('realtime'))
 
 
 @conditional_decorator(login_required, utils.get_setting('FITAPP_LOGIN_REQUIRED'))
@@ -263,7 +286,8 @@ def logout(request):
             kwargs = fbuser.get_user_data()
             # The refresh callback is not desired since the user will be gone
             del kwargs['refresh_cb']
-            unsubscribe.apply_async(kwargs=kwargs, countdown=5)
+            unsubscribe.apply_async(kwargs=kwargs, countdown=5,
+                                    **utils.get_task_options('maintenance'))
         fbuser.delete()
     next_url = request.GET.get('next', None) or utils.get_setting(
         'FITAPP_LOGOUT_REDIRECT')
@@ -274,7 +298,9 @@ def logout(request):
 def update(request):
     """Receive notification from Fitbit or verify subscriber endpoint.
 
-    Loop through the updates and create celery tasks to get the data.
+    Loop through the updates and create celery tasks to get the data. For
+    sleep updates, tasks to get the sleep stages and summaries of the new
+    sleep logs are created too, see :py:func:`fitapp.utils.queue_sleep_sync`.
     More information here:
     https://dev.fitbit.com/docs/subscriptions/
 
@@ -309,13 +335,16 @@ def update(request):
         try:
             # Create a celery task for each data type in the update
             subs = utils.get_setting('FITAPP_SUBSCRIPTIONS')
-            btw_delay = utils.get_setting('FITAPP_BETWEEN_DELAY')
             all_tsdts = list(TimeSeriesDataType.objects.all())
             for update in updates:
                 c_type = update['collectionType']
                 if subs is not None and c_type not in subs:
                     continue
                 cat = getattr(TimeSeriesDataType, c_type)
+                date = parser.parse(update['date'])
+                if cat == TimeSeriesDataType.sleep:
+                    # Get the sleep stages and summary of the new sleep logs
+                    utils.queue_sleep_sync(update['ownerId'], date)
                 tsdts = filter(lambda tsdt: tsdt.category == cat, all_tsdts)
                 if subs is not None:
                     res_list = subs[c_type]
@@ -323,13 +352,14 @@ def update(request):
                         filter(lambda tsdt: tsdt.resource in res_list, tsdts),
                         key=lambda tsdt: res_list.index(tsdt.resource)
                     )
-                for i, _type in enumerate(tsdts):
-                    # Offset each call by a few seconds so they don't bog down
-                    # the server
-                    get_time_series_data.apply_async(
-                        (update['ownerId'], _type.category, _type.resource,),
-                        {'date': parser.parse(update['date'])},
-                        countdown=(btw_delay * i))
+                # The user's jobs are run one at a time, so they don't bog
+                # down the server. The resources of the update are queued as
+                # one batch.
+                utils.queue_sync_jobs(
+                    update['ownerId'], get_time_series_data,
+                    [(update['ownerId'], _type.category, _type.resource,)
+                     for _type in tsdts],
+                    {'date': date})
         except (KeyError, ValueError, OverflowError):
             raise Http404
         except ImproperlyConfigured as e:
@@ -347,26 +377,56 @@ def update(request):
     return HttpResponse(status=404)
 
 
-def make_response(code=None, objects=[]):
+def make_response(code=None, objects=[], **meta):
     """AJAX helper method to generate a response"""
 
+    meta.update({'total_count': len(objects), 'status_code': code})
     data = {
-        'meta': {'total_count': len(objects), 'status_code': code},
+        'meta': meta,
         'objects': objects,
     }
     return HttpResponse(json.dumps(data))
 
 
-def normalize_date_range(request, fitbit_data):
-    """Prepare a fitbit date range for django database access. """
+def _paginate(rows, limit):
+    """
+    Slice a page of at most *limit* items off of an ordered queryset. Returns
+    the items in the page and whether there are more items after them.
+    """
+    rows = list(rows[:limit + 1])
+    return rows[:limit], len(rows) > limit
+
+
+def _bucket_datetime(seconds):
+    date = datetime.utcfromtimestamp(seconds)
+    if settings.USE_TZ:
+        date = timezone.make_aware(date, timezone.utc)
+    return date
+
+
+def normalize_date_range(request, fitbit_data, user=None):
+    """
+    Prepare a fitbit date range for django database access. 'today' is the
+    date in the timezone of the user's cached Fitbit profile, or of the
+    profile in the session.
+    """
 
     result = {}
     base_date = fitbit_data['base_date']
     if base_date == 'today':
         now = timezone.now()
-        if 'fitbit_profile' in request.session.keys():
-            tz = request.session['fitbit_profile']['user']['timezone']
-            now = timezone.pytz.timezone(tz).normalize(timezone.now())
+        tz = utils.get_cached_profile(
+            user if user is not None else request.user, 'timezone')
+        profile = request.session.get('fitbit_profile')
+        if tz is None and profile:
+            if 'user' in profile:
+                # Slim down a session holding the whole profile, from
+                # before only some of its fields were kept
+                profile = utils.get_session_profile(profile)
+                request.session['fitbit_profile'] = profile
+            tz = profile.get('timezone')
+        if tz:
+            now = datetime.now(timezone.pytz.timezone(tz))
         base_date = now.date().strftime('%Y-%m-%d')
     result['date__gte'] = base_date
 
@@ -393,6 +453,88 @@ def normalize_date_range(request, fitbit_data):
     return result
 
 
+def _conditional_response(request, validator, get_response):
+    """
+    Respond with ``get_response()``, with an ETag of *validator*, or with a
+    304 Not Modified response if the request's If-None-Match header matches
+    the ETag, without calling ``get_response`` to build the content.
+    """
+    etag = '"{}"'.format(hashlib.md5(
+        repr(validator).encode('utf8')).hexdigest())
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH', '')
+    if etag in [tag.strip() for tag in if_none_match.split(',')]:
+        response = HttpResponseNotModified()
+    else:
+        response = get_response()
+    response['ETag'] = etag
+    return response
+
+
+def _get_data_user(request):
+    """
+    Look up the user whose data is requested by one of the AJAX data views.
+
+    Returns a ``(user, code)`` tuple, where *code* is the error status code to
+    respond with if the user could not be determined.
+    """
+    user_model = UserFitbit.user.field.rel.to
+
+    try:
+        fb_user_id = int(request.session.get('fb_user_id'))
+        user = user_model.objects.get(pk=fb_user_id)
+    except KeyError:
+        return None, 102
+    except TypeError:
+        return None, 101
+    return user, None
+
+
+def _read_through(user, resource_type, date_range):
+    """
+    Retrieve and save the days of the date range of a data view that haven't
+    been synced yet. Fitbit errors are logged, and the stored data is
+    returned regardless, as it is when Fitbit can't be reached or a
+    concurrent sync saved the same days first.
+    """
+    fbuser = UserFitbit.objects.filter(user=user).first()
+    if fbuser is None:
+        return
+
+    def as_date(value):
+        if isinstance(value, string_types):
+            value = parser.parse(value)
+        return value.date() if isinstance(value, datetime) else value
+
+    start_date = as_date(date_range['date__gte'])
+    end_date = date_range.get('date__lte')
+    if end_date is not None:
+        end_date = as_date(end_date)
+    try:
+        utils.read_through_time_series(
+            fbuser, resource_type, start_date, end_date)
+    except (HTTPException, requests.RequestException, IntegrityError):
+        logger.warning("Couldn't read through %s data for user %s" % (
+            resource_type, fbuser.fitbit_user), exc_info=True)
+
+
+def _get_date_params(request):
+    """
+    Validate the date GET parameters of the AJAX data views, returning the
+    Fitbit API date arguments or None if they are invalid.
+    """
+    base_date = request.GET.get('base_date', None)
+    period = request.GET.get('period', None)
+    end_date = request.GET.get('end_date', None)
+    if period and not end_date:
+        form = forms.PeriodForm({'base_date': base_date, 'period': period})
+    elif end_date and not period:
+        form = forms.RangeForm({'base_date': base_date, 'end_date': end_date})
+    else:
+        # Either end_date or period, but not both, must be specified.
+        return None
+    return form.get_fitbit_data()
+
+
 @require_GET
 def get_steps(request):
     """An AJAX view that retrieves this user's step data from Fitbit.
@@ -448,6 +590,24 @@ def get_data(request, category, resource):
         :meta: a map containing two things: the *total_count* of objects, and
             the *status_code* of the response.
 
+    When :ref:`FITAPP_SUBSCRIBE` is enabled, long histories can be retrieved
+    a page at a time by passing a *limit* GET parameter, the maximum number
+    of days to return (up to ``FITAPP_MAX_PAGE_SIZE``). The *meta* map then
+    also contains a *next* cursor, which is passed as the *cursor* GET
+    parameter with otherwise identical parameters to retrieve the following
+    page. *next* is null on the last page. Each page costs the same to
+    retrieve, however far into the history it is.
+
+    When :ref:`FITAPP_SUBSCRIBE` and ``FITAPP_READ_THROUGH`` are enabled,
+    the days of the requested range that are newer than the last sync of the
+    resource are retrieved from Fitbit and saved first, so the stored data is
+    returned up to date while only the missing days cost a Fitbit request.
+
+    When :ref:`FITAPP_SUBSCRIBE` is disabled, the data is retrieved from
+    Fitbit, and each response is cached for ``FITAPP_LIVE_CACHE_TIMEOUT``
+    seconds. Identical requests made at the same time share one request to
+    Fitbit.
+
     When everything goes well, the *status_code* is 100 and the requested data
     is included. However, there are a number of things that can 'go wrong'
     with this call. For each type of error, we return an empty data list with
@@ -471,15 +631,9 @@ def get_data(request, category, resource):
     URL name:
         `fitbit-data`
     """
-    user_model = UserFitbit.user.field.rel.to
-
-    try:
-        fb_user_id = int(request.session.get('fb_user_id'))
-        user = user_model.objects.get(pk=fb_user_id)
-    except KeyError:
-        return make_response(102)
-    except TypeError:
-        return make_response(101)
+    user, code = _get_data_user(request)
+    if code:
+        return make_response(code)
 
     # Manually check that user is logged in and integrated with Fitbit.
     try:
@@ -494,34 +648,40 @@ def get_data(request, category, resource):
     if not fitapp_subscribe and not utils.is_integrated(user):
         return make_response(102)
 
-    base_date = request.GET.get('base_date', None)
-    period = request.GET.get('period', None)
-    end_date = request.GET.get('end_date', None)
-    if period and not end_date:
-        form = forms.PeriodForm({'base_date': base_date, 'period': period})
-    elif end_date and not period:
-        form = forms.RangeForm({'base_date': base_date, 'end_date': end_date})
-    else:
-        # Either end_date or period, but not both, must be specified.
-        return make_response(104)
-
-    fitbit_data = form.get_fitbit_data()
+    fitbit_data = _get_date_params(request)
     if not fitbit_data:
         return make_response(104)
 
     if fitapp_subscribe:
         # Get the data directly from the database.
-        date_range = normalize_date_range(request, fitbit_data)
+        page = forms.PageForm(request.GET).get_fitbit_data()
+        if page is None:
+            return make_response(104)
+        date_range = normalize_date_range(request, fitbit_data, user)
+        if utils.get_setting('FITAPP_READ_THROUGH'):
+            _read_through(user, resource_type, date_range)
         existing_data = TimeSeriesData.objects.filter(
-            user=user, resource_type=resource_type, **date_range)
-        simplified_data = [{'value': d.value, 'dateTime': d.string_date()}
-                           for d in existing_data]
-        return make_response(100, simplified_data)
-
-    # Request data through the API and handle related errors.
+            user=user, resource_type=resource_type, **date_range
+        ).daily_series()
+        meta = {}
+        if page['cursor'] or page['limit']:
+            if page['cursor']:
+                existing_data = existing_data.filter(date__gt=page['cursor'])
+            max_limit = utils.get_setting('FITAPP_MAX_PAGE_SIZE')
+            existing_data, more = _paginate(
+                existing_data, min(page['limit'] or max_limit, max_limit))
+            meta['next'] = utils.encode_cursor(
+                existing_data[-1][0]) if more else None
+        simplified_data = [{'value': value, 'dateTime': date.strftime('%Y-%m-%d')}
+                           for date, value in existing_data]
+        return make_response(100, simplified_data, **meta)
+
+    # Request data through the API and handle related errors. Identical
+    # requests share a short-lived cached response.
     fbuser = UserFitbit.objects.get(user=user)
     try:
-        data = utils.get_fitbit_data(fbuser, resource_type, **fitbit_data)
+        data = utils.get_cached_fitbit_data(
+            fbuser, resource_type, **fitbit_data)
     except (HTTPUnauthorized, HTTPForbidden):
         # Delete invalid credentials.
         fbuser.delete()
@@ -537,3 +697,286 @@ def get_data(request, category, resource):
         raise
 
     return make_response(100, data)
+
+
+@require_GET
+def get_batch_data(request):
+    """An AJAX view that retrieves several types of this user's data at once.
+
+    This view works like :py:func:`fitapp.views.get_data`, but retrieves the
+    data for several resources over the same time period in a single request,
+    which is useful for dashboards that display many resources together.
+
+    The resources are given as one or more ``resource`` GET parameters, each
+    of the form 'category/resource', for example::
+
+        ?resource=activities/steps&resource=activities/distance&period=7d
+
+    The date parameters (*base_date*, *period* and *end_date*) are the same
+    as for :py:func:`fitapp.views.get_data`, as are the status codes. When
+    everything goes well, *objects* is a map from each requested
+    'category/resource' to an ordered list (from oldest to newest) of its
+    daily data, and the *total_count* is the number of resources returned.
+
+    URL name:
+        `fitbit-batch-data`
+    """
+    user, code = _get_data_user(request)
+    if code:
+        return make_response(code)
+
+    paths = request.GET.getlist('resource')
+    if not paths:
+        return make_response(104)
+    lookups = []
+    for path in paths:
+        category, _, resource = path.partition('/')
+        if not hasattr(TimeSeriesDataType, category) or not resource:
+            return make_response(104)
+        lookups.append(Q(category=getattr(TimeSeriesDataType, category),
+                         resource=resource))
+    resource_types = list(TimeSeriesDataType.objects.filter(
+        reduce(operator.or_, lookups)))
+    if len(resource_types) != len(set(paths)):
+        return make_response(104)
+
+    fitapp_subscribe = utils.get_setting('FITAPP_SUBSCRIBE')
+    if not fitapp_subscribe and not utils.is_integrated(user):
+        return make_response(102)
+
+    fitbit_data = _get_date_params(request)
+    if not fitbit_data:
+        return make_response(104)
+
+    if fitapp_subscribe:
+        # Get all of the data from the database in one query
+        date_range = normalize_date_range(request, fitbit_data, user)
+        paths_by_id = dict((t.pk, t.path()) for t in resource_types)
+        data = dict((p, []) for p in paths_by_id.values())
+        existing_data = TimeSeriesData.objects.filter(
+            user=user, resource_type__in=resource_types, **date_range
+        ).daily_series().values_list('resource_type', 'date', 'value')
+        for resource_type_id, date, value in existing_data:
+            data[paths_by_id[resource_type_id]].append({
+                'value': value, 'dateTime': date.strftime('%Y-%m-%d')})
+        return make_response(100, data)
+
+    # Request data through the API and handle related errors.
+    fbuser = UserFitbit.objects.get(user=user)
+    data = {}
+    try:
+        for resource_type in resource_types:
+            data[resource_type.path()] = utils.get_fitbit_data(
+                fbuser, resource_type, **fitbit_data)
+    except (HTTPUnauthorized, HTTPForbidden):
+        # Delete invalid credentials.
+        fbuser.delete()
+        return make_response(103)
+    except HTTPConflict:
+        return make_response(105)
+    except HTTPServerError:
+        return make_response(106)
+
+    return make_response(100, data)
+
+
+@require_GET
+def get_intraday_data(request, category, resource):
+    """An AJAX view that retrieves this user's stored intraday data.
+
+    This view may only be retrieved through a GET request. Intraday data is
+    only available for resources that support it, and is only stored when
+    both :ref:`FITAPP_SUBSCRIBE` and ``FITAPP_GET_INTRADAY`` are enabled.
+
+    The category and resource parameters are the same as for
+    :py:func:`fitapp.views.get_data`. Three GET parameters are required:
+
+        :base_date: The start of the time range, in the format
+            'yyyy-mm-dd hh:mm' or 'yyyy-mm-dd'.
+        :end_date: The end of the time range, in the same format. If no
+            time is given, the whole day is included.
+        :resolution: The size of each data point - one of '1min', '15min' or
+            '1h'. The minute level data is aggregated into points of this
+            size in the database.
+
+    An optional *function* GET parameter chooses how the minute level data is
+    aggregated - one of 'sum' (the default), 'avg', 'min' or 'max'.
+
+    Times are interpreted in the site's current time zone, and intraday data
+    is stored in UTC.
+
+    The response has the same format and status codes as
+    :py:func:`fitapp.views.get_data`, except that each *dateTime* is of the
+    format 'yyyy-mm-dd hh:mm:ss' and the *value* is a number. At most
+    ``FITAPP_INTRADAY_MAX_POINTS`` data points, or *limit* if that GET
+    parameter is smaller, are returned at a time. When there are more, the
+    *meta* map contains a *next* cursor which is passed as the *cursor* GET
+    parameter to retrieve the following page, as for
+    :py:func:`fitapp.views.get_data`.
+
+    URL name:
+        `fitbit-intraday-data`
+    """
+    user, code = _get_data_user(request)
+    if code:
+        return make_response(code)
+
+    try:
+        resource_type = TimeSeriesDataType.objects.get(
+            category=getattr(TimeSeriesDataType, category), resource=resource,
+            intraday_support=True)
+    except:
+        return make_response(104)
+
+    fitbit_data = forms.IntradayForm(request.GET).get_fitbit_data()
+    page = forms.PageForm(request.GET).get_fitbit_data()
+    if not fitbit_data or page is None:
+        return make_response(104)
+
+    resolution = fitbit_data['resolution']
+    existing_data = TimeSeriesData.objects.filter(
+        user=user, resource_type=resource_type,
+        date__gte=fitbit_data['base_date'], date__lt=fitbit_data['end_date'])
+    if page['cursor']:
+        existing_data = existing_data.filter(
+            date__gte=page['cursor'] + timedelta(seconds=resolution))
+    max_points = utils.get_setting('FITAPP_INTRADAY_MAX_POINTS')
+    buckets, more = _paginate(
+        existing_data.intraday_buckets(resolution, fitbit_data['function']),
+        min(page['limit'] or max_points, max_points))
+    dates = [_bucket_datetime(bucket['bucket']) for bucket in buckets]
+    data = [{
+        'value': bucket['aggregate'],
+        'dateTime': date.strftime('%Y-%m-%d %H:%M:%S'),
+    } for bucket, date in zip(buckets, dates)]
+    return make_response(
+        100, data, next=utils.encode_cursor(dates[-1]) if more else None)
+
+
+@require_GET
+def get_aggregate_data(request, category, resource):
+    """An AJAX view that aggregates this user's stored data in the database.
+
+    This view may only be retrieved through a GET request. It reads the daily
+    data stored in the database, so :ref:`FITAPP_SUBSCRIBE` should be enabled
+    for data to be available.
+
+    The category and resource parameters, and the date GET parameters, are
+    the same as for :py:func:`fitapp.views.get_data`. Two more GET parameters
+    choose how the data is aggregated:
+
+        :bucket: The size of each data point - one of 'day', 'week' (starting
+            on Monday), 'month' or 'year'.
+        :function: The aggregate function - one of 'sum' (the default),
+            'avg', 'min' or 'max'.
+
+    The response has the same format and status codes as
+    :py:func:`fitapp.views.get_data`, where each *dateTime* is the first day
+    of the bucket and *value* is the aggregate of the data within it, as a
+    number.
+
+    URL name:
+        `fitbit-aggregate-data`
+    """
+    user, code = _get_data_user(request)
+    if code:
+        return make_response(code)
+
+    try:
+        resource_type = TimeSeriesDataType.objects.get(
+            category=getattr(TimeSeriesDataType, category), resource=resource)
+    except:
+        return make_response(104)
+
+    fitbit_data = _get_date_params(request)
+    aggregate_data = forms.AggregateForm(request.GET).get_fitbit_data()
+    if not fitbit_data or not aggregate_data:
+        return make_response(104)
+
+    date_range = normalize_date_range(request, fitbit_data, user)
+    buckets = TimeSeriesData.objects.filter(
+        user=user, resource_type=resource_type, **date_range
+    ).daily_buckets(aggregate_data['bucket'], aggregate_data['function'])
+    data = [{
+        'value': bucket['aggregate'],
+        'dateTime': bucket['bucket'].strftime('%Y-%m-%d'),
+    } for bucket in buckets]
+    return make_response(100, data)
+
+
+@require_GET
+def get_sleep_data(request):
+    """An AJAX view that retrieves this user's stored sleep summaries.
+
+    This view may only be retrieved through a GET request. It reads the
+    sleep summaries stored in the database, with the summary of each sleep
+    level of every night read in one query.
+
+    The date GET parameters are the same as for
+    :py:func:`fitapp.views.get_data`. If the *stages* GET parameter is
+    'true', the sleep stages of each night are included too.
+
+    The response has the same format and status codes as
+    :py:func:`fitapp.views.get_data`, where each object is a night of sleep,
+    from oldest to newest, in the format of Fitbit's sleep logs::
+
+        {
+            "dateOfSleep": "2017-01-31",
+            "levels": {
+                "summary": {
+                    "deep": {"count": 3, "minutes": 70},
+                    ...
+                },
+                "data": [
+                    {
+                        "dateTime": "2017-01-30T23:10:00",
+                        "level": "light",
+                        "seconds": 600
+                    },
+                    ...
+                ]
+            }
+        }
+
+    The *data* list is only included with the sleep stages. The response has
+    an ETag, so that unchanged data isn't read or sent again when a client
+    requests it with an If-None-Match header. It changes when sleep data is
+    saved through :py:mod:`fitapp.utils`.
+
+    URL name:
+        `fitbit-sleep-data`
+    """
+    user, code = _get_data_user(request)
+    if code:
+        return make_response(code)
+
+    fitbit_data = _get_date_params(request)
+    sleep_data = forms.SleepForm(request.GET).get_fitbit_data()
+    if not fitbit_data or not sleep_data:
+        return make_response(104)
+
+    date_range = normalize_date_range(request, fitbit_data, user)
+    summaries = SleepStageSummary.objects.filter(user=user, **date_range)
+
+    def get_response():
+        data = []
+        for night in summaries.nights(stages=sleep_data['stages']):
+            levels = {'summary': dict(
+                (level.level, {'count': level.count, 'minutes': level.minute})
+                for level in night.get_summary_data)}
+            if sleep_data['stages']:
+                levels['data'] = [{
+                    'dateTime': stage.date.isoformat(),
+                    'level': stage.level,
+                    'seconds': stage.seconds,
+                } for stage in night.stages]
+            data.append({
+                'dateOfSleep': night.date.strftime('%Y-%m-%d'),
+                'levels': levels,
+            })
+        return make_response(100, data)
+
+    # The nights are only read and serialized if they've changed
+    validator = (user.pk, sorted(date_range.items()), sleep_data['stages'],
+                 summaries.version())
+    return _conditional_response(request, validator, get_response)